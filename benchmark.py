@@ -0,0 +1,433 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Copyright (C) USC Information Sciences Institute
+# Author: Vladimir M. Zaytsev <zaytsev@usc.edu>
+# URL: <http://nlg.isi.edu/>
+# For more information, see README.md
+# For license information, see LICENSE
+
+"""
+Micro-benchmarks of mokujin hot paths.
+
+Usage:
+    $ python benchmark.py parse -i testdata/sample.lf -r 2000
+    $ python benchmark.py memory -i testdata/sample.lf -r 2000
+    $ python benchmark.py extract -i testdata/sample.lf -r 2000
+    $ python benchmark.py corpus -i testdata/sample.lf -r 2000
+    $ python benchmark.py fold -i testdata/sample.lf -r 2000
+    $ python benchmark.py index -i testdata/rus.tuples -r 100
+    $ python benchmark.py codec -i testdata/rus.tuples -r 100
+    $ python benchmark.py terms -i testdata/rus.tuples -r 100
+    $ python benchmark.py tuples -i testdata/rus.tuples -r 100
+    $ python benchmark.py snapshot -i testdata/rus.tuples -r 100
+"""
+
+import gc
+import os
+import sys
+import time
+import array
+import random
+import shutil
+import logging
+import argparse
+import resource
+import tempfile
+import subprocess
+import collections
+
+from mokujin import extsort
+from mokujin.logicalform import Sentence
+from mokujin.logicalform import MetaphorAdpLF_Reader
+from mokujin.lfcorpus import BinaryLF_Reader, BinaryLF_Writer
+from mokujin.triples import ACTUAL_RELS, TripleExtractor, TripleFold
+
+
+def read_lf_lines(lf_path, repeat):
+    lines = []
+    with open(lf_path, "rb") as lf_file:
+        for line in lf_file:
+            if line[0] != "%" and line[0:3] != "id(" and len(line) > 1:
+                lines.append(line.decode("utf-8"))
+    return lines * repeat
+
+
+def bench_parse(args):
+    lf_lines = read_lf_lines(args.input, args.repeat)
+    logging.info("PARSING %d SENTENCES" % len(lf_lines))
+    parsers = (
+        ("split", Sentence.split_lf_line),
+        ("scan", Sentence.from_lf_line),
+    )
+    outputs = []
+    for name, parse in parsers:
+        outputs.append([repr(p) for i, line in enumerate(lf_lines[:1000]) for p in parse(i, line)])
+        t0 = time.time()
+        for i, line in enumerate(lf_lines):
+            parse(i, line)
+        elapsed = time.time() - t0
+        logging.info("%s: %.2f sec, %.0f sentences/sec" % (name, elapsed, len(lf_lines) / elapsed))
+    if outputs[0] != outputs[1]:
+        logging.error("PARSERS OUTPUT DIFFERS")
+
+
+def bench_memory(args):
+    lf_lines = read_lf_lines(args.input, args.repeat)
+    logging.info("LOADING %d SENTENCES" % len(lf_lines))
+    gc.collect()
+    objects_before = len(gc.get_objects())
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    sentences = [Sentence.from_lf_line(i, line) for i, line in enumerate(lf_lines)]
+    gc.collect()
+    objects = len(gc.get_objects()) - objects_before
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+    predicates = sum(len(s.predicates) for s in sentences)
+    logging.info("PEAK RSS: %.1f MB (+%.1f MB)" % (rss_before / 1024.0 + rss / 1024.0, rss / 1024.0))
+    logging.info("PER SENTENCE: %.0f bytes, %.1f GC objects (%.1f predicates)" % (
+        rss * 1024.0 / len(sentences),
+        float(objects) / len(sentences),
+        float(predicates) / len(sentences),
+    ))
+
+
+def bench_extract(args):
+    lf_lines = read_lf_lines(args.input, args.repeat)
+    logging.info("EXTRACTING TRIPLES FROM %d SENTENCES" % len(lf_lines))
+    t0 = time.time()
+    sentences = [Sentence.from_lf_line(i, line) for i, line in enumerate(lf_lines)]
+    elapsed = time.time() - t0
+    logging.info("parse: %.2f sec, %.0f sentences/sec" % (elapsed, len(lf_lines) / elapsed))
+    extractors = (
+        ("per-relation", TripleExtractor(triple_patterns=ACTUAL_RELS, fused=False)),
+        ("fused", TripleExtractor(triple_patterns=ACTUAL_RELS)),
+    )
+    for name, extractor in extractors:
+        t0 = time.time()
+        triples = 0
+        for matches in extractor.i_extract_triples(sentences):
+            triples += len(matches)
+        elapsed = time.time() - t0
+        logging.info("%s extract: %.2f sec, %.0f sentences/sec, %d triples" % (
+            name,
+            elapsed,
+            len(lf_lines) / elapsed,
+            triples,
+        ))
+
+
+def bench_fold(args):
+    lf_lines = read_lf_lines(args.input, args.repeat)
+    extractor = TripleExtractor(triple_patterns=ACTUAL_RELS)
+    matches = list(extractor.i_extract_triples(Sentence.from_lf_line(i, line) for i, line in enumerate(lf_lines)))
+    logging.info("FOLDING %d TRIPLES FROM %d SENTENCES" % (sum(map(len, matches)), len(lf_lines)))
+
+    def fold_packed():
+        counter = collections.Counter()
+        for triples in matches:
+            for triple in triples:
+                counter[triple.pack()] += 1
+        return counter
+
+    def fold_interned():
+        tfold = TripleFold()
+        for triples in matches:
+            tfold.add_triples(triples)
+        return tfold
+
+    for name, fold in (("packed strings", fold_packed), ("interned ids", fold_interned)):
+        gc.collect()
+        rss_before = extsort.current_rss()
+        t0 = time.time()
+        result = fold()
+        elapsed = time.time() - t0
+        gc.collect()
+        rss = extsort.current_rss() - rss_before
+        logging.info("%s: %.2f sec, %.1f usec/sentence, +%.1f MB RSS" % (
+            name,
+            elapsed,
+            elapsed * 1e6 / len(lf_lines),
+            rss / 1048576.0,
+        ))
+        del result
+
+
+def i_scaled_tuples(tuples_path, repeat):
+    # Synthetic scale-up: every copy of the tuples has its own terms.
+    from mokujin.index import TripleReader
+    with open(tuples_path, "rb") as tuples_file:
+        rows = list(TripleReader().iter_triples(tuples_file))
+    for k in xrange(repeat):
+        suffix = "~%d" % k if k > 0 else ""
+        for rel_type, arguments, freq in rows:
+            yield rel_type, [arg + suffix if isinstance(arg, str) else arg for arg in arguments], freq
+
+
+def bench_index(args):
+    from mokujin.index import DepTupleIndex
+    index_root = tempfile.mkdtemp()
+    try:
+        t0 = time.time()
+        DepTupleIndex.create(index_root, i_scaled_tuples(args.input, args.repeat), freq_threshold=0)
+        elapsed = time.time() - t0
+        logging.info("index: %.2f sec, peak RSS %.1f MB" % (elapsed, extsort.peak_rss() / 1048576.0))
+    finally:
+        shutil.rmtree(index_root)
+
+
+def bench_codec(args):
+    from mokujin import numencode
+    from mokujin.index import TripleReader
+    import lz4
+    # Posting lists of the tuples repeated `repeat` times, copies share terms.
+    with open(args.input, "rb") as tuples_file:
+        rows = list(TripleReader().iter_triples(tuples_file))
+    plists = collections.defaultdict(lambda: (array.array("l"), array.array("B")))
+    for k in xrange(args.repeat):
+        for tuple_no, (_, arguments, _) in enumerate(rows):
+            for arg_idx, arg in enumerate(arguments):
+                if isinstance(arg, str):
+                    plists[arg][0].append(k * len(rows) + tuple_no)
+                    plists[arg][1].append(arg_idx)
+    plists = plists.values()
+    postings = sum(len(tid_arr) for tid_arr, _ in plists)
+    # Throughput is measured in MB of decoded postings (8-byte tuple id and 1-byte position).
+    mbytes = postings * 9 / 1048576.0
+    logging.info("ENCODING %d POSTING LISTS, %d POSTINGS" % (len(plists), postings))
+    codecs = (
+        ("v1", lambda tid_arr, pos_arr: numencode.encode_plist_v1(array.array("l", tid_arr), pos_arr)),
+        ("v2", numencode.encode_plist_arrays),
+    )
+    sizes = {}
+    for name, encode in codecs:
+        gc.collect()
+        t0 = time.time()
+        encoded = [encode(tid_arr, pos_arr) for tid_arr, pos_arr in plists]
+        sizes[name] = map(len, encoded)
+        encode_elapsed = time.time() - t0
+        gc.collect()
+        t0 = time.time()
+        for plist_data in encoded:
+            numencode.decode_plist_arrays(plist_data)
+        decode_elapsed = time.time() - t0
+        size = sum(map(len, encoded))
+        lz4_size = sum(len(lz4.compressHC(plist_data)) for plist_data in encoded)
+        logging.info("%s: encode %.1f MB/s, decode %.1f MB/s, %.2f bytes/posting (%.2f with lz4)" % (
+            name,
+            mbytes / encode_elapsed,
+            mbytes / decode_elapsed,
+            float(size) / postings,
+            float(lz4_size) / postings,
+        ))
+    larger = sum(1 for v1_size, v2_size in zip(sizes["v1"], sizes["v2"]) if v2_size > v1_size)
+    if larger:
+        logging.error("V2 IS LARGER THAN V1 FOR %d POSTING LISTS" % larger)
+
+
+def bench_terms(args):
+    from mokujin.index import DepTupleIndex
+    from mokujin.termdict import TermDict, write_term_dict
+    term2id = {}
+    for _, arguments, _ in i_scaled_tuples(args.input, args.repeat):
+        for arg in arguments:
+            if isinstance(arg, str) and arg not in term2id:
+                term2id[arg] = len(term2id)
+    # Rows of term.ldb, as they are iterated by DepTupleIndex.load_terms.
+    term_rows = sorted((str(term_id), term) for term, term_id in term2id.iteritems())
+    terms = term2id.keys()
+    del term2id
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        dict_path = "%s/term.dict" % tmp_dir
+        write_term_dict(dict((term, int(term_id)) for term_id, term in term_rows), dict_path)
+        logging.info("%d TERMS, DICTIONARY FILE %.1f MB" % (len(terms), os.path.getsize(dict_path) / 1048576.0))
+
+        def load_dicts():
+            id2term, term2id = {}, {}
+            DepTupleIndex.load_terms(term_rows, id2term, term2id)
+            return term2id, id2term
+
+        def open_term_dict():
+            term_dict = TermDict(dict_path)
+            return term_dict.term_id_map, term_dict.id_term_map
+
+        rnd = random.Random(1)
+        sample = [rnd.choice(terms) for _ in xrange(100000)]
+        for name, load in (("dicts", load_dicts), ("mmap", open_term_dict)):
+            gc.collect()
+            rss_before = extsort.current_rss()
+            t0 = time.time()
+            term_id_map, id_term_map = load()
+            load_elapsed = time.time() - t0
+            rss = extsort.current_rss() - rss_before
+            t0 = time.time()
+            sample_ids = [term_id_map[term] for term in sample]
+            term_elapsed = time.time() - t0
+            t0 = time.time()
+            for term_id in sample_ids:
+                id_term_map[term_id]
+            id_elapsed = time.time() - t0
+            logging.info("%s: load %.3f sec, +%.1f MB RSS, term->id %.1f usec, id->term %.1f usec" % (
+                name,
+                load_elapsed,
+                rss / 1048576.0,
+                term_elapsed * 1e6 / len(sample),
+                id_elapsed * 1e6 / len(sample),
+            ))
+            del term_id_map, id_term_map
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def bench_tuples(args):
+    import marshal
+    from mokujin.index import DepTupleIndex
+    from mokujin.tuplestore import TupleStore, write_tuple_store
+    term2id = {}
+    rel_stamps = collections.defaultdict(list)
+    for d_tuple in i_scaled_tuples(args.input, args.repeat):
+        for arg in d_tuple[1]:
+            if isinstance(arg, str) and arg not in term2id:
+                term2id[arg] = len(term2id)
+        stamp = DepTupleIndex.tuple2stamp(d_tuple, term2id)
+        rel_stamps[stamp[0]].append(stamp)
+    del term2id
+    stamps = []
+    rel_ranges = {}
+    for rel_id, rel_stamp_list in sorted(rel_stamps.iteritems()):
+        rel_ranges[rel_id] = (len(stamps), len(stamps) + len(rel_stamp_list))
+        stamps.extend(rel_stamp_list)
+    del rel_stamps
+    # Rows of tuple.ldb, as they are iterated by DepTupleIndex.load_tuples.
+    tuple_rows = sorted((str(tuple_id), marshal.dumps(stamp)) for tuple_id, stamp in enumerate(stamps))
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        store_path = "%s/tuple.cols" % tmp_dir
+        write_tuple_store(store_path, stamps, len(stamps), rel_ranges)
+        logging.info("%d TUPLES, STORE FILE %.1f MB" % (len(stamps), os.path.getsize(store_path) / 1048576.0))
+
+        def load_dict():
+            id2tuple = {}
+            DepTupleIndex.load_tuples(tuple_rows, id2tuple)
+            return id2tuple
+
+        rnd = random.Random(1)
+        sample = [rnd.randrange(len(stamps)) for _ in xrange(100000)]
+        for name, load in (("dict", load_dict), ("mmap", lambda: TupleStore(store_path))):
+            gc.collect()
+            rss_before = extsort.current_rss()
+            t0 = time.time()
+            tuple_map = load()
+            load_elapsed = time.time() - t0
+            rss = extsort.current_rss() - rss_before
+            t0 = time.time()
+            for tuple_id in sample:
+                tuple_map[tuple_id]
+            elapsed = time.time() - t0
+            if [tuple_map[tuple_id] for tuple_id in sample[:1000]] != [stamps[tuple_id] for tuple_id in sample[:1000]]:
+                logging.error("%s: STAMPS DIFFER" % name)
+            logging.info("%s: load %.3f sec, +%.1f MB RSS, id->tuple %.1f usec" % (
+                name,
+                load_elapsed,
+                rss / 1048576.0,
+                elapsed * 1e6 / len(sample),
+            ))
+            del tuple_map
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+# Opens the index given on the command line in a new process, prints time spent in the open.
+OPEN_INDEX_SCRIPT = """
+import sys, time
+from mokujin.index import DepTupleIndex
+t0 = time.time()
+index = %s(sys.argv[1])
+sys.stdout.write("%%f" %% (time.time() - t0))
+"""
+
+
+def bench_snapshot(args):
+    from mokujin.index import DepTupleIndex, TripleSearchEngine
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        index_root = os.path.join(tmp_dir, "index")
+        snapshot_path = os.path.join(tmp_dir, "index.snapshot")
+        os.mkdir(index_root)
+        DepTupleIndex.create(index_root, i_scaled_tuples(args.input, args.repeat), freq_threshold=0, tmp_dir=tmp_dir)
+        DepTupleIndex(index_root).export_snapshot(snapshot_path, tmp_dir=tmp_dir)
+        logging.info("SNAPSHOT FILE %.1f MB" % (os.path.getsize(snapshot_path) / 1048576.0))
+        openers = (
+            ("leveldb", "DepTupleIndex", DepTupleIndex, index_root),
+            ("snapshot", "DepTupleIndex.open_snapshot", DepTupleIndex.open_snapshot, snapshot_path),
+        )
+        outputs = []
+        for name, opener_name, open_index, path in openers:
+            # Cold open is timed in a new process, pages of the files can still be in the OS cache.
+            cold_elapsed = float(subprocess.check_output([sys.executable, "-c", OPEN_INDEX_SCRIPT % opener_name,
+                                                          path]))
+            warm_elapsed = []
+            for _ in xrange(5):
+                gc.collect()
+                t0 = time.time()
+                index = open_index(path)
+                warm_elapsed.append(time.time() - t0)
+                del index
+            index = open_index(path)
+            engine = TripleSearchEngine(index)
+            outputs.append([engine.search(arg_query=(term_id, )) for term_id in xrange(min(1000, len(index.id2term)))])
+            del engine, index
+            logging.info("%s: cold open %.3f sec, warm open %.3f sec" % (name, cold_elapsed, min(warm_elapsed)))
+        if outputs[0] != outputs[1]:
+            logging.error("SEARCH RESULTS DIFFER")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def bench_corpus(args):
+    lf_text = open(args.input, "rb").read()
+    with tempfile.NamedTemporaryFile() as lf_file, tempfile.NamedTemporaryFile() as bin_file:
+        for _ in xrange(args.repeat):
+            lf_file.write(lf_text)
+        lf_file.flush()
+        BinaryLF_Writer.convert(MetaphorAdpLF_Reader(open(lf_file.name, "rb")).i_sentences(),
+                                open(bin_file.name, "wb"))
+        readers = (
+            ("text", MetaphorAdpLF_Reader(open(lf_file.name, "rb"))),
+            ("text-lazy", MetaphorAdpLF_Reader(open(lf_file.name, "rb"), lazy=True)),
+            ("binary", BinaryLF_Reader(open(bin_file.name, "rb"))),
+        )
+        for name, reader in readers:
+            t0 = time.time()
+            sentences = 0
+            for _ in reader.i_sentences():
+                sentences += 1
+            elapsed = time.time() - t0
+            logging.info("%s: %.2f sec, %.0f sentences/sec" % (name, elapsed, sentences / elapsed))
+
+
+BENCHMARKS = {
+    "parse": bench_parse,
+    "memory": bench_memory,
+    "extract": bench_extract,
+    "corpus": bench_corpus,
+    "fold": bench_fold,
+    "index": bench_index,
+    "codec": bench_codec,
+    "terms": bench_terms,
+    "tuples": bench_tuples,
+    "snapshot": bench_snapshot,
+}
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS.keys()), help="Benchmark to run")
+    parser.add_argument("-i", "--input", default="testdata/sample.lf", type=str, help="Benchmark input file")
+    parser.add_argument("-r", "--repeat", default=1000, type=int, help="How many times input should be repeated")
+    args = parser.parse_args()
+
+    BENCHMARKS[args.benchmark](args)
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Copyright (C) USC Information Sciences Institute
+# Author: Vladimir M. Zaytsev <zaytsev@usc.edu>
+# URL: <http://nlg.isi.edu/>
+# For more information, see README.md
+# For license information, see LICENSE
+
+"""
+Converts Metaphor-ADP LF file into binary pre-parsed LF corpus which can be given to
+findtriples.py, createlfindex.py and findmetaphors.py instead of the text file.
+
+Usage:
+    $ python createlfbinary.py -i sentences.lf.txt -o sentences.lf.bin
+"""
+
+import sys
+import logging
+import argparse
+
+from mokujin.lfcorpus import BinaryLF_Writer
+from mokujin.logicalform import MetaphorAdpLF_Reader
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", default=None, type=str, help="Source LF file")
+    parser.add_argument("-o", "--output", default=None, type=str, help="Binary LF corpus file. Default is "
+                                                                       "<input>.bin")
+    args = parser.parse_args()
+
+    i_file = sys.stdin if args.input is None else open(args.input, "rb")
+    if args.output is not None:
+        o_file = open(args.output, "wb")
+    elif args.input is not None:
+        o_file = open("%s.bin" % args.input, "wb")
+    else:
+        logging.error("Output file should be specified when reading from stdin (-o/--output).")
+        exit(1)
+
+    logging.info("INPUT FILE: %r" % i_file)
+    logging.info("OUTPUT FILE: %r" % o_file)
+
+    reader = MetaphorAdpLF_Reader(i_file, lazy=True)
+    BinaryLF_Writer.convert(reader.i_sentences(), o_file)
+    i_file.close()
+
+    logging.info("DONE")
@@ -14,7 +14,8 @@ import cPickle as pickle
 
 from mokujin.logicalform import POS
 from mokujin.index import SimpleObjectIndex
-from mokujin.logicalform import MetaphorAdpLF_Reader
+from mokujin.lfcorpus import lf_reader
+from mokujin.streams import open_input
 
 
 def sent_to_terms(sent):
@@ -45,8 +46,8 @@ if __name__ == "__main__":
     index.load_all()
     
     for fl in i_files:
-        i_file = open(fl, "r")
-        reader = MetaphorAdpLF_Reader(i_file)
+        i_file = open_input(fl)
+        reader = lf_reader(i_file, lazy=True)
         i_sents = reader.i_sentences()
         index.update_index(i_sents)
 
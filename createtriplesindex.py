@@ -8,12 +8,12 @@
 # For license information, see LICENSE
 
 
-import sys
 import logging
 import argparse
 
 from mokujin.index import TripleReader
 from mokujin.index import DepTupleIndex
+from mokujin.streams import open_input
 
 
 if __name__ == "__main__":
@@ -25,19 +25,43 @@ if __name__ == "__main__":
                                                                       "findtriples.py script")
     parser.add_argument("-o", "--out_dir", default="triple-store-index", type=str, help="Triple index directory")
     parser.add_argument("-mf", "--min_freq", default=5, type=int, help="Triple minimum frequency to be stored in index")
+    parser.add_argument("-m", "--memory_mb", default=512, type=int, help="Memory budget for the posting lists cache, "
+                                                                         "the rest is sorted on disk")
+    parser.add_argument("--tmp_dir", default=None, type=str, help="Directory for the sorted posting list runs")
+    parser.add_argument("-j", "--jobs", default=1, type=int, help="Number of processes building posting lists")
+    parser.add_argument("-s", "--snapshot", default=None, type=str, help="Also export the index to this single "
+                                                                         "snapshot file, which findsources.py can "
+                                                                         "open instead of the index directory")
+    parser.add_argument("-e", "--export_only", action="store_true", help="Do not build the index, only export the "
+                                                                         "existing one to the snapshot")
     args = parser.parse_args()
 
-    i_file = sys.stdout if args.input is None else open(args.input, "rb")
+    if args.export_only and args.snapshot is None:
+        parser.error("--export_only needs the snapshot file (-s)")
+
     o_dir = args.out_dir
 
-    logging.info("INPUT FILE: %r" % i_file)
-    logging.info("OUT DIR: %r" % o_dir)
-    logging.info("MIN FREQ: %d" % args.min_freq)
+    if not args.export_only:
+
+        i_file = open_input(args.input)
+
+        logging.info("INPUT FILE: %r" % i_file)
+        logging.info("OUT DIR: %r" % o_dir)
+        logging.info("MIN FREQ: %d" % args.min_freq)
+
+        reader = TripleReader()
 
-    reader = TripleReader()
 
+        i_triples = reader.iter_triples(i_file)
+        DepTupleIndex.create(index_root=o_dir,
+                             tuples=i_triples,
+                             freq_threshold=args.min_freq,
+                             memory_mb=args.memory_mb,
+                             tmp_dir=args.tmp_dir,
+                             n_jobs=args.jobs)
 
-    i_triples = reader.iter_triples(i_file)
-    DepTupleIndex.create(index_root=o_dir, tuples=i_triples, freq_threshold=args.min_freq)
+    if args.snapshot is not None:
+        logging.info("SNAPSHOT FILE: %r" % args.snapshot)
+        DepTupleIndex(o_dir).export_snapshot(args.snapshot, tmp_dir=args.tmp_dir)
 
     logging.info("DONE")
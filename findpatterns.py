@@ -7,6 +7,7 @@
 # For more information, see README.md
 # For license information, see LICENSE
 
+import os
 import logging
 import argparse
 
@@ -34,7 +35,8 @@ if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("-i", "--index", default="data/index", help="Triple store index directory", type=str)
+    parser.add_argument("-i", "--index", default="data/index", help="Triple store index directory or snapshot file",
+                        type=str)
     parser.add_argument("-o", "--outputdir", default="output",
                         help="Directory where script's ouput will be placed",  type=str)
     parser.add_argument("-q", "--queryterm", default=None, help="Query term", type=str)
@@ -70,7 +72,10 @@ if __name__ == "__main__":
     logging.info("OUTPUT FORMAT: %s" % args.format)
 
     logging.info("LOADING INDEX")
-    indexer = DepTupleIndex(args.index)
+    if os.path.isfile(args.index):
+        indexer = DepTupleIndex.open_snapshot(args.index)
+    else:
+        indexer = DepTupleIndex(args.index)
     engine = TripleSearchEngine(indexer)
 
     if args.stoplist:
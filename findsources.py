@@ -7,6 +7,8 @@
 # For more information, see README.md
 # For license information, see LICENSE
 
+import os
+import time
 import logging
 import argparse
 import cPickle as pickle
@@ -35,7 +37,8 @@ if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("-i", "--index", default="data/index", help="Triple store index directory", type=str)
+    parser.add_argument("-i", "--index", default="data/index", help="Triple store index directory or snapshot file",
+                        type=str)
     parser.add_argument("-o", "--outputdir", default="output",
                         help="Directory where potential source words will be placed",  type=str)
     parser.add_argument("-q", "--queryfile", default="resources/example.json", help="Search query file. See "
@@ -97,8 +100,13 @@ if __name__ == "__main__":
 
     query = DomainSearchQuery.fromstring(open(args.queryfile).read())
     logging.info("LOADING INDEX")
-    indexer = DepTupleIndex(args.index)
+    t0 = time.time()
+    if os.path.isfile(args.index):
+        indexer = DepTupleIndex.open_snapshot(args.index)
+    else:
+        indexer = DepTupleIndex(args.index)
     engine = TripleSearchEngine(indexer)
+    logging.info("INDEX LOADED IN %.2f SEC" % (time.time() - t0))
 
     explorer = TripleStoreExplorer(engine, stop_terms=stop_list, concept_net=concept_net)
 
@@ -7,40 +7,292 @@
 # For more information, see README.md
 # For license information, see LICENSE
 
+import os
 import sys
+import json
+import time
+import logging
+import argparse
+import resource
+import itertools
+import multiprocessing
 
+from fnmatch import fnmatch
+
+from mokujin import extsort
+from mokujin.journal import BatchJournal
+from mokujin.logicalform import lf_byte_ranges
 from mokujin.logicalform import MetaphorAdpLF_Reader
-from mokujin.triples import TripleExtractor, TripleFold, Triple
+from mokujin.lfcorpus import lf_reader, is_binary_lf
+from mokujin.lfcorpus import BinaryLF_Reader
+from mokujin.streams import open_input, input_codec
+from mokujin.triples import TripleExtractor, TripleFold, ApproximateTripleFold, ExtractorStats, Triple
 from mokujin.triples import ACTUAL_RELS as RELS
 
 
-if __name__ == "__main__":
+def make_fold(fold_options):
+    if fold_options.get("approx") is not None:
+        return ApproximateTripleFold(capacity=fold_options["approx"], sketch_width=fold_options["sketch_width"])
+    return TripleFold(max_entries=fold_options["max_entries"],
+                      max_rss=fold_options["max_rss"],
+                      tmp_dir=fold_options["tmp_dir"])
+
+
+def fold_sentences(i_sents, fold_options):
+    stats = ExtractorStats(log_interval=fold_options["log_interval"])
+    ex = TripleExtractor(triple_patterns=RELS, fused=fold_options["fused"], stats=stats)
+    tfold = make_fold(fold_options)
+    for triples in ex.i_extract_triples(i_sents):
+        tfold.add_triples(triples)
+    return tfold, stats
+
+
+def fold_shard(shard):
+    lf_path, start, end, fold_options = shard
+    with open(lf_path, "rb") as ifile:
+        if is_binary_lf(ifile):
+            i_sents = BinaryLF_Reader(ifile).i_sentences(start, end)
+        else:
+            i_sents = MetaphorAdpLF_Reader(ifile, start, end, lazy=True).i_sentences()
+        # Spilled runs (if any) are passed to the parent process together with the counter.
+        return fold_sentences(i_sents, fold_options)
+
 
-    if len(sys.argv) > 1:
-        ifile = open(sys.argv[1], "r")
-        if len(sys.argv) > 2:
-            ofile = open(sys.argv[2], "w")
+def i_input_files(input_path, pattern):
+    if not os.path.isdir(input_path):
+        yield input_path
+        return
+    for dir_name, dir_names, file_names in os.walk(input_path):
+        dir_names.sort()
+        for file_name in sorted(file_names):
+            if fnmatch(file_name, pattern):
+                yield os.path.join(dir_name, file_name)
+
+
+def batch_segments(lf_paths, checkpoint_bytes, fold_options):
+    """
+    Splits input files into segments of about `checkpoint_bytes` each, a compressed file is one
+    segment (start and end are None) since it can not be read from an offset.
+    """
+    segments = []
+    for lf_path in lf_paths:
+        if input_codec(lf_path) is not None:
+            segments.append((lf_path, None, None, fold_options))
         else:
-            ofile = open("%s.triples.csv" % sys.argv[1], "w")
+            n_segments = max(1, (os.path.getsize(lf_path) + checkpoint_bytes - 1) / checkpoint_bytes)
+            segments.extend(shard_file(lf_path, n_segments, fold_options))
+    return segments
+
+
+def fold_segment(segment):
+    lf_path, start, end, fold_options = segment
+    if start is None:
+        with open_input(lf_path) as ifile:
+            tfold, stats = fold_sentences(lf_reader(ifile, lazy=True).i_sentences(), fold_options)
+    else:
+        tfold, stats = fold_shard(segment)
+    # Counts are persisted as sorted runs in the batch work directory (fold tmp_dir).
+    tfold.spill()
+    return segment, tfold.runs, stats
+
+
+def i_folded_triples(tfold, approx, min_freq, remove_runs=True):
+    """
+    Yields (triple, error) pairs, triples are [relation, arg1, ..., arg5, freq] lists sorted by
+    frequency (descending) with freq >= min_freq, error is 0 for exact counts.
+    """
+    if approx:
+        for p_triple, freq, error in tfold.i_estimates(min_freq):
+            yield Triple.unpack(p_triple) + [freq], error
+    else:
+        for triple in tfold.i_triples(remove_runs):
+            if triple[-1] < min_freq:
+                break
+            yield triple, 0
+
+
+def i_output_triples(i_triples, ofile, bfile):
+    """
+    Writes rows of the triples to the CSV (and bounds) file, if any, and yields the triples. All of
+    them are given to DepTupleIndex.create, which drops the rare ones, so that terms get the same
+    IDs as in the index of the CSV built by createtriplesindex.py.
+    """
+    for triple, error in i_triples:
+        if ofile is not None:
+            row = Triple.to_row(triple).encode("utf-8")
+            ofile.write(row)
+            ofile.write("\n")
+            if bfile is not None:
+                bfile.write(row)
+                bfile.write(", %d\n" % error)
+        yield triple
+
+
+def shard_file(lf_path, n_jobs, fold_options):
+    with open(lf_path, "rb") as ifile:
+        if is_binary_lf(ifile):
+            n_sentences = len(BinaryLF_Reader(ifile))
+            bounds = [n_sentences * k / n_jobs for k in xrange(n_jobs + 1)]
+            ranges = zip(bounds[:-1], bounds[1:])
+        else:
+            ranges = lf_byte_ranges(ifile, n_jobs)
+    return [(lf_path, start, end, fold_options) for start, end in ranges]
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", nargs="?", default=None, type=str, help="Input LF file (stdin if omitted), with "
+                                                                         "--batch also a directory of LF files")
+    parser.add_argument("output", nargs="?", default=None, type=str, help="Output CSV file (with --index, CSV is "
+                                                                          "written only if given)")
+    parser.add_argument("-j", "--jobs", default=1, type=int, help="Number of worker processes")
+    parser.add_argument("--max_entries", default=None, type=int, help="Maximum number of distinct triples kept "
+                                                                      "in memory (per process), the rest is "
+                                                                      "spilled to disk")
+    parser.add_argument("--max_rss", default=None, type=int, help="Spill triples to disk when process RSS "
+                                                                  "exceeds this number of megabytes")
+    parser.add_argument("--tmp_dir", default=None, type=str, help="Directory for spilled triple runs")
+    parser.add_argument("--approx", default=None, type=int, help="Count triples approximately in a fixed-size "
+                                                                 "table of this many most frequent triples")
+    parser.add_argument("--sketch_width", default=None, type=int, help="Width of the Count-Min sketch used with "
+                                                                       "--approx (default: --approx value)")
+    parser.add_argument("-mf", "--min_freq", default=1, type=int, help="Triple minimum frequency to be written "
+                                                                       "(and given to the index)")
+    parser.add_argument("--bounds", default=None, type=str, help="With --approx, file for the count error "
+                                                                 "bounds (default: <output>.bounds)")
+    parser.add_argument("--stats", default=None, type=str, help="File for the JSON extraction report (not "
+                                                                "written by default)")
+    parser.add_argument("--stats_unfused", action="store_true", help="Match relations one by one (slower), so "
+                                                                     "that the --stats report has time of every "
+                                                                     "relation class, not of the fused passes")
+    parser.add_argument("--index", default=None, type=str, help="Triple index directory: folded triples are "
+                                                                "indexed directly, as by createtriplesindex.py")
+    parser.add_argument("--index_min_freq", default=5, type=int, help="Triple minimum frequency to be stored in "
+                                                                      "index")
+    parser.add_argument("--batch", default=None, type=str, help="Work directory of a resumable batch job: counts "
+                                                                "of finished input segments are kept there and "
+                                                                "a restarted job skips them")
+    parser.add_argument("--pattern", default="*", type=str, help="With --batch, names of LF files to read from "
+                                                                 "the input directory")
+    parser.add_argument("--checkpoint_mb", default=256, type=int, help="With --batch, size of the input segments "
+                                                                       "in megabytes")
+    parser.add_argument("--log_interval", default=60.0, type=float, help="Seconds between extraction progress "
+                                                                         "log lines (0 to disable)")
+    args = parser.parse_args()
+
+    if args.batch is not None and (args.input is None or args.approx is not None):
+        parser.error("--batch requires input file or directory and exact counting (no --approx)")
+
+    fold_options = {
+        "max_entries": args.max_entries,
+        "max_rss": args.max_rss * 1024 * 1024 if args.max_rss is not None else None,
+        "tmp_dir": args.tmp_dir,
+        "approx": args.approx,
+        "sketch_width": args.sketch_width or args.approx,
+        "log_interval": args.log_interval,
+        "fused": not args.stats_unfused,
+    }
+
+    if args.index is not None and args.output is None:
+        ofile = None
+    elif args.input is not None:
+        ofile = open(args.output or "%s.triples.csv" % args.input.rstrip(os.sep), "w")
     else:
-        ifile = sys.stdin
         ofile = sys.stdout
+    bfile = None
+    if args.approx is not None and ofile is not None:
+        if args.bounds is not None or ofile is not sys.stdout:
+            bfile = open(args.bounds or "%s.bounds" % ofile.name, "w")
+        else:
+            logging.warning("No --bounds file given, error bounds will not be written")
 
-    reader = MetaphorAdpLF_Reader(ifile)
-    i_sents = reader.i_sentences()
+    t0 = time.time()
+    journal = None
 
-    ex = TripleExtractor(triple_patterns=RELS)
-    i_triple_sets = ex.i_extract_triples(i_sents)
-    tfold = TripleFold()
+    if args.batch is not None:
+        journal = BatchJournal(args.batch, {
+            "input": os.path.abspath(args.input),
+            "pattern": args.pattern,
+            "checkpoint_mb": args.checkpoint_mb,
+        })
+        batch_options = dict(fold_options, tmp_dir=args.batch)
+        segments = batch_segments(i_input_files(args.input, args.pattern), args.checkpoint_mb * 1024 * 1024,
+                                  batch_options)
+        todo = [segment for segment in segments if not journal.is_done(*segment[:3])]
+        logging.info("EXTRACTING TRIPLES FROM %d SEGMENTS (%d ALREADY DONE)" % (len(todo), len(segments) - len(todo)))
+        if args.jobs > 1:
+            pool = multiprocessing.Pool(args.jobs)
+            i_results = pool.imap_unordered(fold_segment, todo)
+        else:
+            pool = None
+            i_results = itertools.imap(fold_segment, todo)
+        stats = ExtractorStats()
+        for (lf_path, start, end, _), runs, segment_stats in i_results:
+            journal.add(lf_path, start, end, runs, sentences=segment_stats.sentences)
+            stats.merge(segment_stats)
+        if pool is not None:
+            pool.close()
+            pool.join()
+        # Runs are merged in the work directory, which is on the same disk as the journaled runs, runs
+        # left there by a job killed while merging are removed on restart.
+        tfold = make_fold(batch_options)
+        tfold.runs.extend(journal.run_paths())
+    elif args.jobs > 1 and args.input is not None and input_codec(args.input) is None:
+        shards = shard_file(args.input, args.jobs, fold_options)
+        logging.info("EXTRACTING TRIPLES FROM %d SHARDS" % len(shards))
+        pool = multiprocessing.Pool(args.jobs)
+        tfold = make_fold(fold_options)
+        stats = ExtractorStats()
+        for shard_fold, shard_stats in pool.imap_unordered(fold_shard, shards):
+            tfold.merge(shard_fold)
+            stats.merge(shard_stats)
+        pool.close()
+        pool.join()
+    else:
+        if args.jobs > 1:
+            logging.warning("--jobs requires uncompressed input file, reading input serially")
+        ifile = open_input(args.input)
+        tfold, stats = fold_sentences(lf_reader(ifile, lazy=True).i_sentences(), fold_options)
+        ifile.close()
+    # Wall time of the whole extraction, with --jobs the worker times are summed per relation.
+    stats.elapsed = time.time() - t0
+    logging.info(stats.log_line())
+    if args.stats is not None:
+        with open(args.stats, "w") as stats_file:
+            json.dump(stats.report(), stats_file, indent=2, sort_keys=True)
 
-    for triples in i_triple_sets:
-        tfold.add_triples(triples)
+    if args.approx is not None:
+        # Bounds file has one more column, the count error: true frequency is in [freq - error, freq].
+        logging.info("APPROXIMATE COUNTS FLOOR: %d" % tfold.floor)
+    # Journaled runs are kept until the output is complete, so that a failed job can be resumed.
+    i_triples = i_output_triples(i_folded_triples(tfold, args.approx is not None, args.min_freq, journal is None),
+                                 ofile,
+                                 bfile)
 
-    triples = tfold.i_triples()
+    if args.index is not None:
+        # Imported here, so that counting triples does not require index dependencies.
+        from mokujin.index import TripleReader, DepTupleIndex
+        logging.info("INDEX DIR: %r" % args.index)
+        DepTupleIndex.create(index_root=args.index,
+                             tuples=TripleReader().iter_fold_triples(i_triples),
+                             freq_threshold=args.index_min_freq,
+                             tmp_dir=args.tmp_dir,
+                             n_jobs=args.jobs)
+    else:
+        for _ in i_triples:
+            pass
 
-    for triple_tuple in triples:
-        ofile.write(Triple.to_row(triple_tuple).encode("utf-8"))
-        ofile.write("\n")
+    if bfile is not None:
+        bfile.close()
+    if ofile is not None:
+        ofile.close()
+    if journal is not None:
+        journal.remove()
 
-    ofile.close()
-    ifile.close()
+    logging.info("PEAK RSS: %.1f MB (WORKERS: %.1f MB)" % (
+        extsort.peak_rss() / 1048576.0,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0,
+    ))
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Copyright (C) USC Information Sciences Institute
+# Author: Vladimir M. Zaytsev <zaytsev@usc.edu>
+# URL: <http://nlg.isi.edu/>
+# For more information, see README.md
+# For license information, see LICENSE
+
+"""
+External sorting helpers: sorted runs are written to compressed temporary files and merged back
+with heapq.merge, so only one batch of items per run has to be kept in memory. At most MAX_FAN_IN
+runs are merged at once, more runs are first merged in groups into intermediate runs, so that the
+number of open files stays bounded.
+
+Run file is a sequence of blocks, each block is a header (4-byte data length and 4-byte key
+length), the marshal dump of the first field of the last item of the block and the zlib-compressed
+marshal dump of the list of items. Items should be marshal-able tuples (ints, strings, unicode
+strings). Readers which need only the items from some key on skip the blocks which end before it
+without decompressing them.
+"""
+
+from __future__ import absolute_import
+
+import os
+import zlib
+import heapq
+import struct
+import marshal
+import logging
+import resource
+import tempfile
+import itertools
+
+
+BLOCK_SIZE = 4096
+BLOCK_HEADER = struct.Struct("=II")
+COMPRESSION_LEVEL = 1
+MAX_FAN_IN = 256
+
+
+def current_rss():
+    """
+    Current resident set size of the process in bytes (peak RSS where /proc is not available).
+    """
+    try:
+        with open("/proc/self/statm", "rb") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        return peak_rss()
+
+
+def peak_rss():
+    """
+    Peak resident set size of the process in bytes.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def write_run(sorted_items, tmp_dir=None, prefix="mokujin-run-"):
+    """
+    Writes already sorted items into new temporary run file and returns its path.
+    """
+    fd, run_path = tempfile.mkstemp(prefix=prefix, suffix=".run", dir=tmp_dir)
+    try:
+        with os.fdopen(fd, "wb") as run_file:
+            block = []
+            for item in sorted_items:
+                block.append(item)
+                if len(block) >= BLOCK_SIZE:
+                    write_block(run_file, block)
+                    block = []
+            if block:
+                write_block(run_file, block)
+    except:
+        remove_runs([run_path])
+        raise
+    return run_path
+
+
+def write_block(run_file, block):
+    data = zlib.compress(marshal.dumps(block), COMPRESSION_LEVEL)
+    last_key = marshal.dumps(block[-1][0])
+    run_file.write(BLOCK_HEADER.pack(len(data), len(last_key)))
+    run_file.write(last_key)
+    run_file.write(data)
+
+
+def i_read_run(run_path, first_key=None):
+    """
+    Yields items of the run. If `first_key` is given, blocks whose items all have the first field
+    less than `first_key` are skipped, items of the first block which is read are not filtered.
+    """
+    with open(run_path, "rb") as run_file:
+        while True:
+            header = run_file.read(BLOCK_HEADER.size)
+            if not header:
+                return
+            size, key_size = BLOCK_HEADER.unpack(header)
+            if first_key is not None:
+                if marshal.loads(run_file.read(key_size)) < first_key:
+                    run_file.seek(size, os.SEEK_CUR)
+                    continue
+                first_key = None
+            else:
+                run_file.seek(key_size, os.SEEK_CUR)
+            for item in marshal.loads(zlib.decompress(run_file.read(size))):
+                yield item
+
+
+def i_merge_runs(run_paths, tmp_dir=None, max_fan_in=None, first_key=None):
+    """
+    K-way merge of sorted run files. If there are more than `max_fan_in` (default MAX_FAN_IN) runs,
+    groups of them are merged into intermediate runs in `tmp_dir` (as many passes as needed) until
+    at most `max_fan_in` runs are left. Intermediate runs are removed when the iteration finishes,
+    given runs are not. Blocks which end before `first_key` are skipped (see i_read_run).
+    """
+    merged_paths = set()
+    try:
+        run_paths = reduce_runs(run_paths, tmp_dir, max_fan_in, merged_paths)
+        for item in heapq.merge(*[i_read_run(run_path, first_key) for run_path in run_paths]):
+            yield item
+    finally:
+        remove_runs(merged_paths)
+
+
+def reduce_runs(run_paths, tmp_dir=None, max_fan_in=None, merged_paths=None):
+    """
+    Merges groups of the runs into intermediate runs in `tmp_dir` until at most `max_fan_in`
+    (default MAX_FAN_IN) runs are left and returns them. Paths of the intermediate runs which are
+    left are added to the `merged_paths` set, the caller should remove them; given runs are kept.
+    """
+    max_fan_in = max_fan_in or MAX_FAN_IN
+    merged_paths = merged_paths if merged_paths is not None else set()
+    run_paths = list(run_paths)
+    while len(run_paths) > max_fan_in:
+        logging.info("MERGING %d SORTED RUNS IN GROUPS OF %d" % (len(run_paths), max_fan_in))
+        group_paths = []
+        for start in xrange(0, len(run_paths), max_fan_in):
+            group = run_paths[start:(start + max_fan_in)]
+            if len(group) == 1:
+                group_paths.append(group[0])
+                continue
+            group_path = write_run(heapq.merge(*[i_read_run(run_path) for run_path in group]), tmp_dir,
+                                   prefix="mokujin-merge-")
+            merged_paths.add(group_path)
+            group_paths.append(group_path)
+            remove_runs([run_path for run_path in group if run_path in merged_paths])
+            merged_paths.difference_update(group)
+        run_paths = group_paths
+    return run_paths
+
+
+def i_sum_sorted(sorted_pairs):
+    """
+    Sums values of adjacent (key, value) pairs with equal keys, e.g. of merged runs of counters.
+    """
+    current_key = None
+    current_value = None
+    for key, value in sorted_pairs:
+        if key == current_key and current_value is not None:
+            current_value += value
+        else:
+            if current_value is not None:
+                yield current_key, current_value
+            current_key = key
+            current_value = value
+    if current_value is not None:
+        yield current_key, current_value
+
+
+def remove_runs(run_paths):
+    for run_path in run_paths:
+        try:
+            os.remove(run_path)
+        except OSError:
+            logging.warning("Can not remove run file %s" % run_path)
+
+
+def write_sorted_runs(items, max_items, tmp_dir=None):
+    """
+    Writes items as sorted runs of at most `max_items` items each and returns the run paths, so that
+    the runs can be merged later (possibly by another process). Runs are removed if writing fails.
+    """
+    run_paths = []
+    batch = []
+    try:
+        for item in items:
+            batch.append(item)
+            if len(batch) >= max_items:
+                batch.sort()
+                run_paths.append(write_run(batch, tmp_dir))
+                batch = []
+        if batch:
+            batch.sort()
+            run_paths.append(write_run(batch, tmp_dir))
+    except:
+        remove_runs(run_paths)
+        raise
+    return run_paths
+
+
+def i_external_sort(items, max_items, tmp_dir=None):
+    """
+    Sorts items keeping at most `max_items` of them in memory. Items are yielded in ascending order,
+    run files (see write_sorted_runs) are removed when the iteration finishes. If all items fit in
+    memory, nothing is written.
+    """
+    items = iter(items)
+    batch = sorted(itertools.islice(items, max_items))
+    if len(batch) < max_items:
+        for item in batch:
+            yield item
+        return
+    run_paths = []
+    try:
+        run_paths.append(write_run(batch, tmp_dir))
+        del batch
+        run_paths.extend(write_sorted_runs(items, max_items, tmp_dir))
+        logging.info("MERGING %d SORTED RUNS" % len(run_paths))
+        for item in i_merge_runs(run_paths, tmp_dir):
+            yield item
+    finally:
+        remove_runs(run_paths)
@@ -7,17 +7,27 @@
 # For more information, see README.md
 # For license information, see LICENSE
 
-import gc
 import os
 import lz4
-import plyvel
+import time
+import array
+import heapq
+import shutil
 import logging
+import tempfile
+import itertools
+import collections
+import multiprocessing
 import StringIO
 import marshal as pickle
 import mokujin.triples as mtr
 
+from mokujin import extsort
 from mokujin import numencode
 from mokujin.logicalform import POS
+from mokujin.termdict import TermDict, write_term_dict
+from mokujin.tuplestore import TupleStore, write_tuple_store
+from mokujin.snapshot import Snapshot, PostingTable, write_snapshot, write_posting_table
 from mokujin.triples import ACTUAL_RELS
 
 
@@ -63,20 +73,32 @@ class ArgType(object):
 
 class TripleReader(object):
 
-    def parse_triple_row(self, ts_row):
-        arguments = []
-        for i in range(1, (len(ts_row) - 1)):
-            argument = ts_row[i]
-            if argument == ArgType.STR_NONE:
-                arguments.append(ArgType.NONE)
-            elif argument == ArgType.STR_EMPTY:
-                arguments.append(ArgType.EMPTY)
+    def __init__(self):
+        self.arguments = {}
+
+    def parse_argument(self, argument):
+        parsed = self.arguments.get(argument)
+        if parsed is not None:
+            return parsed
+        if argument == ArgType.STR_NONE:
+            parsed = ArgType.NONE
+        elif argument == ArgType.STR_EMPTY:
+            parsed = ArgType.EMPTY
+        else:
+            if isinstance(argument, unicode):
+                lemma_pos = argument.encode("utf-8").split(ArgType.POS_DELIMITER)
             else:
                 lemma_pos = argument.split(ArgType.POS_DELIMITER)
-                if lemma_pos[-1] == ArgType.POS_NONE:
-                    arguments.append(ArgType.NONE)
-                else:
-                    arguments.append("-".join(lemma_pos[0:(len(lemma_pos) - 1)]))
+            if lemma_pos[-1] == ArgType.POS_NONE:
+                parsed = ArgType.NONE
+            else:
+                parsed = "-".join(lemma_pos[0:(len(lemma_pos) - 1)])
+        self.arguments[argument] = parsed
+        return parsed
+
+    def parse_triple_row(self, ts_row):
+        parse_argument = self.parse_argument
+        arguments = [parse_argument(ts_row[i]) for i in range(1, (len(ts_row) - 1))]
         return ts_row[0], arguments, int(ts_row[-1])
 
     def iter_triples(self, i_file):
@@ -85,6 +107,15 @@ class TripleReader(object):
             triple = self.parse_triple_row(row)
             yield triple
 
+    def iter_fold_triples(self, i_triples):
+        """
+        Converts [relation, arg1, ..., arg5, freq] lists yielded by TripleFold.i_triples() to the
+        tuples of iter_triples(), so that folded triples are indexed without writing and parsing CSV.
+        """
+        parse_argument = self.parse_argument
+        for triple in i_triples:
+            yield str(triple[0]), [parse_argument(arg) for arg in triple[1:-1]], triple[-1]
+
 
 class DepTupleIndex(object):
     """
@@ -96,15 +127,32 @@ class DepTupleIndex(object):
 
     TUPLE_INDEX_DB_BLOCK_SIZE = 64
     TERM_INDEX_DB_BLOCK_SIZE  = 256
-    PLIST_CACHE_SIZE          = 256000
+    TUPLE_BATCH_SIZE          = 100000
+    PLIST_BATCH_SIZE          = 10000
+    POSTING_MEMORY            = 12      # Estimated bytes per cached posting
+    PLIST_MEMORY              = 240     # and per cached posting list.
     STRING_ARRAY_SEP          = chr(244)
-
-    def __init__(self, index_root):
+    TERM_DICT_FILE            = "term.dict"
+    TUPLE_STORE_FILE          = "tuple.cols"
+    TERM_SECTION              = "terms"     # Sections of the snapshot file.
+    TUPLE_SECTION             = "tuples"
+    PLIST_SECTION             = "plists"
+    PLIST_LAYOUT_KEY          = "!layout"
+    POSITIONAL_LAYOUT         = "positional"
+    REL_ID_SHIFT              = 40      # Provisional tuple ID is (rel_id << REL_ID_SHIFT) | number in relation.
+
+    def __init__(self, index_root, snapshot=None):
+        """
+        Opens the index directory or, if snapshot is given, the index snapshot file (see
+        open_snapshot), index_root is then the path of the snapshot.
+        """
         self.index_root = index_root
+        self.snapshot   = snapshot
 
-        self.term_ldb   = DepTupleIndex.get_term_ldb(index_root, create=False)
-        self.plist_ldb  = DepTupleIndex.get_plist_ldb(index_root, create=False)
-        self.tuple_ldb  = DepTupleIndex.get_tuple_ldb(index_root, create=False)
+        if snapshot is not None:
+            self.plist_ldb = PostingTable(snapshot.data, snapshot.section_offset(DepTupleIndex.PLIST_SECTION))
+        else:
+            self.plist_ldb = DepTupleIndex.get_plist_ldb(index_root, create=False)
 
         self.term2id    = {}
         self.id2term    = {}
@@ -112,8 +160,137 @@ class DepTupleIndex(object):
         self.reltype2id = REL_ID_MAP
         self.id2reltype = ID_REL_MAP
 
-        DepTupleIndex.load_terms(self.term_ldb, self.id2term, self.term2id)
-        DepTupleIndex.load_tuples(self.tuple_ldb, self.id2tuple)
+        # Indexes created before the postings were split by argument position have one list per term.
+        self.positional = self.plist_ldb.get(DepTupleIndex.PLIST_LAYOUT_KEY) == DepTupleIndex.POSITIONAL_LAYOUT
+
+        term_dict_path = os.path.join(index_root, DepTupleIndex.TERM_DICT_FILE)
+        if snapshot is not None or os.path.exists(term_dict_path):
+            # Terms are looked up in the memory mapped dictionary, nothing is loaded.
+            self.term_ldb  = None
+            if snapshot is not None:
+                self.term_dict = TermDict(index_root, snapshot.data,
+                                          snapshot.section_offset(DepTupleIndex.TERM_SECTION))
+            else:
+                self.term_dict = TermDict(term_dict_path)
+            self.term2id   = self.term_dict.term_id_map
+            self.id2term   = self.term_dict.id_term_map
+        else:
+            self.term_ldb  = DepTupleIndex.get_term_ldb(index_root, create=False)
+            self.term_dict = None
+            DepTupleIndex.load_terms(self.term_ldb, self.id2term, self.term2id)
+
+        tuple_store_path = os.path.join(index_root, DepTupleIndex.TUPLE_STORE_FILE)
+        if snapshot is not None or os.path.exists(tuple_store_path):
+            # Tuples are read from the memory mapped columns, nothing is loaded.
+            self.tuple_ldb   = None
+            if snapshot is not None:
+                self.tuple_store = TupleStore(index_root, snapshot.data,
+                                              snapshot.section_offset(DepTupleIndex.TUPLE_SECTION))
+            else:
+                self.tuple_store = TupleStore(tuple_store_path)
+            self.id2tuple    = self.tuple_store
+            self.rel_ranges  = self.tuple_store.rel_ranges
+        else:
+            self.tuple_ldb   = DepTupleIndex.get_tuple_ldb(index_root, create=False)
+            self.tuple_store = None
+            # Older indexes do not keep tuples of a relation in a contiguous ID range.
+            self.rel_ranges  = None
+            DepTupleIndex.load_tuples(self.tuple_ldb, self.id2tuple)
+
+    @staticmethod
+    def open_snapshot(snapshot_path, verify=False):
+        """
+        Opens the index snapshot file written by export_snapshot. File is mapped read-only, so
+        processes which open the same snapshot share its pages. Checksums of the whole file are
+        checked only if verify is True.
+        """
+        snapshot = Snapshot(snapshot_path)
+        if verify:
+            snapshot.verify()
+        return DepTupleIndex(snapshot_path, snapshot=snapshot)
+
+    def export_snapshot(self, snapshot_path, tmp_dir=None):
+        """
+        Writes the term dictionary, the tuple store and the posting lists of the index to one
+        snapshot file (see mokujin.snapshot). Index should have the relation ranges of tuple IDs.
+        """
+        if self.rel_ranges is None:
+            raise ValueError("Index %s has no relation ranges of tuple IDs, it should be rebuilt to be "
+                             "exported." % self.index_root)
+        sections_dir = tempfile.mkdtemp(prefix="mokujin-snapshot-", dir=tmp_dir)
+        try:
+            term_dict_path = os.path.join(sections_dir, DepTupleIndex.TERM_SECTION)
+            write_term_dict(dict(self.term2id.iteritems()), term_dict_path)
+            tuple_store_path = os.path.join(sections_dir, DepTupleIndex.TUPLE_SECTION)
+            write_tuple_store(tuple_store_path,
+                              (self.id2tuple[tuple_id] for tuple_id in xrange(len(self.id2tuple))),
+                              len(self.id2tuple),
+                              self.rel_ranges)
+            plist_table_path = os.path.join(sections_dir, DepTupleIndex.PLIST_SECTION)
+            write_posting_table(plist_table_path, iter(self.plist_ldb), tmp_dir)
+            write_snapshot(snapshot_path, [(DepTupleIndex.TERM_SECTION, term_dict_path),
+                                           (DepTupleIndex.TUPLE_SECTION, tuple_store_path),
+                                           (DepTupleIndex.PLIST_SECTION, plist_table_path)])
+        finally:
+            shutil.rmtree(sections_dir)
+        logging.info("Wrote snapshot of %d terms and %d tuples to %s (%.1f MB)." % (
+            len(self.term2id),
+            len(self.id2tuple),
+            snapshot_path,
+            os.path.getsize(snapshot_path) / 1048576.0,
+        ))
+
+    def i_sub_postings(self, term_id, pos=-1, tid_range=None):
+        """
+        Yields (tid_arr, pos_arr) postings of the term for every argument position sub-list, only
+        of the given argument position unless pos is -1 and only of the tuple IDs in [start, end) if
+        tid_range is given. Positional lookup decodes only the sub-list of the position.
+        """
+        plist_blob = self.plist_ldb.get(DepTupleIndex.plist_key(term_id))
+        if plist_blob is None:
+            return
+        if not self.positional:
+            tid_arr, pos_arr = numencode.decode_plist_arrays(lz4.decompress(plist_blob))
+            if pos != -1 or tid_range is not None:
+                start_tid, end_tid = tid_range if tid_range is not None else (0, None)
+                postings = [(tid, ag_pos) for tid, ag_pos in zip(tid_arr, pos_arr)
+                            if (pos == -1 or ag_pos == pos) and tid >= start_tid and (end_tid is None or tid < end_tid)]
+                tid_arr = array.array("l", [tid for tid, _ in postings])
+                pos_arr = array.array("B", [ag_pos for _, ag_pos in postings])
+            yield tid_arr, pos_arr
+            return
+        for ag_pos, _ in numencode.decode_plist_dir(plist_blob):
+            if pos != -1 and ag_pos != pos:
+                continue
+            sub_plist_data = self.plist_ldb.get(DepTupleIndex.plist_key(term_id, ag_pos))
+            if tid_range is None:
+                yield numencode.decode_plist_arrays(sub_plist_data)
+            else:
+                yield numencode.decode_plist_range(sub_plist_data, *tid_range)
+
+    def get_postings(self, term_id, pos=-1, tid_range=None):
+        """
+        Returns array("l") of tuple ids and array("B") of argument positions of the term postings
+        (see i_sub_postings), sub-lists are merged in the tuple ID order.
+        """
+        sub_lists = list(self.i_sub_postings(term_id, pos, tid_range))
+        if len(sub_lists) == 1:
+            return sub_lists[0]
+        tid_arr, pos_arr = array.array("l"), array.array("B")
+        for tid, ag_pos in heapq.merge(*[zip(sub_tids, sub_poss) for sub_tids, sub_poss in sub_lists]):
+            tid_arr.append(tid)
+            pos_arr.append(ag_pos)
+        return tid_arr, pos_arr
+
+    @staticmethod
+    def plist_key(term_id, pos=None):
+        """
+        Key of the term directory (positions and posting counts of its sub-lists) or, if the
+        position is given, of the sub-list.
+        """
+        if pos is None:
+            return numencode.encode_uint(term_id)
+        return "%s.%d" % (numencode.encode_uint(term_id), pos)
 
     @staticmethod
     def tuple2stamp(d_tuple, term2id):
@@ -146,8 +323,9 @@ class DepTupleIndex(object):
         return stamp[1: len(stamp) - 1]
 
     @staticmethod
-    def get_tuple_ldb(index_root, create=False):
-        db_path = os.path.join(index_root, "tuple.ldb")
+    def open_ldb(db_path, create=False):
+        # Imported here, so that snapshots and the index build helpers do not require LevelDB.
+        import plyvel
         return plyvel.DB(db_path,
                          compression="snappy",
                          write_buffer_size=1024 * (1024 ** 2),  # 1 GB
@@ -156,27 +334,17 @@ class DepTupleIndex(object):
                          create_if_missing=create,
                          error_if_exists=create)
 
+    @staticmethod
+    def get_tuple_ldb(index_root, create=False):
+        return DepTupleIndex.open_ldb(os.path.join(index_root, "tuple.ldb"), create)
+
     @staticmethod
     def get_term_ldb(index_root, create=False):
-        db_path = os.path.join(index_root, "term.ldb")
-        return plyvel.DB(db_path,
-                         compression="snappy",
-                         write_buffer_size=1024 * (1024 ** 2),  # 1 GB
-                         block_size=512 * (1024 ** 2),          # 512 MB
-                         bloom_filter_bits=8,
-                         create_if_missing=create,
-                         error_if_exists=create)
+        return DepTupleIndex.open_ldb(os.path.join(index_root, "term.ldb"), create)
 
     @staticmethod
     def get_plist_ldb(index_root, create=False):
-        db_path = os.path.join(index_root, "plist.ldb")
-        return plyvel.DB(db_path,
-                         compression="snappy",
-                         write_buffer_size=1024 * (1024 ** 2),  # 1 GB
-                         block_size=512 * (1024 ** 2),          # 512 MB
-                         bloom_filter_bits=8,
-                         create_if_missing=create,
-                         error_if_exists=create)
+        return DepTupleIndex.open_ldb(os.path.join(index_root, "plist.ldb"), create)
 
     @staticmethod
     def write_tuples(id2tuple, tuple_ldb):
@@ -185,6 +353,18 @@ class DepTupleIndex(object):
                 wb.put(str(tuple_id), pickle.dumps(stamp))
         logging.info("Wrote %d tuples on disk." % len(id2tuple))
 
+    @staticmethod
+    def i_rel_stamps(rel_tuples, tuple_runs, rel_ranges):
+        """
+        Yields stamps of every relation, read from the runs and from memory, in the final ID order.
+        """
+        for rel_id, _ in sorted(rel_ranges.iteritems()):
+            for run_path in tuple_runs[rel_id]:
+                for stamp in extsort.i_read_run(run_path):
+                    yield stamp
+            for stamp in rel_tuples[rel_id]:
+                yield stamp
+
     @staticmethod
     def load_tuples(tuple_ldb, id2tuple):
         for tuple_id_str, stamp_blob in tuple_ldb:
@@ -223,90 +403,282 @@ class DepTupleIndex(object):
         return lz4.compressHC(updated_plist)
 
     @staticmethod
-    def write_plists(plist_dict, plist_ldb, final_iteration=True):
-        plist_dict_dict = {}
-        with plist_ldb.write_batch() as wb:
-            for term_id, plist in plist_dict.iteritems():
-                if 50 <= len(plist) <= 100000 and not final_iteration:
-                    plist_dict_dict[term_id] = plist
-                    continue
-                term_key = numencode.encode_uint(term_id)
-                try:
-                    old_plist_blob = plist_ldb.get(term_key)
-                except KeyError:
-                    old_plist_blob = None
-                if old_plist_blob is None:
-                    plist_blob = DepTupleIndex.encode_posting_list(plist)
-                else:
-                    plist_blob = DepTupleIndex.update_posting_list(old_plist_blob, plist)
-                wb.put(term_key, plist_blob)
-        logging.info("Wrote %d posting lists on disk." % len(plist_dict))
-        return plist_dict_dict
+    def write_plist_run(plist_dict, run_no, tmp_dir=None):
+        """
+        Writes cached posting lists to a run sorted by the posting list key (see plist_key), which is
+        the order of the posting lists database. Postings hold provisional tuple IDs, runs are
+        numbered in the order in which they are spilled (the input order), so that lists of a term
+        from several runs are concatenated in the input order.
+        """
+        run = sorted((DepTupleIndex.plist_key(term_id), run_no, tid_arr.tostring(), pos_arr.tostring())
+                     for term_id, (tid_arr, pos_arr) in plist_dict.iteritems())
+        return extsort.write_run(run, tmp_dir, prefix="mokujin-plist-")
+
+    @staticmethod
+    def plist_key_ranges(n_terms, n_parts):
+        """
+        Splits the keys of posting lists of n_terms terms into at most n_parts contiguous ranges of
+        about the same number of terms. Returns (first key, end key) pairs, None is an open end.
+        """
+        step = max(1, n_terms / 1000)
+        keys = sorted(DepTupleIndex.plist_key(term_id) for term_id in xrange(0, n_terms, step))
+        bounds = sorted(set(keys[len(keys) * part / n_parts] for part in xrange(1, n_parts)) - set(keys[:1]))
+        return zip([None] + bounds, bounds + [None])
 
     @staticmethod
-    def create(index_root, tuples, freq_threshold=5):
+    def i_merge_plists(plist_runs, plist_dict, tmp_dir=None, key_range=(None, None)):
+        """
+        Merges runs and the last cached posting lists, yields (term_id, tid_arr, pos_arr) sorted by
+        the posting list key, each term exactly once. Only the terms with keys in [first key, end key)
+        of key_range are yielded, blocks of the runs which end before the first key are skipped
+        without decompressing them and reading of the runs stops at the end key.
+        """
+        first_key, end_key = key_range
+        last_run = sorted(((DepTupleIndex.plist_key(term_id), len(plist_runs), tid_arr, pos_arr)
+                           for term_id, (tid_arr, pos_arr) in plist_dict.iteritems()), key=lambda item: item[0])
+        items = heapq.merge(extsort.i_merge_runs(plist_runs, tmp_dir, first_key=first_key), last_run)
+        if first_key is not None:
+            items = itertools.dropwhile(lambda item: item[0] < first_key, items)
+        if end_key is not None:
+            items = itertools.takewhile(lambda item: item[0] < end_key, items)
+        current_key, current_tids, current_poss = None, None, None
+        for key, _, tids, poss in items:
+            if key != current_key:
+                if current_key is not None:
+                    yield numencode.decode_uint(current_key), current_tids, current_poss
+                current_key, current_tids, current_poss = key, array.array("l"), array.array("B")
+            if isinstance(tids, array.array):
+                current_tids.extend(tids)
+                current_poss.extend(poss)
+            else:
+                current_tids.fromstring(tids)
+                current_poss.fromstring(poss)
+        if current_key is not None:
+            yield numencode.decode_uint(current_key), current_tids, current_poss
+
+    @staticmethod
+    def i_final_plists(i_plists, rel_starts):
+        """
+        Replaces provisional tuple IDs of the postings by the final ones. Postings of every relation
+        come in the input order, i.e. sorted, and relations have disjoint ranges of the final IDs
+        ordered by relation ID, so the sorted list is the concatenation of the per-relation lists
+        in the relation ID order, nothing is sorted.
+        """
+        shift = DepTupleIndex.REL_ID_SHIFT
+        mask = (1 << shift) - 1
+        for term_id, tid_arr, pos_arr in i_plists:
+            rel_tids, rel_poss = {}, {}
+            for tid, ag_pos in itertools.izip(tid_arr, pos_arr):
+                rel_id = tid >> shift
+                final_tids = rel_tids.get(rel_id)
+                if final_tids is None:
+                    final_tids = rel_tids[rel_id] = array.array("l")
+                    rel_poss[rel_id] = array.array("B")
+                final_tids.append(rel_starts[rel_id] + (tid & mask))
+                rel_poss[rel_id].append(ag_pos)
+            if len(rel_tids) == 1:
+                yield term_id, final_tids, rel_poss[rel_id]
+                continue
+            tid_arr, pos_arr = array.array("l"), array.array("B")
+            for rel_id in sorted(rel_tids):
+                tid_arr.extend(rel_tids[rel_id])
+                pos_arr.extend(rel_poss[rel_id])
+            yield term_id, tid_arr, pos_arr
 
-        id2term    = {}
+    @staticmethod
+    def i_encode_plists(i_plists):
+        """
+        Splits posting lists by argument position, yields (key, blob) pairs of the term directory
+        and of the sub-lists. Keys of a term directory and of its sub-lists are adjacent in the key
+        order ("." sorts before the key letters), so lists given in the key order give sorted pairs.
+        Sub-lists are stored uncompressed, so that a range of tuple IDs is decoded from the blob
+        through its skip table (lz4 made the version 2 lists larger).
+        """
+        for term_id, tid_arr, pos_arr in i_plists:
+            if pos_arr.count(pos_arr[0]) == len(pos_arr):
+                sub_lists = [(pos_arr[0], tid_arr, pos_arr)]
+            else:
+                pos_tids = {}
+                for tid, ag_pos in zip(tid_arr, pos_arr):
+                    pos_tids.setdefault(ag_pos, array.array("l")).append(tid)
+                sub_lists = [(ag_pos, sub_tids, array.array("B", [ag_pos]) * len(sub_tids))
+                             for ag_pos, sub_tids in sorted(pos_tids.iteritems())]
+            plist_dir = [(ag_pos, len(sub_tids)) for ag_pos, sub_tids, _ in sub_lists]
+            yield DepTupleIndex.plist_key(term_id), numencode.encode_plist_dir(plist_dir)
+            # Sub-list keys end with the decimal position, "k.10" sorts before "k.2".
+            for ag_pos, sub_tids, sub_poss in sorted(sub_lists, key=lambda sub_list: str(sub_list[0])):
+                sub_plist_data = numencode.encode_plist_arrays(sub_tids, sub_poss)
+                yield DepTupleIndex.plist_key(term_id, ag_pos), sub_plist_data
+
+    @staticmethod
+    def write_plists(i_plist_blobs, plist_ldb):
+        """
+        Writes (key, blob) pairs of i_encode_plists in batches, every posting list is written once.
+        """
+        written = 0
+        i_plist_blobs = iter(i_plist_blobs)
+        while True:
+            with plist_ldb.write_batch() as wb:
+                batch_size = 0
+                for term_key, plist_blob in i_plist_blobs:
+                    wb.put(term_key, plist_blob)
+                    batch_size += 1
+                    if batch_size == DepTupleIndex.PLIST_BATCH_SIZE:
+                        break
+            written += batch_size
+            if batch_size < DepTupleIndex.PLIST_BATCH_SIZE:
+                break
+        logging.info("Wrote %d posting lists and directories on disk." % written)
+
+    @staticmethod
+    def create(index_root, tuples, freq_threshold=5, memory_mb=512, tmp_dir=None, n_jobs=1):
+        """
+        Creates index of the given tuples. Terms are kept in memory, tuples are written to disk in
+        batches and postings are cached up to the `memory_mb` budget, then written to sorted runs in
+        `tmp_dir`; at the end the runs are merged and every posting list is written once.
+
+        Runs and posting lists are in the key order of the posting lists database. With n_jobs > 1
+        the keys are split into n_jobs contiguous ranges, posting lists of every range are merged and
+        encoded by its own process and written to one output run, the outputs are concatenated in
+        the key order while they are loaded into the database.
+
+        Tuples of every relation get a contiguous range of IDs (in the input order), so that search
+        restricts posting lists to the range of a relation. Until all tuples are counted, tuples are
+        cached or written to runs per relation and postings hold provisional IDs.
+        """
+
+        t0 = time.time()
         term2id    = {}
-        id2tuple   = {}
+        rel_tuples = collections.defaultdict(list)
+        tuple_runs = collections.defaultdict(list)
+        rel_sizes  = collections.defaultdict(int)
         plist_dict = {}
+        plist_runs = []
+        merged_runs = set()
+        blob_runs  = []
+        n_tuples   = 0
+        n_spills   = 0
 
-        term_ldb   = DepTupleIndex.get_term_ldb(index_root, create=True)
         plist_ldb  = DepTupleIndex.get_plist_ldb(index_root, create=True)
-        tuple_ldb  = DepTupleIndex.get_tuple_ldb(index_root, create=True)
 
         cached = 0
+        max_cached = memory_mb * 1024 * 1024
         logging.info("Beginning creating index.")
+        plist_ldb.put(DepTupleIndex.PLIST_LAYOUT_KEY, DepTupleIndex.POSITIONAL_LAYOUT)
 
-        for line_no, d_tuple in enumerate(tuples):
-
-            dep_arguments = d_tuple[1]
-            dep_frequency = d_tuple[-1]
-
-            if line_no % 25000 == 0:
-                logging.info("Indexing tuple #%d. Freq=%d." % (line_no, dep_frequency))
-
-            for term in dep_arguments:
-
-                # Skip special terms.
-                if term == -1 or term == -2:
-                    continue
-
-                # Add term to dictionary.
-                term_id = term2id.get(term, -1)
-                if term_id == -1:
-                    term_id = len(term2id)
-                    term2id[term] = term_id
-                    id2term[term_id] = term
-
-            # Get compact representation of dependency tuple.
-            stamp = DepTupleIndex.tuple2stamp(d_tuple, term2id)
-
-            if dep_frequency > freq_threshold:
-
-                # Generate ID for new tuple.
-                tuple_id = len(id2tuple)
-                id2tuple[tuple_id] = stamp
-
-                for arg_idx, arg in enumerate(stamp[1:-1]):
-                    if arg >= 0:
-                        arg_plist = plist_dict.get(arg)
-                        if arg_plist is None:
-                            plist_dict[arg] = [(tuple_id, arg_idx)]
-                        else:
-                            plist_dict[arg].append((tuple_id, arg_idx))
-
-                cached += 1
-                if cached == DepTupleIndex.PLIST_CACHE_SIZE:
-                    logging.info("Writing %d posting lists to disc." % len(plist_dict))
-                    plist_dict = DepTupleIndex.write_plists(plist_dict, plist_ldb, final_iteration=False)
-                    cached = 0
-
-                    gc.collect()
-
-        DepTupleIndex.write_terms(term2id, term_ldb)
-        DepTupleIndex.write_tuples(id2tuple, tuple_ldb)
-        DepTupleIndex.write_plists(plist_dict, plist_ldb, final_iteration=True)
+        try:
+            for line_no, d_tuple in enumerate(tuples):
+
+                dep_arguments = d_tuple[1]
+                dep_frequency = d_tuple[-1]
+
+                if line_no % 25000 == 0:
+                    logging.info("Indexing tuple #%d. Freq=%d." % (line_no, dep_frequency))
+
+                for term in dep_arguments:
+
+                    # Skip special terms.
+                    if term == -1 or term == -2:
+                        continue
+
+                    # Add term to dictionary.
+                    term_id = term2id.get(term, -1)
+                    if term_id == -1:
+                        term_id = len(term2id)
+                        term2id[term] = term_id
+
+                # Get compact representation of dependency tuple.
+                stamp = DepTupleIndex.tuple2stamp(d_tuple, term2id)
+
+                if dep_frequency > freq_threshold:
+
+                    # Generate provisional ID for new tuple.
+                    rel_id = stamp[0]
+                    tuple_id = (rel_id << DepTupleIndex.REL_ID_SHIFT) | rel_sizes[rel_id]
+                    rel_sizes[rel_id] += 1
+                    n_tuples += 1
+                    rel_tuples[rel_id].append(stamp)
+                    if n_tuples % DepTupleIndex.TUPLE_BATCH_SIZE == 0:
+                        for run_rel_id, stamps in rel_tuples.iteritems():
+                            tuple_runs[run_rel_id].append(extsort.write_run(stamps, tmp_dir, prefix="mokujin-tuple-"))
+                        rel_tuples = collections.defaultdict(list)
+
+                    for arg_idx, arg in enumerate(stamp[1:-1]):
+                        if arg >= 0:
+                            arg_plist = plist_dict.get(arg)
+                            if arg_plist is None:
+                                arg_plist = plist_dict[arg] = (array.array("l"), array.array("B"))
+                                cached += DepTupleIndex.PLIST_MEMORY
+                            arg_plist[0].append(tuple_id)
+                            arg_plist[1].append(arg_idx)
+                            cached += DepTupleIndex.POSTING_MEMORY
+
+                    if cached >= max_cached:
+                        logging.info("Writing %d posting lists to run #%d." % (len(plist_dict), n_spills + 1))
+                        plist_runs.append(DepTupleIndex.write_plist_run(plist_dict, n_spills, tmp_dir))
+                        plist_dict = {}
+                        cached = 0
+                        n_spills += 1
+
+            rel_ranges = {}
+            rel_starts = {}
+            start = 0
+            for rel_id, rel_size in sorted(rel_sizes.iteritems()):
+                rel_starts[rel_id] = start
+                rel_ranges[rel_id] = (start, start + rel_size)
+                start += rel_size
+
+            write_term_dict(term2id, os.path.join(index_root, DepTupleIndex.TERM_DICT_FILE))
+            logging.info("Wrote %d terms on disk." % len(term2id))
+            write_tuple_store(os.path.join(index_root, DepTupleIndex.TUPLE_STORE_FILE),
+                              DepTupleIndex.i_rel_stamps(rel_tuples, tuple_runs, rel_ranges),
+                              n_tuples,
+                              rel_ranges)
+            logging.info("Wrote %d tuples on disk." % n_tuples)
+            if n_jobs > 1:
+                plist_runs.append(DepTupleIndex.write_plist_run(plist_dict, n_spills, tmp_dir))
+                plist_dict = {}
+                # Runs are merged down to the fan-in once, here, every process skips the blocks before its range.
+                part_runs = extsort.reduce_runs(plist_runs, tmp_dir, merged_paths=merged_runs)
+                key_ranges = DepTupleIndex.plist_key_ranges(len(term2id), n_jobs)
+                logging.info("Building posting lists in %d processes." % len(key_ranges))
+                pool = multiprocessing.Pool(n_jobs)
+                tasks = [(part_runs, key_range, rel_starts, tmp_dir) for key_range in key_ranges]
+                for blob_run in pool.imap(build_plist_partition, tasks):
+                    blob_runs.append(blob_run)
+                pool.close()
+                pool.join()
+                i_plist_blobs = itertools.chain.from_iterable(extsort.i_read_run(blob_run) for blob_run in blob_runs)
+                DepTupleIndex.write_plists(i_plist_blobs, plist_ldb)
+            else:
+                if n_spills:
+                    logging.info("Merging %d posting list runs." % (n_spills + 1))
+                i_plists = DepTupleIndex.i_merge_plists(plist_runs, plist_dict, tmp_dir)
+                i_plists = DepTupleIndex.i_final_plists(i_plists, rel_starts)
+                DepTupleIndex.write_plists(DepTupleIndex.i_encode_plists(i_plists), plist_ldb)
+        finally:
+            extsort.remove_runs(plist_runs)
+            extsort.remove_runs(merged_runs)
+            extsort.remove_runs([run_path for runs in tuple_runs.itervalues() for run_path in runs])
+            extsort.remove_runs(blob_runs)
+
+        logging.info("INDEX: %d TERMS, %d TUPLES, BUILT IN %.1f SEC, PEAK RSS %.1f MB" % (
+            len(term2id),
+            n_tuples,
+            time.time() - t0,
+            extsort.peak_rss() / 1048576.0,
+        ))
+
+
+def build_plist_partition(task):
+    """
+    Merges and encodes posting lists of the terms in one range of keys, returns the run of their
+    (key, blob) pairs, which are written in the key order, nothing is sorted.
+    """
+    run_paths, key_range, rel_starts, tmp_dir = task
+    i_plists = DepTupleIndex.i_merge_plists(run_paths, {}, tmp_dir, key_range)
+    i_plist_blobs = DepTupleIndex.i_encode_plists(DepTupleIndex.i_final_plists(i_plists, rel_starts))
+    return extsort.write_run(i_plist_blobs, tmp_dir, prefix="mokujin-blobs-")
 
 
 class TripleSearchEngine(object):
@@ -340,25 +712,25 @@ class TripleSearchEngine(object):
                 term_id, pos = None, -1
             if term_id is not None and term_id in self.id_term_map:
                 norm_query.append((term_id, pos))
+        # Relation is a range of tuple IDs in indexes which have the range table.
+        tid_range = None
+        if rel_type is not None and self.index.rel_ranges is not None:
+            tid_range = self.index.rel_ranges.get(rel_type, (0, 0))
         results = None
         for term_id, pos in norm_query:
-            try:
-                plist_blob = self.arg_index.get(numencode.encode_uint(term_id))
-                plist = self.index.decode_posting_list(plist_blob)
-            except KeyError:
-                plist = []
-            if pos != -1:
-                plist = filter(lambda plist_el: plist_el[1] == pos, plist)
-            plist = [plist_el[0] for plist_el in plist]
-            plist = set(plist)
+            plist = set()
+            for sub_tids, _ in self.index.i_sub_postings(term_id, pos, tid_range):
+                plist.update(sub_tids)
             if results is None:
                 results = plist
             else:
                 results &= plist
         if results is None:
-            return ()
+            if arg_query or rel_type is None:
+                return ()
+            results = xrange(*tid_range) if tid_range is not None else self.id_triple_map.iterkeys()
         results = [self.id_triple_map[triple_id] for triple_id in results]
-        if rel_type is not None:
+        if rel_type is not None and tid_range is None:
             results = filter(lambda triple: triple[0] == rel_type, results)
         return results
 
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Copyright (C) USC Information Sciences Institute
+# Author: Vladimir M. Zaytsev <zaytsev@usc.edu>
+# URL: <http://nlg.isi.edu/>
+# For more information, see README.md
+# For license information, see LICENSE
+
+"""
+Journal of a resumable batch job.
+
+The job is split into segments, (path, start, end) parts of the input files. Counts of every finished
+segment are persisted as sorted run files (see extsort.write_run) in the work directory and the
+segment is appended to the journal, one JSON object per line, flushed and fsync'ed. A restarted job
+reads the journal and skips finished segments; runs written by a segment which was not journaled
+(the job was killed in between) are removed.
+
+The first journal line records job parameters, the journal can not be resumed with different ones
+since segments would not match.
+"""
+
+import os
+import json
+import logging
+
+
+JOURNAL_FILE = "journal"
+
+
+class JournalError(Exception):
+    pass
+
+
+class BatchJournal(object):
+
+    def __init__(self, work_dir, params):
+        self.work_dir = work_dir
+        self.path = os.path.join(work_dir, JOURNAL_FILE)
+        self.params = json.loads(json.dumps(params))
+        self.segments = dict()
+        if not os.path.isdir(work_dir):
+            os.makedirs(work_dir)
+        if os.path.exists(self.path):
+            self.load()
+        self.j_file = open(self.path, "a")
+        if not self.segments and os.path.getsize(self.path) == 0:
+            self.write_entry({"params": params})
+        self.remove_orphans()
+
+    def load(self):
+        with open(self.path, "rb") as j_file:
+            lines = j_file.read().split("\n")
+        entries = []
+        for line_no, line in enumerate(lines):
+            if not line:
+                continue
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # Only the last line may be incomplete, when the job was killed while writing it.
+                if line_no < len(lines) - 1:
+                    raise JournalError("Corrupted journal %s at line %d." % (self.path, line_no + 1))
+                logging.warning("Ignoring incomplete last line of %s" % self.path)
+                with open(self.path, "r+b") as j_file:
+                    j_file.truncate(len("\n".join(lines[:line_no])) + 1 if line_no else 0)
+        if not entries:
+            return
+        if entries[0].get("params") != self.params:
+            raise JournalError("Journal %s was written with parameters %r, not %r." % (
+                self.path, entries[0].get("params"), self.params))
+        for entry in entries[1:]:
+            self.segments[segment_key(entry)] = entry
+        logging.info("JOURNAL: %d SEGMENTS DONE" % len(self.segments))
+
+    def write_entry(self, entry):
+        self.j_file.write(json.dumps(entry, sort_keys=True))
+        self.j_file.write("\n")
+        self.j_file.flush()
+        os.fsync(self.j_file.fileno())
+
+    def is_done(self, path, start, end):
+        entry = self.segments.get((abs_path(path), start, end))
+        if entry is None:
+            return False
+        if entry["size"] != os.path.getsize(path):
+            raise JournalError("%s has changed since it was journaled." % path)
+        return True
+
+    def add(self, path, start, end, run_paths, **info):
+        """
+        Marks segment as done. Run files should already be in the work directory.
+        """
+        entry = dict(info)
+        entry["path"] = abs_path(path)
+        entry["size"] = os.path.getsize(path)
+        entry["start"] = start
+        entry["end"] = end
+        entry["runs"] = [os.path.basename(run_path) for run_path in run_paths]
+        self.write_entry(entry)
+        self.segments[segment_key(entry)] = entry
+
+    def run_paths(self):
+        run_paths = []
+        for key in sorted(self.segments):
+            run_paths.extend(os.path.join(self.work_dir, run) for run in self.segments[key]["runs"])
+        return run_paths
+
+    def remove_orphans(self):
+        journaled = set(os.path.basename(run_path) for run_path in self.run_paths())
+        for filename in os.listdir(self.work_dir):
+            if filename.endswith(".run") and filename not in journaled:
+                logging.info("REMOVING UNFINISHED RUN %s" % filename)
+                os.remove(os.path.join(self.work_dir, filename))
+
+    def close(self):
+        self.j_file.close()
+
+    def remove(self):
+        """
+        Removes the journal and all journaled runs, when the job is complete.
+        """
+        self.close()
+        for run_path in self.run_paths():
+            if os.path.exists(run_path):
+                os.remove(run_path)
+        os.remove(self.path)
+        self.segments = dict()
+
+
+def abs_path(path):
+    path = os.path.abspath(path)
+    return path.decode("utf-8") if isinstance(path, str) else path
+
+
+def segment_key(entry):
+    return entry["path"], entry["start"], entry["end"]
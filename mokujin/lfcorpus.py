@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Copyright (C) USC Information Sciences Institute
+# Author: Vladimir M. Zaytsev <zaytsev@usc.edu>
+# URL: <http://nlg.isi.edu/>
+# For more information, see README.md
+# For license information, see LICENSE
+
+"""
+Binary pre-parsed LF corpus.
+
+File layout (native byte order, all arrays are 8-bytes aligned):
+
+    header          - magic, counts and offsets of the sections below (see HEADER)
+    string blob     - UTF-8 strings (pids, lemmas, extras, arguments and raw texts)
+    string offsets  - uint64[n_strings + 1], string i is blob[offsets[i]:offsets[i + 1]]
+    sent_pred       - uint64[n_sentences + 1], index of the first predicate of each sentence
+    sent_text       - int32[n_sentences], string id of the raw text or -1
+    pred_pid        - int32[n_predicates], string id of the pid or -1 (extra predicates)
+    pred_lemma      - int32[n_predicates], string id of the lemma or -1
+    pred_extra      - int32[n_predicates], string id of the extra predicate name or -1
+    pred_pos        - uint8[n_predicates], POS enum value
+    pred_args       - uint64[n_predicates + 1], index of the first argument of each predicate
+    args            - int32[n_args], string id of the argument or -1 (unbound argument)
+"""
+
+import os
+import mmap
+import stat
+import array
+import struct
+import logging
+
+from mokujin.logicalform import Sentence
+from mokujin.logicalform import Predicate
+from mokujin.logicalform import intern_str
+from mokujin.logicalform import MetaphorAdpLF_Reader
+
+
+MAGIC = "MKJLFB01"
+HEADER = struct.Struct("=8s14Q")
+ALIGNMENT = 8
+NONE_ID = -1
+
+
+def is_binary_lf(lf_file):
+    """
+    Checks magic bytes of the given file. Only regular files are checked, so that reading from
+    pipes (e.g. stdin) does not lose data.
+    """
+    try:
+        if not stat.S_ISREG(os.fstat(lf_file.fileno()).st_mode):
+            return False
+    except (AttributeError, ValueError):
+        return False
+    position = lf_file.tell()
+    magic = lf_file.read(len(MAGIC))
+    lf_file.seek(position)
+    return magic == MAGIC
+
+
+def lf_reader(lf_file, lazy=False):
+    """
+    Returns sentence reader suitable for the given file: BinaryLF_Reader for binary corpora
+    created by BinaryLF_Writer and MetaphorAdpLF_Reader for text LF files (`lazy` is passed to
+    MetaphorAdpLF_Reader, binary corpora always decode raw texts lazily).
+    """
+    if is_binary_lf(lf_file):
+        return BinaryLF_Reader(lf_file)
+    return MetaphorAdpLF_Reader(lf_file, lazy=lazy)
+
+
+class BinaryLF_Writer(object):
+
+    def __init__(self, o_file):
+        self.o_file = o_file
+        self.string_ids = {}
+        self.string_offsets = array.array("L", [0])
+        self.sent_pred = array.array("L", [0])
+        self.sent_text = array.array("i")
+        self.pred_pid = array.array("i")
+        self.pred_lemma = array.array("i")
+        self.pred_extra = array.array("i")
+        self.pred_pos = array.array("B")
+        self.pred_args = array.array("L", [0])
+        self.args = array.array("i")
+        if self.sent_pred.itemsize != 8:
+            raise Exception("Binary LF corpus requires 64-bit array('L').")
+        self.o_file.write(HEADER.pack(MAGIC, *([0] * 14)))
+        self.blob_offset = self.o_file.tell()
+        self.blob_size = 0
+
+    def add_string(self, string):
+        data = string.encode("utf-8")
+        self.o_file.write(data)
+        self.blob_size += len(data)
+        self.string_offsets.append(self.blob_size)
+        return len(self.string_offsets) - 2
+
+    def string_id(self, string):
+        if string is None or string is False or string == -1:
+            return NONE_ID
+        string_id = self.string_ids.get(string)
+        if string_id is None:
+            string_id = self.add_string(string)
+            self.string_ids[string] = string_id
+        return string_id
+
+    def add_sentence(self, sentence):
+        # Raw texts are unique, so they are not interned.
+        self.sent_text.append(self.add_string(sentence.raw_text) if sentence.raw_text is not None else NONE_ID)
+        for pred in sentence:
+            self.pred_pid.append(self.string_id(pred.pid))
+            self.pred_lemma.append(self.string_id(pred.lemma))
+            self.pred_extra.append(self.string_id(pred.extra))
+            self.pred_pos.append(pred.pos.pos)
+            for arg in pred.args:
+                self.args.append(self.string_id(arg))
+            self.pred_args.append(len(self.args))
+        self.sent_pred.append(len(self.pred_pid))
+
+    def write_array(self, arr):
+        padding = -self.o_file.tell() % ALIGNMENT
+        self.o_file.write("\0" * padding)
+        offset = self.o_file.tell()
+        arr.tofile(self.o_file)
+        return offset
+
+    def close(self):
+        offsets = [self.blob_offset]
+        for arr in (self.string_offsets,
+                    self.sent_pred,
+                    self.sent_text,
+                    self.pred_pid,
+                    self.pred_lemma,
+                    self.pred_extra,
+                    self.pred_pos,
+                    self.pred_args,
+                    self.args):
+            offsets.append(self.write_array(arr))
+        self.o_file.seek(0)
+        self.o_file.write(HEADER.pack(MAGIC,
+                                      len(self.sent_text),
+                                      len(self.pred_pid),
+                                      len(self.args),
+                                      len(self.string_offsets) - 1,
+                                      *offsets))
+        self.o_file.close()
+        logging.info("Wrote %d sentences, %d predicates, %d strings." % (
+            len(self.sent_text),
+            len(self.pred_pid),
+            len(self.string_offsets) - 1,
+        ))
+
+    @staticmethod
+    def convert(i_sentences, o_file):
+        writer = BinaryLF_Writer(o_file)
+        for sentence in i_sentences:
+            writer.add_sentence(sentence)
+        writer.close()
+
+
+class BinaryLF_Reader(object):
+    """
+    Reads binary LF corpus through mmap and yields Sentence objects without text parsing.
+    Sentences have no `line` attribute value, everything else is the same as produced by
+    MetaphorAdpLF_Reader.
+    """
+
+    def __init__(self, lf_file):
+        self.lf_file = lf_file
+        self.data = mmap.mmap(lf_file.fileno(), 0, access=mmap.ACCESS_READ)
+        header = HEADER.unpack_from(self.data, 0)
+        if header[0] != MAGIC:
+            raise Exception("%r is not a binary LF corpus." % lf_file)
+        self.n_sentences, self.n_predicates, self.n_args, self.n_strings = header[1:5]
+        (self.blob_offset,
+         self.string_offsets_offset,
+         self.sent_pred_offset,
+         self.sent_text_offset,
+         self.pred_pid_offset,
+         self.pred_lemma_offset,
+         self.pred_extra_offset,
+         self.pred_pos_offset,
+         self.pred_args_offset,
+         self.args_offset) = header[5:]
+        self.strings = {NONE_ID: None}
+
+    def __len__(self):
+        return self.n_sentences
+
+    def read_bytes(self, string_id):
+        start, end = struct.unpack_from("=2Q", self.data, self.string_offsets_offset + string_id * 8)
+        return self.data[(self.blob_offset + start):(self.blob_offset + end)]
+
+    def read_string(self, string_id):
+        return self.read_bytes(string_id).decode("utf-8")
+
+    def string(self, string_id):
+        string = self.strings.get(string_id)
+        if string is None and string_id != NONE_ID:
+            string = intern_str(self.read_string(string_id))
+            self.strings[string_id] = string
+        return string
+
+    def sentence(self, sid):
+        data = self.data
+        start, end = struct.unpack_from("=2Q", data, self.sent_pred_offset + sid * 8)
+        text_id, = struct.unpack_from("=i", data, self.sent_text_offset + sid * 4)
+        size = end - start
+        pids = struct.unpack_from("=%di" % size, data, self.pred_pid_offset + start * 4)
+        lemmas = struct.unpack_from("=%di" % size, data, self.pred_lemma_offset + start * 4)
+        extras = struct.unpack_from("=%di" % size, data, self.pred_extra_offset + start * 4)
+        poss = struct.unpack_from("=%dB" % size, data, self.pred_pos_offset + start)
+        arg_bounds = struct.unpack_from("=%dQ" % (size + 1), data, self.pred_args_offset + start * 8)
+        if size > 0:
+            args = struct.unpack_from("=%di" % (arg_bounds[-1] - arg_bounds[0]), data,
+                                      self.args_offset + arg_bounds[0] * 4)
+        string = self.string
+        predicates = []
+        for i in xrange(size):
+            arg_list = tuple([string(arg) if arg != NONE_ID else False
+                              for arg in args[(arg_bounds[i] - arg_bounds[0]):(arg_bounds[i + 1] - arg_bounds[0])]])
+            predicates.append(Predicate.fromparts(string(pids[i]) if pids[i] != NONE_ID else -1,
+                                                  string(lemmas[i]),
+                                                  poss[i],
+                                                  arg_list,
+                                                  string(extras[i])))
+        sentence = Sentence(sid, predicates)
+        if text_id != NONE_ID:
+            # Decoded by Sentence on the first access.
+            sentence.raw_text = self.read_bytes(text_id)
+        return sentence
+
+    def i_sentences(self, start=0, end=None):
+        if end is None or end > self.n_sentences:
+            end = self.n_sentences
+        for sid in xrange(start, end):
+            yield self.sentence(sid)
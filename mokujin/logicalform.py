@@ -7,6 +7,7 @@
 # For more information, see README.md
 # For license information, see LICENSE
 
+import re
 import logging
 
 
@@ -21,6 +22,20 @@ class POS(object):
     PR = 0x06
     ANY = 0x07
 
+# One well-formed predicate of a Metaphor-ADP logical form line, either a lexical predicate
+# "[pid]:lemma-pos(args)" or an extra predicate "name(args)", preceded by the " & " separator.
+LF_PREDICATE_RE = re.compile(
+    r"(?:\A| & )"
+    r"(?:(\[[^:&()]*):([^:&()]*)-([^-:&()]*)\(([^-:&()]*)\)"
+    r"|([^\[&()][^&()]*)\(([^&()]*)\))",
+    re.UNICODE,
+)
+LF_TAIL_RE = re.compile(r"\s*\Z", re.UNICODE)
+# The same expressions for undecoded UTF-8 lines. Multi-byte UTF-8 sequences never contain ASCII
+# bytes, so separators and brackets are matched exactly as in decoded lines.
+LF_PREDICATE_BYTES_RE = re.compile(LF_PREDICATE_RE.pattern)
+LF_TAIL_BYTES_RE = re.compile(LF_TAIL_RE.pattern)
+
 ID_POS_NAME = {
     POS.NONE: "NONE",
     POS.VB: "VB",
@@ -33,13 +48,60 @@ ID_POS_NAME = {
 }
 
 
+POS_TAG_ID = {
+    "vb": POS.VB,
+    "v": POS.VB,
+    "nn": POS.NN,
+    "n": POS.NN,
+    "adj": POS.ADJ,
+    "a": POS.ADJ,
+    "rb": POS.RB,
+    "r": POS.RB,
+    "in": POS.PREP,
+    "p": POS.PREP,
+    "pr": POS.PR,
+}
+
+INTERN_CACHE_SIZE = 2 ** 20
+INTERN_CACHE = {}
+
+
+def intern_str(string):
+    """
+    Returns shared copy of the given lemma or argument string. Unlike built-in intern() it works for
+    unicode strings. The cache is dropped when it grows over INTERN_CACHE_SIZE entries.
+    """
+    interned = INTERN_CACHE.get(string)
+    if interned is None:
+        if len(INTERN_CACHE) >= INTERN_CACHE_SIZE:
+            INTERN_CACHE.clear()
+        INTERN_CACHE[string] = string
+        interned = string
+    return interned
+
+
+DECODE_CACHE = {}
+
+
+def decode_str(data):
+    """
+    Decodes UTF-8 lemma or argument and returns its shared copy (see intern_str). Each distinct byte
+    string is decoded only once while it stays in the cache.
+    """
+    string = DECODE_CACHE.get(data)
+    if string is None:
+        if len(DECODE_CACHE) >= INTERN_CACHE_SIZE:
+            DECODE_CACHE.clear()
+        string = intern_str(data.decode("utf-8"))
+        DECODE_CACHE[data] = string
+    return string
+
+
 class Args(object):
+    __slots__ = ("arg_list", )
 
     def __init__(self, arg_list):
-        self.arg_list = [False] * len(arg_list)
-        for i, arg in enumerate(arg_list):
-            if arg and arg[0] != "u":
-                self.arg_list[i] = arg
+        self.arg_list = tuple([intern_str(arg) if arg and arg[0] != "u" else False for arg in arg_list])
 
     @property
     def first(self):
@@ -66,75 +128,57 @@ class Args(object):
         return False
 
     def __iter__(self):
-        for arg in self.arg_list:
-            yield arg
+        return iter(self.arg_list)
+
+    def __getstate__(self):
+        return self.arg_list
+
+    def __setstate__(self, arg_list):
+        self.arg_list = arg_list
 
 
 class Pos(object):
+    """
+    Part of speech tag. There is only one shared (flyweight) instance per POS enum value, so
+    Pos("nn") is Pos.fromenum(POS.NN) and neither call allocates.
+    """
+    __slots__ = ("pos", )
 
-    def __init__(self, pos_tag=None):
-        self.pos = POS.NONE
-        if pos_tag == "vb" or pos_tag == "v":
-            self.vb = True
-            self.pos = POS.VB
-        else:
-            self.vb = False
-        if pos_tag == "nn" or pos_tag == "n":
-            self.nn = True
-            self.pos = POS.NN
-        else:
-            self.nn = False
-        if pos_tag == "adj" or pos_tag == "a":
-            self.adj = True
-            self.pos = POS.ADJ
-        else:
-            self.adj = False
-        if pos_tag == "rb" or pos_tag == "r":
-            self.rb = True
-            self.pos = POS.RB
-        else:
-            self.rb = False
-        if pos_tag == "in" or pos_tag == "p":
-            self.prep = True
-            self.pos = POS.PREP
-        else:
-            self.prep = False
-        if pos_tag == "pr":
-            self.pr = True
-            self.pos = POS.PR
-        else:
-            self.pr = False
+    def __new__(cls, pos_tag=None):
+        return POS_INSTANCES[POS_TAG_ID.get(pos_tag, POS.NONE)]
 
     @staticmethod
     def fromenum(enum):
-        if enum == POS.VB:
-            return Pos("vb")
-        if enum == POS.NN:
-            return Pos("nn")
-        if enum == POS.ADJ:
-            return Pos("adj")
-        if enum == POS.RB:
-            return Pos("rb")
-        if enum == POS.PREP:
-            return Pos("in")
-        if enum == POS.PR:
-            return Pos("pr")
-        return Pos(None)
+        return POS_INSTANCES.get(enum, POS_INSTANCES[POS.NONE])
+
+    @property
+    def vb(self):
+        return self.pos == POS.VB
+
+    @property
+    def nn(self):
+        return self.pos == POS.NN
+
+    @property
+    def adj(self):
+        return self.pos == POS.ADJ
+
+    @property
+    def rb(self):
+        return self.pos == POS.RB
+
+    @property
+    def prep(self):
+        return self.pos == POS.PREP
+
+    @property
+    def pr(self):
+        return self.pos == POS.PR
 
     def __str__(self):
-        if self.vb:
-            return "VB"
-        if self.nn:
-            return "NN"
-        if self.adj:
-            return "ADJ"
-        if self.rb:
-            return "RB"
-        if self.prep:
-            return "PREP"
-        if self.pr:
-            return "PR"
-        return "<NONE-POS>"
+        if self.pos == POS.NONE:
+            return "<NONE-POS>"
+        return ID_POS_NAME[self.pos]
 
     def __int__(self):
         return self.pos
@@ -142,17 +186,31 @@ class Pos(object):
     def __repr__(self):
         return self.__str__()
 
+    def __reduce__(self):
+        for pos_tag, pos in POS_TAG_ID.iteritems():
+            if pos == self.pos:
+                return Pos, (pos_tag, )
+        return Pos, ()
+
+
+POS_INSTANCES = {}
+
+for pos_id in set(POS_TAG_ID.itervalues()) | {POS.NONE}:
+    POS_INSTANCES[pos_id] = object.__new__(Pos)
+    POS_INSTANCES[pos_id].pos = pos_id
+
 
 class Predicate(object):
+    __slots__ = ("pid", "lemma", "pos", "args", "extra", "none")
 
     def __init__(self, pid=None, lemma=None, pos=None, args=None, extra=None, none=False):
         self.none = none
         if not none:
             self.pid = pid
-            self.lemma = lemma
+            self.lemma = intern_str(lemma) if lemma else lemma
             self.pos = Pos(pos)
             self.args = Args(args)
-            self.extra = extra
+            self.extra = intern_str(extra) if extra else extra
         else:
             self.pid = None
             self.lemma = None
@@ -160,11 +218,36 @@ class Predicate(object):
             self.args = None
             self.extra = None
 
+    @staticmethod
+    def fromparts(pid, lemma, pos, arg_list, extra):
+        """
+        Creates predicate from already parsed parts: POS enum value and tuple of arguments with False
+        in place of unbound ones, i.e. what Pos and Args keep. Used by the binary LF corpus reader.
+        """
+        args = Args.__new__(Args)
+        args.arg_list = arg_list
+        predicate = Predicate.__new__(Predicate)
+        predicate.none = False
+        predicate.pid = pid
+        predicate.lemma = lemma
+        predicate.pos = Pos.fromenum(pos)
+        predicate.args = args
+        predicate.extra = extra
+        return predicate
+
     def lemma_pos(self):
         if self.none:
             return "<NONE>"
         return u"%s-%s" % (self.lemma, self.pos)
 
+    def fold_key(self):
+        """
+        Hashable key identifying lemma_pos() value without formatting it, used by TripleFold.
+        """
+        if self.none:
+            return "<NONE>"
+        return self.lemma, self.pos.pos
+
     @staticmethod
     def fromstr(line):
         result = line.split(":")
@@ -221,6 +304,12 @@ class Predicate(object):
             )
         return predicate_str.encode("utf-8")
 
+    def __getstate__(self):
+        return self.pid, self.lemma, self.pos, self.args, self.extra, self.none
+
+    def __setstate__(self, state):
+        self.pid, self.lemma, self.pos, self.args, self.extra, self.none = state
+
 
 class PredicateSet(object):
 
@@ -238,6 +327,14 @@ class PredicateSet(object):
             return u"%s-%r" % (lemmas, self.pos)
         return "<NONE>"
 
+    def fold_key(self):
+        """
+        Hashable key identifying lemma_pos() value (up to the order of lemmas), see Predicate.fold_key.
+        """
+        if len(self.predicates) > 0:
+            return tuple([pred.lemma for pred in self.predicates]), self.pos.pos
+        return "<NONE>"
+
     def __cmp__(self, other):
         set1 = set(other.lemmas())
         set2 = set(self.lemmas())
@@ -268,6 +365,11 @@ class PredicateSet(object):
 
 
 class SentenceIndex(object):
+    """
+    Sentence predicates index. Besides of per-argument dictionaries it keeps predicates grouped by
+    part of speech and by (argument slot, argument, part of speech) composite keys, so the typical
+    lookups made by relation matchers, e.g. find(second=x, pos=POS.NN), are single dictionary hits.
+    """
 
     def __init__(self, sentence):
 
@@ -277,8 +379,19 @@ class SentenceIndex(object):
         self.i_dic_arg_third = dict()
         self.i_dic_arg_fourth = dict()
         self.i_dic_extra = dict()
+        self.i_dic_pos = dict()
+        self.i_dic_slot_pos = dict()
+        self.i_dic_slots = (
+            self.i_dic_arg_first,
+            self.i_dic_arg_second,
+            self.i_dic_arg_third,
+            self.i_dic_arg_fourth,
+        )
         self.sentence = sentence
 
+        # Keys (slot, arg) of the slot dictionaries which contain a predicate with given lemma.
+        lemma_slot_keys = dict()
+
         for pred in sentence:
             for arg in pred.args:
                 if arg is not None:
@@ -291,28 +404,65 @@ class SentenceIndex(object):
                     self.i_dic_extra[pred.extra].append(pred)
                 else:
                     self.i_dic_extra[pred.extra] = [pred]
-            if pred.args.first:
-                if pred.args.first in self.i_dic_arg_first:
-                    self.i_dic_arg_first[pred.args.first].append(pred)
-                else:
-                    self.i_dic_arg_first[pred.args.first] = [pred]
-            if pred.args.second:
-                if pred.args.second in self.i_dic_arg_second:
-                    self.i_dic_arg_second[pred.args.second].append(pred)
-                else:
-                    self.i_dic_arg_second[pred.args.second] = [pred]
-            if pred.args.third:
-                if pred.args.third in self.i_dic_arg_third:
-                    self.i_dic_arg_third[pred.args.third].append(pred)
-                else:
-                    self.i_dic_arg_third[pred.args.third] = [pred]
-            if pred.args.fourth:
-                if pred.args.fourth in self.i_dic_arg_fourth:
-                    self.i_dic_arg_fourth[pred.args.fourth].append(pred)
+            for slot, arg in enumerate(pred.args.arg_list[0:4]):
+                if arg:
+                    slot_dic = self.i_dic_slots[slot]
+                    if arg in slot_dic:
+                        slot_dic[arg].append(pred)
+                    else:
+                        slot_dic[arg] = [pred]
+                    if pred.lemma is not None:
+                        if pred.lemma in lemma_slot_keys:
+                            lemma_slot_keys[pred.lemma].add((slot, arg))
+                        else:
+                            lemma_slot_keys[pred.lemma] = {(slot, arg)}
+
+        # Predicate matches a slot list if it is in that list or if the list contains a predicate with
+        # the same lemma (see Predicate.__eq__), that is what the list intersection in find() did.
+        for pred in sentence:
+            pos = pred.pos.pos
+            if pos == POS.NONE:
+                continue
+            if pos in self.i_dic_pos:
+                self.i_dic_pos[pos].append(pred)
+            else:
+                self.i_dic_pos[pos] = [pred]
+            if pred.lemma is not None:
+                slot_keys = lemma_slot_keys.get(pred.lemma, ())
+            else:
+                slot_keys = [(slot, arg) for slot, arg in enumerate(pred.args.arg_list[0:4]) if arg]
+            for slot, arg in slot_keys:
+                key = (slot, arg, pos)
+                if key in self.i_dic_slot_pos:
+                    self.i_dic_slot_pos[key].append(pred)
                 else:
-                    self.i_dic_arg_fourth[pred.args.fourth] = [pred]
+                    self.i_dic_slot_pos[key] = [pred]
 
     def find(self, first=None, second=None, third=None, fourth=None, pos=None, arg=None, extra=None, return_set=False):
+        """
+        Returns list of the matched predicates (or PredicateSet if return_set is True and pos is
+        given). The list is a copy, callers may change it without changing the index.
+        """
+        filter_pos = pos is not None and pos is not POS.NONE
+
+        if arg is None and extra is None:
+            slot_key = None
+            slot_keys = 0
+            for slot, slot_arg in enumerate((first, second, third, fourth)):
+                if slot_arg is not None:
+                    slot_key = (slot, slot_arg)
+                    slot_keys += 1
+            if slot_keys == 1 or (slot_keys == 0 and filter_pos):
+                if slot_keys == 0:
+                    matched = self.i_dic_pos.get(pos, [])
+                elif filter_pos:
+                    matched = self.i_dic_slot_pos.get((slot_key[0], slot_key[1], pos), [])
+                else:
+                    matched = self.i_dic_slots[slot_key[0]].get(slot_key[1], [])
+                if return_set and pos:
+                    return PredicateSet(matched, pos)
+                return list(matched)
+
         predicate_lists = []
         if arg is not None:
             predicate_lists.append(self.i_dic_arg.get(arg, []))
@@ -326,36 +476,55 @@ class SentenceIndex(object):
             predicate_lists.append(self.i_dic_arg_third.get(third, []))
         if fourth is not None:
             predicate_lists.append(self.i_dic_arg_fourth.get(fourth, []))
-        if pos is not None and pos is not POS.NONE:
-            predicate_lists.append(filter(lambda p: p.pos.pos == pos, self.sentence))
+        if filter_pos:
+            predicate_lists.append(self.i_dic_pos.get(pos, []))
         if len(predicate_lists) == 1:
             if return_set and pos:
                 return PredicateSet(predicate_lists[0], pos)
-            return predicate_lists[0]
+            return list(predicate_lists[0])
         else:
-            list1 = predicate_lists.pop()
-            matched = []
-            for e in list1:
-                in_intersection = True
-                for l in predicate_lists:
-                    if e not in l:
-                        in_intersection = False
-                        break
-                if in_intersection:
-                    matched.append(e)
+            matched = predicate_lists.pop()
+            for l in predicate_lists:
+                l_ids = set(id(p) for p in l)
+                l_lemmas = set(p.lemma for p in l if p.lemma is not None)
+                matched = [e for e in matched if id(e) in l_ids or (e.lemma is not None and e.lemma in l_lemmas)]
             if return_set and pos is not None:
                 return PredicateSet(matched, pos)
             return matched
 
 
 class Sentence(object):
+    """
+    LF sentence. `line` and `raw_text` may be given as undecoded UTF-8 byte strings, in that case
+    they are decoded on the first access.
+    """
 
     def __init__(self, sid, predicates, line=None, raw_text=None):
-        self.line = line
+        self._line = line
         self.predicates = predicates
         self.sid = sid
         self.index = SentenceIndex(self)
-        self.raw_text = raw_text
+        self._raw_text = raw_text
+
+    @property
+    def line(self):
+        if isinstance(self._line, str):
+            self._line = self._line.decode("utf-8")
+        return self._line
+
+    @line.setter
+    def line(self, line):
+        self._line = line
+
+    @property
+    def raw_text(self):
+        if isinstance(self._raw_text, str):
+            self._raw_text = self._raw_text.decode("utf-8")
+        return self._raw_text
+
+    @raw_text.setter
+    def raw_text(self, raw_text):
+        self._raw_text = raw_text
 
     def lemmas(self):
         lemmas = []
@@ -366,6 +535,78 @@ class Sentence(object):
 
     @staticmethod
     def from_lf_line(lf_line_index, lf_line):
+        predicates = Sentence.scan_lf_line(lf_line)
+        if predicates is None:
+            return Sentence.split_lf_line(lf_line_index, lf_line)
+        return Sentence(lf_line_index, predicates, lf_line.replace(" & ", "&"))
+
+    @staticmethod
+    def from_lf_bytes(lf_line_index, lf_line):
+        """
+        Same as Sentence.from_lf_line, but takes undecoded UTF-8 line. Only lemmas, arguments and
+        extra predicate names are decoded (once per distinct value, see decode_str), the line itself
+        is decoded only if sentence.line is accessed.
+        """
+        predicates = Sentence.scan_lf_bytes(lf_line)
+        if predicates is None:
+            return Sentence.from_lf_line(lf_line_index, lf_line.decode("utf-8"))
+        return Sentence(lf_line_index, predicates, lf_line.replace(" & ", "&"))
+
+    @staticmethod
+    def scan_lf_bytes(lf_line):
+        return Sentence.scan_lf(lf_line, LF_PREDICATE_BYTES_RE, LF_TAIL_BYTES_RE, decode_str)
+
+    @staticmethod
+    def scan_lf_line(lf_line):
+        return Sentence.scan_lf(lf_line, LF_PREDICATE_RE, LF_TAIL_RE, intern_str)
+
+    @staticmethod
+    def scan_lf(lf_line, predicate_re, tail_re, decode):
+        """
+        Parses well-formed LF line in a single pass of predicate_re. Returns None if the line has
+        anything the regular expression does not cover, so that the caller could fall back to
+        Sentence.split_lf_line which knows how to handle (or log) malformed input. Lemmas, arguments
+        and extra predicate names are passed through decode, which is intern_str for unicode lines
+        and decode_str for undecoded UTF-8 lines.
+        """
+        scanned = []
+        end = 0
+        for match in predicate_re.finditer(lf_line):
+            if match.start() != end:
+                return None
+            scanned.append(match.groups())
+            end = match.end()
+        if len(scanned) == 0 or tail_re.match(lf_line, end) is None:
+            return None
+
+        # Split parser cuts the last character of the last predicate assuming that it is ")",
+        # so the closing bracket and the trailing whitespace (except of the last character)
+        # end up in the last argument. Keep it the same.
+        tail = lf_line[end:]
+        if len(tail) > 0:
+            pid, lemma, pos, args, extra, extra_args = scanned[-1]
+            if extra is None:
+                args += ")" + tail[:-1]
+            else:
+                extra_args += ")" + tail[:-1]
+            scanned[-1] = (pid, lemma, pos, args, extra, extra_args)
+
+        predicates = []
+        for pid, lemma, pos, args, extra, extra_args in scanned:
+            if extra is None:
+                pos = POS_TAG_ID.get(pos, POS.NONE)
+                if lemma and pos:
+                    arg_list = tuple([decode(arg) if arg and arg[0] != "u" else False for arg in args.split(",")])
+                    if not isinstance(pid, unicode):
+                        pid = pid.decode("utf-8")
+                    predicates.append(Predicate.fromparts(pid, decode(lemma), pos, arg_list, None))
+            else:
+                arg_list = tuple([decode(arg) if arg and arg[0] != "u" else False for arg in extra_args.split(",")])
+                predicates.append(Predicate.fromparts(-1, None, POS.NONE, arg_list, decode(extra)))
+        return predicates
+
+    @staticmethod
+    def split_lf_line(lf_line_index, lf_line):
         predicates = []
 
         lf_line = lf_line.replace(" & ", "&")
@@ -398,16 +639,71 @@ class Sentence(object):
             yield pred
 
 
+def lf_byte_ranges(lf_file, n_ranges):
+    """
+    Splits seekable LF file into at most `n_ranges` (start, end) byte ranges of roughly equal size.
+    Every range starts on a sentence boundary: a "%" comment header or the first line after a blank
+    line, so ranges can be read independently with MetaphorAdpLF_Reader.
+    """
+    lf_file.seek(0, 2)
+    size = lf_file.tell()
+    cuts = [0]
+    for k in xrange(1, n_ranges):
+        lf_file.seek(max(size * k / n_ranges, cuts[-1]))
+        lf_file.readline()
+        prev_blank = False
+        while True:
+            position = lf_file.tell()
+            line = lf_file.readline()
+            if not line:
+                position = size
+                break
+            blank = len(line.strip()) == 0
+            if line[0] == "%" or (prev_blank and not blank):
+                break
+            prev_blank = blank
+        if position > cuts[-1]:
+            cuts.append(position)
+    if size > cuts[-1]:
+        cuts.append(size)
+    lf_file.seek(0)
+    return zip(cuts[:-1], cuts[1:])
+
+
 class MetaphorAdpLF_Reader(object):
+    """
+    Reads Metaphor-ADP LF file. With lazy=True lines are parsed without decoding: sentences keep
+    `line` and `raw_text` as UTF-8 bytes until they are accessed (see Sentence.from_lf_bytes).
+    """
 
-    def __init__(self, lf_file):
+    def __init__(self, lf_file, start=None, end=None, lazy=False):
         self.lf_file = lf_file
+        self.start = start
+        self.end = end
+        self.lazy = lazy
+
+    def i_lines(self):
+        if self.start is None and self.end is None:
+            return iter(self.lf_file)
+        return self.i_range_lines()
+
+    def i_range_lines(self):
+        self.lf_file.seek(self.start or 0)
+        while self.end is None or self.lf_file.tell() < self.end:
+            line = self.lf_file.readline()
+            if not line:
+                break
+            yield line
 
     def i_sentences(self):
         i = 0
         text = None
-        for line in self.lf_file:
-            line = line.decode("utf-8")
+        lazy = self.lazy
+        for line in self.i_lines():
+            # Lines starting with a non-ASCII character are always decoded, so that isdigit() and
+            # len() checks below work the same way in both modes.
+            if not lazy or line[0] >= "\x80":
+                line = line.decode("utf-8")
             if line[0] == "%":
                 if len(line) >= 3 and line[0:3] == "%%%":
                     text = line[4:len(line)]
@@ -418,7 +714,10 @@ class MetaphorAdpLF_Reader(object):
             elif line[0].isdigit():
                 continue
             elif len(line) > 1:
-                sentence = Sentence.from_lf_line(i, line)
+                if isinstance(line, str):
+                    sentence = Sentence.from_lf_bytes(i, line)
+                else:
+                    sentence = Sentence.from_lf_line(i, line)
                 sentence.raw_text = text
                 i += 1
                 yield sentence
@@ -15,7 +15,9 @@ import threading
 import multiprocessing
 
 
-from mokujin.logicalform import MetaphorAdpLF_Reader, POS
+from mokujin.logicalform import POS
+from mokujin.lfcorpus import lf_reader
+from mokujin.streams import open_input
 
 
 class SourceTargetSearcher(object):
@@ -175,8 +177,8 @@ class ParallelReader(object):
                 return
             else:
                 logging.info("START READING %s FILE" % item)
-                fl_file = open(item, "r")
-                reader = MetaphorAdpLF_Reader(fl_file)
+                fl_file = open_input(item)
+                reader = lf_reader(fl_file, lazy=True)
                 for sent in reader.i_sentences():
                     o_queue.put(sent, block=True)
                 logging.info("READING DONE %s FILE" % item)
@@ -7,14 +7,53 @@
 # For more information, see README.md
 # For license information, see LICENSE
 
+"""
+Posting list codecs.
+
+Version 1 (legacy) posting list is an 8-byte count, one byte per argument position and 8-byte
+tuple id deltas.
+
+Version 2 posting list is a (version, count) header, a skip table and blocks of PLIST_BLOCK_SIZE
+postings. Skip entry of a block is the (last tuple id, offset) pair, offset is relative to the end
+of the skip table, so that a range of tuple ids can be decoded without touching other blocks (lists
+of one block have no skip table).
+
+Block is the first tuple id of the block (variable-byte delta from the last id of the previous
+block), the smallest delta between the consecutive tuple ids of the block (variable-byte), a width
+byte, the deltas minus the smallest one as little endian unsigned integers of `width` bytes each
+(0 to 8, the smallest which fits the largest of them) and one byte per argument position.
+If all postings of the block have the same argument position (e.g. in the sub-lists of one
+position), the SAME_POS bit of the width byte is set and the position is stored once. Deltas of a
+block are unpacked by one struct call (widths of 3, 5, 6 and 7 bytes, which are rare, one by one);
+ids of blocks of evenly spaced tuple ids (e.g. consecutive) take no bytes at all.
+
+Legacy lists are recognised by their length, which is exactly 8 + 9 * count. Read as a legacy
+count, version 2 header is at least 256 times the number of postings, which never fits the list.
+"""
+
+import heapq
 import array
+import bisect
+import struct
 import string
+import itertools
 
 ALPHABET = string.ascii_letters
 ALPHABET_REVERSE = dict((c, i) for (i, c) in enumerate(ALPHABET))
 BASE = len(ALPHABET)
 LONG_SIZE = 8
 
+PLIST_V1 = 1
+PLIST_V2 = 2
+PLIST_BLOCK_SIZE = 128
+LEGACY_HEADER = struct.Struct("=Q")
+PLIST_HEADER = struct.Struct("=BI")
+PLIST_SKIP = struct.Struct("=QI")
+DELTA_FORMATS = {1: "<%dB", 2: "<%dH", 4: "<%dI", 8: "<%dQ"}
+DELTA_STRUCTS = {}                      # (width, number of deltas) -> struct.Struct
+WIDE_DELTA = struct.Struct("<Q")
+SAME_POS = 0x80
+
 
 def encode_uint(uint_val):
     s = []
@@ -55,12 +94,122 @@ def encode_plist(plist):
         tid_arr[i] = plist[i][0]
         pos_arr[i] = plist[i][1]
         i += 1
+    return encode_plist_arrays(tid_arr, pos_arr)
+
+
+def encode_varint(uint_val):
+    s = []
+    while uint_val >= 0x80:
+        s.append(chr(uint_val & 0x7F | 0x80))
+        uint_val >>= 7
+    s.append(chr(uint_val))
+    return "".join(s)
+
+
+def decode_varint(data, offset):
+    """
+    Returns decoded value and the offset of the next byte.
+    """
+    uint_val = 0
+    shift = 0
+    while True:
+        byte = ord(data[offset])
+        offset += 1
+        uint_val |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return uint_val, offset
+        shift += 7
+
+
+def delta_struct(width, n_deltas):
+    delta_st = DELTA_STRUCTS.get((width, n_deltas))
+    if delta_st is None:
+        delta_st = DELTA_STRUCTS[(width, n_deltas)] = struct.Struct(DELTA_FORMATS[width] % n_deltas)
+    return delta_st
+
+
+def pack_deltas(deltas, width):
+    """
+    Packs non-negative deltas into `width` bytes each (little endian).
+    """
+    if not width or not deltas:
+        return ""
+    if width in DELTA_FORMATS:
+        return delta_struct(width, len(deltas)).pack(*deltas)
+    return "".join(WIDE_DELTA.pack(delta)[:width] for delta in deltas)
+
+
+def unpack_deltas(data, offset, width, n_deltas):
+    """
+    Unpacks n_deltas deltas packed by pack_deltas, widths of DELTA_FORMATS are unpacked by one call.
+    """
+    if width in DELTA_FORMATS:
+        return delta_struct(width, n_deltas).unpack_from(data, offset)
+    padding = "\0" * (WIDE_DELTA.size - width)
+    return [WIDE_DELTA.unpack(data[start:(start + width)] + padding)[0]
+            for start in xrange(offset, offset + n_deltas * width, width)]
+
+
+def encode_plist_arrays(tid_arr, pos_arr):
+    """
+    Same as encode_plist for the posting list given as array("l") of sorted tuple ids and
+    array("B") of argument positions. Raises ValueError if tuple ids are negative or not sorted.
+    """
+    skips = []
+    blocks = []
+    offset = 0
+    last_tid = 0
+    for start in xrange(0, len(tid_arr), PLIST_BLOCK_SIZE):
+        block_tids = tid_arr[start:(start + PLIST_BLOCK_SIZE)]
+        deltas = [tid - prev_tid for prev_tid, tid in itertools.izip(block_tids, block_tids[1:])]
+        min_delta = min(deltas) if deltas else 0
+        if block_tids[0] < last_tid or min_delta < 0:
+            if tid_arr[0] < 0:
+                raise ValueError("Tuple ids should be non-negative, got %d." % tid_arr[0])
+            raise ValueError("Tuple ids should be sorted, got unsorted ids in postings %d-%d."
+                             % (max(0, start - 1), start + len(block_tids) - 1))
+        if min_delta:
+            deltas = [delta - min_delta for delta in deltas]
+        width = (max(deltas).bit_length() + 7) / 8 if deltas else 0
+        block_poss = pos_arr[start:(start + PLIST_BLOCK_SIZE)]
+        if block_poss.count(block_poss[0]) == len(block_poss):
+            width |= SAME_POS
+            block_poss = block_poss[:1]
+        block = encode_varint(block_tids[0] - last_tid) + \
+                encode_varint(min_delta) + \
+                chr(width) + \
+                pack_deltas(deltas, width & ~SAME_POS) + \
+                block_poss.tostring()
+        skips.append(PLIST_SKIP.pack(block_tids[-1], offset))
+        blocks.append(block)
+        offset += len(block)
+        last_tid = block_tids[-1]
+    if len(blocks) == 1:
+        return PLIST_HEADER.pack(PLIST_V2, len(tid_arr)) + blocks[0]
+    return PLIST_HEADER.pack(PLIST_V2, len(tid_arr)) + "".join(skips) + "".join(blocks)
+
+
+def encode_plist_v1(tid_arr, pos_arr):
+    """
+    Legacy encoding of the posting list, tuple ids array is delta encoded in place.
+    """
     delta_encode(tid_arr)
-    sz = array.array("L", [len(plist)])
+    sz = array.array("L", [len(tid_arr)])
     return sz.tostring() + pos_arr.tostring() + tid_arr.tostring()
 
 
-def decode_plist(plist_data):
+def plist_version(plist_data):
+    if len(plist_data) >= LONG_SIZE:
+        sz, = LEGACY_HEADER.unpack_from(plist_data)
+        if len(plist_data) == LONG_SIZE + sz * (LONG_SIZE + 1):
+            return PLIST_V1
+    version = ord(plist_data[0])
+    if version != PLIST_V2:
+        raise ValueError("Unknown posting list version %d." % version)
+    return version
+
+
+def decode_plist_v1(plist_data):
     sz = array.array("L")
     sz.fromstring(plist_data[:LONG_SIZE])
     sz = sz[0]
@@ -69,24 +218,182 @@ def decode_plist(plist_data):
     pos_arr.fromstring(plist_data[LONG_SIZE:(LONG_SIZE + sz)])
     tid_arr.fromstring(plist_data[(LONG_SIZE + sz):])
     delta_decode(tid_arr)
-    return zip(tid_arr, pos_arr)
+    return tid_arr, pos_arr
 
 
-def update_plist(plist_data, new_plist):
-    sz = array.array("L")
-    sz.fromstring(plist_data[:LONG_SIZE])
-    sz = sz[0]
+def skip_table_size(sz):
+    n_blocks = (sz + PLIST_BLOCK_SIZE - 1) / PLIST_BLOCK_SIZE
+    return n_blocks, n_blocks * PLIST_SKIP.size if n_blocks > 1 else 0
+
+
+def decode_block(plist_data, offset, block_sz, last_tid, tid_arr, pos_arr):
+    """
+    Appends tuple ids and argument positions of the block to the arrays, returns the end offset
+    of the block.
+    """
+    # Variable-byte numbers of one and two bytes are read inline.
+    tid = ord(plist_data[offset])
+    if tid < 0x80:
+        offset += 1
+    elif ord(plist_data[offset + 1]) < 0x80:
+        tid = (tid & 0x7F) | (ord(plist_data[offset + 1]) << 7)
+        offset += 2
+    else:
+        tid, offset = decode_varint(plist_data, offset)
+    tid += last_tid
+    min_delta = ord(plist_data[offset])
+    if min_delta < 0x80:
+        offset += 1
+    else:
+        min_delta, offset = decode_varint(plist_data, offset)
+    width = ord(plist_data[offset])
+    offset += 1
+    same_pos = width & SAME_POS
+    width &= ~SAME_POS
+    tid_arr.append(tid)
+    n_deltas = block_sz - 1
+    if width and n_deltas:
+        # Unpacks the deltas (see pack_deltas) and sums them up to tuple ids.
+        delta_st = DELTA_STRUCTS.get((width, n_deltas))
+        if delta_st is not None:
+            deltas = delta_st.unpack_from(plist_data, offset)
+        else:
+            deltas = unpack_deltas(plist_data, offset, width, n_deltas)
+        append = tid_arr.append
+        if min_delta:
+            for delta in deltas:
+                tid += delta + min_delta
+                append(tid)
+        else:
+            for delta in deltas:
+                tid += delta
+                append(tid)
+        offset += n_deltas * width
+    elif min_delta:
+        tid_arr.extend(xrange(tid + min_delta, tid + min_delta * n_deltas + 1, min_delta))
+    else:
+        tid_arr.extend([tid] * n_deltas)
+    if same_pos:
+        pos_arr.fromstring(plist_data[offset] * block_sz)
+        return offset + 1
+    pos_arr.fromstring(plist_data[offset:(offset + block_sz)])
+    return offset + block_sz
+
+
+def slice_plist(plist_arrays, start_tid, end_tid):
+    """
+    Returns postings of the decoded posting list with start_tid <= tuple id < end_tid.
+    """
+    tid_arr, pos_arr = plist_arrays
+    start = bisect.bisect_left(tid_arr, start_tid) if start_tid > 0 else 0
+    end = bisect.bisect_left(tid_arr, end_tid) if end_tid is not None else len(tid_arr)
+    if start == 0 and end == len(tid_arr):
+        return tid_arr, pos_arr
+    return tid_arr[start:end], pos_arr[start:end]
+
+
+def decode_plist_range(plist_data, start_tid=0, end_tid=None):
+    """
+    Decodes postings with start_tid <= tuple id < end_tid (till the end if end_tid is None), returns
+    array("l") of tuple ids and array("B") of argument positions. Version 2 lists are decoded
+    only in the blocks which may contain the range, found in the skip table.
+    """
+    n_blocks = 0
+    if plist_version(plist_data) == PLIST_V2:
+        _, sz = PLIST_HEADER.unpack_from(plist_data)
+        n_blocks, skips_size = skip_table_size(sz)
+    if n_blocks <= 1:
+        return slice_plist(decode_plist_arrays(plist_data), start_tid, end_tid)
+    data_start = PLIST_HEADER.size + skips_size
     tid_arr = array.array("l")
     pos_arr = array.array("B")
-    pos_arr.fromstring(plist_data[LONG_SIZE:(LONG_SIZE + sz)])
-    tid_arr.fromstring(plist_data[(LONG_SIZE + sz):])
-    delta_decode(tid_arr)
+    # Binary search of the first block with last tuple id >= start_tid.
+    lo, hi = 0, n_blocks
+    while lo < hi:
+        mid = (lo + hi) / 2
+        if PLIST_SKIP.unpack_from(plist_data, PLIST_HEADER.size + mid * PLIST_SKIP.size)[0] < start_tid:
+            lo = mid + 1
+        else:
+            hi = mid
+    last_tid = PLIST_SKIP.unpack_from(plist_data, PLIST_HEADER.size + (lo - 1) * PLIST_SKIP.size)[0] if lo else 0
+    for block_no in xrange(lo, n_blocks):
+        if end_tid is not None and last_tid >= end_tid:
+            break
+        block_last_tid, offset = PLIST_SKIP.unpack_from(plist_data, PLIST_HEADER.size + block_no * PLIST_SKIP.size)
+        block_sz = min(PLIST_BLOCK_SIZE, sz - block_no * PLIST_BLOCK_SIZE)
+        block_tids = array.array("l")
+        block_poss = array.array("B")
+        decode_block(plist_data, data_start + offset, block_sz, last_tid, block_tids, block_poss)
+        block_tids, block_poss = slice_plist((block_tids, block_poss), start_tid, end_tid)
+        tid_arr.extend(block_tids)
+        pos_arr.extend(block_poss)
+        last_tid = block_last_tid
+    return tid_arr, pos_arr
+
+
+def decode_plist_arrays(plist_data):
+    """
+    Decodes posting list of any version into array("l") of tuple ids and array("B") of argument
+    positions.
+    """
+    if plist_version(plist_data) == PLIST_V1:
+        return decode_plist_v1(plist_data)
+    _, sz = PLIST_HEADER.unpack_from(plist_data)
+    tid_arr = array.array("l")
+    pos_arr = array.array("B")
+    if sz <= PLIST_BLOCK_SIZE:
+        if sz:
+            decode_block(plist_data, PLIST_HEADER.size, sz, 0, tid_arr, pos_arr)
+        return tid_arr, pos_arr
+    n_blocks, skips_size = skip_table_size(sz)
+    offset = PLIST_HEADER.size + skips_size
+    last_tid = 0
+    for block_no in xrange(n_blocks):
+        block_sz = min(PLIST_BLOCK_SIZE, sz - block_no * PLIST_BLOCK_SIZE)
+        offset = decode_block(plist_data, offset, block_sz, last_tid, tid_arr, pos_arr)
+        last_tid = tid_arr[-1]
+    return tid_arr, pos_arr
+
+
+def decode_plist(plist_data):
+    tid_arr, pos_arr = decode_plist_arrays(plist_data)
+    return zip(tid_arr, pos_arr)
+
+
+def update_plist(plist_data, new_plist):
+    """
+    Adds postings to the encoded posting list, postings are merged in the tuple id order (new
+    postings with the same tuple id go after the old ones). The result is always encoded as
+    version 2.
+    """
+    tid_arr, pos_arr = decode_plist_arrays(plist_data)
+    new_plist = sorted(new_plist, key=lambda posting: posting[0])
+    if new_plist and tid_arr and new_plist[0][0] < tid_arr[-1]:
+        postings = heapq.merge(itertools.izip(tid_arr, itertools.repeat(0), pos_arr),
+                               ((tr_id, 1, ag_pos) for tr_id, ag_pos in new_plist))
+        tid_arr, pos_arr = array.array("l"), array.array("B")
+        new_plist = [(tr_id, ag_pos) for tr_id, _, ag_pos in postings]
     for tr_id, ag_pos in new_plist:
         tid_arr.append(tr_id)
         pos_arr.append(ag_pos)
-    delta_encode(tid_arr)
-    sz = array.array("L", [sz + len(new_plist)])
-    return sz.tostring() + pos_arr.tostring() + tid_arr.tostring()
+    return encode_plist_arrays(tid_arr, pos_arr)
+
+
+def encode_plist_dir(plist_dir):
+    """
+    Encodes the directory of posting sub-lists, (argument position, posting count) pairs.
+    """
+    return "".join(chr(ag_pos) + encode_varint(count) for ag_pos, count in plist_dir)
+
+
+def decode_plist_dir(dir_data):
+    plist_dir = []
+    offset = 0
+    while offset < len(dir_data):
+        ag_pos = ord(dir_data[offset])
+        count, offset = decode_varint(dir_data, offset + 1)
+        plist_dir.append((ag_pos, count))
+    return plist_dir
 
 
 def encode_1d_plist(plist):
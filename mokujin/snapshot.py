@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Copyright (C) USC Information Sciences Institute
+# Author: Vladimir M. Zaytsev <zaytsev@usc.edu>
+# URL: <http://nlg.isi.edu/>
+# For more information, see README.md
+# For license information, see LICENSE
+
+"""
+Index snapshot, a single read-only file which is memory mapped, so that several processes can
+share its pages.
+
+File is a header, the section table (name, offset, size and CRC-32 of every section) and the
+sections, each one is aligned to 8 bytes. Sections are the files written by other modules (term
+dictionary, tuple store) and the posting table, which is a sorted key -> blob table: number of
+entries, offsets of the keys and of the values (both have one more entry than the table), the keys
+and the values. CRC-32 of the header and the section table is checked on every open, checksums of
+the sections only by Snapshot.verify, which reads the whole file.
+"""
+
+import os
+import mmap
+import zlib
+import array
+import shutil
+import struct
+import tempfile
+
+
+MAGIC = "MKJSNAPS"
+VERSION = 1
+HEADER = struct.Struct("=8sIII")        # magic, version, sections, CRC-32 of the section table
+SECTION = struct.Struct("=16sQQI4x")    # name, offset, size, CRC-32
+COUNT = struct.Struct("=Q")
+OFFSET = struct.Struct("=Q")
+OFFSET_PAIR = struct.Struct("=QQ")
+COPY_BUFFER_SIZE = 1024 * 1024
+OFFSET_CHUNK = 65536                    # Offsets packed at once by write_offsets.
+
+
+def align(offset):
+    return (offset + 7) & ~7
+
+
+def table_crc(version, section_table):
+    return zlib.crc32(struct.pack("=I", version) + section_table) & 0xFFFFFFFF
+
+
+def file_crc(path):
+    crc = 0
+    with open(path, "rb") as section_file:
+        for chunk in iter(lambda: section_file.read(COPY_BUFFER_SIZE), ""):
+            crc = zlib.crc32(chunk, crc)
+    return crc & 0xFFFFFFFF
+
+
+def write_snapshot(path, sections):
+    """
+    Writes snapshot of the sections given as (name, file path) pairs. File is written under a
+    temporary name and renamed, so that processes which have the old snapshot mapped keep it.
+    """
+    section_table = []
+    offset = align(HEADER.size + len(sections) * SECTION.size)
+    for name, section_path in sections:
+        size = os.path.getsize(section_path)
+        section_table.append(SECTION.pack(name, offset, size, file_crc(section_path)))
+        offset = align(offset + size)
+    section_table = "".join(section_table)
+    tmp_path = "%s.tmp" % path
+    with open(tmp_path, "wb") as snapshot_file:
+        snapshot_file.write(HEADER.pack(MAGIC, VERSION, len(sections), table_crc(VERSION, section_table)))
+        snapshot_file.write(section_table)
+        for _, section_path in sections:
+            snapshot_file.write("\0" * (align(snapshot_file.tell()) - snapshot_file.tell()))
+            with open(section_path, "rb") as section_file:
+                shutil.copyfileobj(section_file, snapshot_file, COPY_BUFFER_SIZE)
+        snapshot_file.write("\0" * (align(snapshot_file.tell()) - snapshot_file.tell()))
+    os.rename(tmp_path, path)
+
+
+class Snapshot(object):
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as snapshot_file:
+            self.data = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.data) < HEADER.size:
+            raise ValueError("%s is not an index snapshot." % path)
+        magic, version, n_sections, crc = HEADER.unpack_from(self.data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not an index snapshot of version %d." % (path, VERSION))
+        section_table = self.data[HEADER.size:(HEADER.size + n_sections * SECTION.size)]
+        if len(section_table) != n_sections * SECTION.size or table_crc(version, section_table) != crc:
+            raise ValueError("%s has a corrupted section table." % path)
+        self.sections = {}
+        for i in xrange(n_sections):
+            name, offset, size, crc = SECTION.unpack_from(section_table, i * SECTION.size)
+            if offset + size > len(self.data):
+                raise ValueError("%s is truncated." % path)
+            self.sections[name.rstrip("\0")] = (offset, size, crc)
+
+    def section_offset(self, name):
+        if name not in self.sections:
+            raise ValueError("%s has no %s section." % (self.path, name))
+        return self.sections[name][0]
+
+    def verify(self):
+        """
+        Checks CRC-32 of every section, raises ValueError if some of them is corrupted.
+        """
+        for name, (offset, size, crc) in sorted(self.sections.iteritems()):
+            section_crc = 0
+            for chunk_offset in xrange(offset, offset + size, COPY_BUFFER_SIZE):
+                section_crc = zlib.crc32(self.data[chunk_offset:min(chunk_offset + COPY_BUFFER_SIZE, offset + size)],
+                                         section_crc)
+            if section_crc & 0xFFFFFFFF != crc:
+                raise ValueError("%s section of %s is corrupted." % (name, self.path))
+
+    def close(self):
+        self.data.close()
+
+
+def write_offsets(table_file, offsets):
+    """
+    Writes offsets as OFFSET numbers, the size of array("L") items depends on the platform.
+    """
+    for start in xrange(0, len(offsets), OFFSET_CHUNK):
+        chunk = offsets[start:(start + OFFSET_CHUNK)]
+        table_file.write(struct.pack("=%dQ" % len(chunk), *chunk))
+
+
+def write_posting_table(path, items, tmp_dir=None):
+    """
+    Writes (key, value) items, sorted by key, as a posting table. Values are written to a temporary
+    file first, only the keys and the offsets are kept in memory.
+    """
+    key_offsets = array.array("L", [0])
+    value_offsets = array.array("L", [0])
+    keys = []
+    prev_key = None
+    values_file = tempfile.TemporaryFile(prefix="mokujin-snapshot-", dir=tmp_dir)
+    try:
+        for key, value in items:
+            if prev_key is not None and key <= prev_key:
+                raise ValueError("Posting table keys should be sorted, got %r after %r." % (key, prev_key))
+            keys.append(key)
+            key_offsets.append(key_offsets[-1] + len(key))
+            values_file.write(value)
+            value_offsets.append(value_offsets[-1] + len(value))
+            prev_key = key
+        values_file.seek(0)
+        with open(path, "wb") as table_file:
+            table_file.write(COUNT.pack(len(keys)))
+            write_offsets(table_file, key_offsets)
+            write_offsets(table_file, value_offsets)
+            table_file.write("".join(keys))
+            shutil.copyfileobj(values_file, table_file, COPY_BUFFER_SIZE)
+    finally:
+        values_file.close()
+
+
+class PostingTable(object):
+    """
+    Read-only key -> blob posting table of the snapshot, it can be used instead of plist.ldb.
+    """
+
+    def __init__(self, data, offset):
+        self.data = data
+        self.size = COUNT.unpack_from(data, offset)[0]
+        self.key_offsets_start = offset + COUNT.size
+        self.value_offsets_start = self.key_offsets_start + (self.size + 1) * OFFSET.size
+        self.keys_start = self.value_offsets_start + (self.size + 1) * OFFSET.size
+        self.values_start = self.keys_start + OFFSET.unpack_from(data, self.value_offsets_start - OFFSET.size)[0]
+
+    def __len__(self):
+        return self.size
+
+    def key(self, i):
+        start, end = OFFSET_PAIR.unpack_from(self.data, self.key_offsets_start + i * OFFSET.size)
+        return self.data[(self.keys_start + start):(self.keys_start + end)]
+
+    def value(self, i):
+        start, end = OFFSET_PAIR.unpack_from(self.data, self.value_offsets_start + i * OFFSET.size)
+        return self.data[(self.values_start + start):(self.values_start + end)]
+
+    def get(self, key, default=None):
+        key_at = self.key
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) / 2
+            if key_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.size and key_at(lo) == key:
+            return self.value(lo)
+        return default
+
+    def __iter__(self):
+        for i in xrange(self.size):
+            yield self.key(i), self.value(i)
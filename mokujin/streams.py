@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Copyright (C) USC Information Sciences Institute
+# Author: Vladimir M. Zaytsev <zaytsev@usc.edu>
+# URL: <http://nlg.isi.edu/>
+# For more information, see README.md
+# For license information, see LICENSE
+
+"""
+Transparent decompression of input files.
+
+open_input() detects the codec of the file by its magic bytes and returns file-like object with
+decompressed data. Decompression runs in a separate process (gzip, bzip2, xz, lz4 or zstd command
+line tool) or, if the tool is not available, in a background thread. Decompressed data is passed
+through a pipe, so decompression overlaps with parsing, the buffer between them is bounded by the
+pipe capacity and nothing is written to disk. Uncompressed files are opened as is.
+"""
+
+import os
+import sys
+import bz2
+import zlib
+import errno
+import logging
+import threading
+import subprocess
+
+
+MAGIC_SIZE = 6
+CHUNK_SIZE = 1 << 16
+
+CODECS = (
+    # name,  magic bytes,              decompression command
+    ("gzip", "\x1f\x8b", ("gzip", "-dc")),
+    ("bzip2", "BZh", ("bzip2", "-dc")),
+    ("xz", "\xfd7zXZ\x00", ("xz", "-dc")),
+    ("lz4", "\x04\x22\x4d\x18", ("lz4", "-dc")),
+    ("zstd", "\x28\xb5\x2f\xfd", ("zstd", "-dc")),
+)
+
+
+def detect_codec(head):
+    for name, magic, command in CODECS:
+        if head.startswith(magic):
+            return name, command
+    return None, None
+
+
+def input_codec(path):
+    """
+    Returns name of the codec the given file is compressed with or None for uncompressed files.
+    """
+    with open(path, "rb") as i_file:
+        return detect_codec(i_file.read(MAGIC_SIZE))[0]
+
+
+def read_head(fd):
+    head = ""
+    while len(head) < MAGIC_SIZE:
+        data = os.read(fd, MAGIC_SIZE - len(head))
+        if not data:
+            break
+        head += data
+    return head
+
+
+def i_chunks(fd, head=""):
+    try:
+        if head:
+            yield head
+        while True:
+            data = os.read(fd, CHUNK_SIZE)
+            if not data:
+                return
+            yield data
+    finally:
+        os.close(fd)
+
+
+def i_gzip_decompress(i_chunks):
+    # Handles concatenated gzip members, e.g. files written by several `gzip >> file` calls.
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in i_chunks:
+        while chunk:
+            yield decompressor.decompress(chunk)
+            chunk = decompressor.unused_data
+            if chunk:
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    # After the end of the stream more input goes to unused_data, otherwise the input was truncated.
+    try:
+        probe = decompressor.copy()
+        probe.decompress("\x00")
+        complete = probe.unused_data == "\x00"
+    except zlib.error:
+        complete = False
+    yield decompressor.flush()
+    if not complete:
+        raise IOError("Unexpected end of gzip stream.")
+
+
+def i_bzip2_decompress(i_chunks):
+    decompressor = bz2.BZ2Decompressor()
+    for chunk in i_chunks:
+        while chunk:
+            try:
+                yield decompressor.decompress(chunk)
+            except EOFError:
+                decompressor = bz2.BZ2Decompressor()
+                continue
+            chunk = decompressor.unused_data
+            if chunk:
+                decompressor = bz2.BZ2Decompressor()
+    # The decompressor refuses more input only after the end of the stream.
+    try:
+        decompressor.decompress("B")
+    except EOFError:
+        return
+    except IOError:
+        pass
+    raise IOError("Unexpected end of bzip2 stream.")
+
+
+THREAD_DECOMPRESSORS = {
+    "gzip": i_gzip_decompress,
+    "bzip2": i_bzip2_decompress,
+}
+
+
+class InputStream(object):
+    """
+    Read end of the decompression pipe. Behaves like a file opened for reading and raises IOError
+    at the end of data if the decompressor failed, so that truncated input is not silently accepted.
+    """
+
+    def __init__(self, pipe, name, codec, process=None, threads=()):
+        self.pipe = pipe
+        self.name = name
+        self.codec = codec
+        self.process = process
+        self.threads = threads
+        self.errors = []
+
+    def check(self):
+        for thread in self.threads:
+            thread.join()
+        if self.process is not None and self.process.wait() != 0:
+            self.errors.append("%s exited with code %d" % (self.codec, self.process.returncode))
+        if self.errors:
+            raise IOError("Failed to decompress %s: %s" % (self.name, "; ".join(map(str, self.errors))))
+
+    def read(self, size=-1):
+        data = self.pipe.read(size)
+        if not data and size != 0:
+            self.check()
+        return data
+
+    def readline(self, size=-1):
+        line = self.pipe.readline(size)
+        if not line:
+            self.check()
+        return line
+
+    def __iter__(self):
+        for line in self.pipe:
+            yield line
+        self.check()
+
+    def fileno(self):
+        return self.pipe.fileno()
+
+    def close(self):
+        self.pipe.close()
+        if self.process is not None:
+            if self.process.poll() is None:
+                self.process.terminate()
+            self.process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __repr__(self):
+        return "<%s input %r>" % (self.codec, self.name)
+
+
+def start_thread(target, stream, *args):
+    def run():
+        try:
+            target(*args)
+        except Exception as e:
+            if not (isinstance(e, (IOError, OSError)) and e.errno == errno.EPIPE):
+                stream.errors.append(e)
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def write_chunks(i_chunks, o_fd):
+    try:
+        for chunk in i_chunks:
+            while chunk:
+                chunk = chunk[os.write(o_fd, chunk):]
+    finally:
+        os.close(o_fd)
+
+
+def open_input(path=None, buffer_size=CHUNK_SIZE):
+    """
+    Opens input file (stdin if path is None or "-") for reading, decompressing it if it is gzip,
+    bzip2, xz, lz4 or zstd compressed. Uncompressed regular files are returned as ordinary (seekable)
+    file objects.
+    """
+    if path is None or path == "-":
+        name = "<stdin>"
+        fd = os.dup(sys.stdin.fileno())
+    else:
+        name = path
+        fd = os.open(path, os.O_RDONLY)
+    head = read_head(fd)
+    try:
+        os.lseek(fd, 0, os.SEEK_SET)
+        seekable = True
+        head_left = ""
+    except OSError:
+        seekable = False
+        head_left = head
+    codec, command = detect_codec(head)
+
+    if codec is None and seekable:
+        return os.fdopen(fd, "rb", buffer_size)
+
+    if codec is None:
+        # Non-seekable plain input (e.g. a pipe): pass the already read magic bytes and the rest.
+        r_fd, w_fd = os.pipe()
+        stream = InputStream(os.fdopen(r_fd, "rb", buffer_size), name, "plain")
+        stream.threads = (start_thread(write_chunks, stream, i_chunks(fd, head_left), w_fd), )
+        return stream
+
+    logging.info("DECOMPRESSING %s (%s)" % (name, codec))
+    try:
+        process = subprocess.Popen(command,
+                                   stdin=fd if seekable else subprocess.PIPE,
+                                   stdout=subprocess.PIPE,
+                                   bufsize=buffer_size,
+                                   close_fds=True)
+    except OSError:
+        process = None
+    if process is not None:
+        stream = InputStream(process.stdout, name, codec, process=process)
+        if not seekable:
+            w_fd = os.dup(process.stdin.fileno())
+            process.stdin.close()
+            stream.threads = (start_thread(write_chunks, stream, i_chunks(fd, head_left), w_fd), )
+        else:
+            os.close(fd)
+        return stream
+
+    decompress = THREAD_DECOMPRESSORS.get(codec)
+    if decompress is None:
+        os.close(fd)
+        raise IOError("Can not decompress %s: %r command is not available." % (name, command[0]))
+    r_fd, w_fd = os.pipe()
+    stream = InputStream(os.fdopen(r_fd, "rb", buffer_size), name, codec)
+    stream.threads = (start_thread(write_chunks, stream, decompress(i_chunks(fd, head_left)), w_fd), )
+    return stream
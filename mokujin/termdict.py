@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Copyright (C) USC Information Sciences Institute
+# Author: Vladimir M. Zaytsev <zaytsev@usc.edu>
+# URL: <http://nlg.isi.edu/>
+# For more information, see README.md
+# For license information, see LICENSE
+
+"""
+Static term dictionary, memory mapped, so that opening it is instant and its pages are shared by
+all processes which use the same index.
+
+File is a header, offsets of the string blocks, term ids in the sorted order (rank -> id), ranks
+of the term ids (id -> rank) and the sorted terms. Terms are front coded in blocks of
+RESTART_INTERVAL terms: the first term of a block is stored as (length, bytes), the others as
+(shared prefix length, suffix length, suffix bytes), lengths are variable-byte numbers. Term is
+found by a binary search over the first terms of the blocks and a scan of one block.
+"""
+
+import mmap
+import array
+import struct
+
+from mokujin.numencode import encode_varint, decode_varint
+
+
+MAGIC = "MKJTERMS"
+VERSION = 1
+RESTART_INTERVAL = 16
+HEADER = struct.Struct("=8sIIQQ")       # magic, version, restart interval, terms, blocks
+OFFSET = struct.Struct("=Q")
+TERM_ID = struct.Struct("=I")
+
+
+def common_prefix_size(str_1, str_2):
+    size = min(len(str_1), len(str_2))
+    i = 0
+    while i < size and str_1[i] == str_2[i]:
+        i += 1
+    return i
+
+
+def write_term_dict(term2id, path, restart_interval=RESTART_INTERVAL):
+    """
+    Writes term -> id map, ids should be 0 ... len(term2id) - 1.
+    """
+    encoded = sorted((term.encode("utf-8") if isinstance(term, unicode) else term, term_id)
+                     for term, term_id in term2id.iteritems())
+    terms = [term for term, _ in encoded]
+    rank_ids = array.array("I", [term_id for _, term_id in encoded])
+    id_ranks = array.array("I", [0]) * len(terms)
+    for rank, term_id in enumerate(rank_ids):
+        if term_id >= len(terms):
+            raise ValueError("Term ids should be dense, got %d for %d terms." % (term_id, len(terms)))
+        id_ranks[term_id] = rank
+    blocks = []
+    block_offsets = []
+    offset = 0
+    for start in xrange(0, len(terms), restart_interval):
+        block_terms = terms[start:(start + restart_interval)]
+        block = [encode_varint(len(block_terms[0])), block_terms[0]]
+        for prev_term, term in zip(block_terms, block_terms[1:]):
+            shared = common_prefix_size(prev_term, term)
+            block.append(encode_varint(shared))
+            block.append(encode_varint(len(term) - shared))
+            block.append(term[shared:])
+        block = "".join(block)
+        block_offsets.append(offset)
+        blocks.append(block)
+        offset += len(block)
+    with open(path, "wb") as dict_file:
+        dict_file.write(HEADER.pack(MAGIC, VERSION, restart_interval, len(terms), len(blocks)))
+        for block_offset in block_offsets:
+            dict_file.write(OFFSET.pack(block_offset))
+        dict_file.write(rank_ids.tostring())
+        dict_file.write(id_ranks.tostring())
+        for block in blocks:
+            dict_file.write(block)
+
+
+class TermDict(object):
+
+    def __init__(self, path, data=None, offset=0):
+        """
+        Maps the dictionary file or, if data is given, reads the dictionary from the data (mapped
+        snapshot) at the offset.
+        """
+        self.path = path
+        self.own_data = data is None
+        if data is None:
+            with open(path, "rb") as dict_file:
+                data = mmap.mmap(dict_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.data = data
+        magic, version, self.restart_interval, self.size, self.n_blocks = HEADER.unpack_from(data, offset)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a term dictionary of version %d." % (path, VERSION))
+        self.offsets_start = offset + HEADER.size
+        self.rank_ids_start = self.offsets_start + self.n_blocks * OFFSET.size
+        self.id_ranks_start = self.rank_ids_start + self.size * TERM_ID.size
+        self.blocks_start = self.id_ranks_start + self.size * TERM_ID.size
+        self.term_id_map = TermIdMap(self)
+        self.id_term_map = IdTermMap(self)
+
+    def __len__(self):
+        return self.size
+
+    def read_varint(self, offset):
+        # Lengths of the most of the terms fit in one byte.
+        byte = ord(self.data[offset])
+        if byte < 0x80:
+            return byte, offset + 1
+        return decode_varint(self.data, offset)
+
+    def block_start(self, block_no):
+        return self.blocks_start + OFFSET.unpack_from(self.data, self.offsets_start + block_no * OFFSET.size)[0]
+
+    def i_block_terms(self, block_no):
+        data = self.data
+        read_varint = self.read_varint
+        size, offset = read_varint(self.block_start(block_no))
+        term = data[offset:(offset + size)]
+        offset += size
+        yield term
+        for _ in xrange(min(self.restart_interval, self.size - block_no * self.restart_interval) - 1):
+            shared, offset = read_varint(offset)
+            size, offset = read_varint(offset)
+            term = term[:shared] + data[offset:(offset + size)]
+            offset += size
+            yield term
+
+    def first_term(self, block_no):
+        size, offset = self.read_varint(self.block_start(block_no))
+        return self.data[offset:(offset + size)]
+
+    def rank(self, term):
+        """
+        Rank of the term in the sorted order or -1 if there is no such term.
+        """
+        first_term = self.first_term
+        lo, hi = 0, self.n_blocks
+        while lo < hi:
+            mid = (lo + hi) / 2
+            if first_term(mid) <= term:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == 0:
+            return -1
+        block_no = lo - 1
+        for i, block_term in enumerate(self.i_block_terms(block_no)):
+            if block_term == term:
+                return block_no * self.restart_interval + i
+            if block_term > term:
+                break
+        return -1
+
+    def term_id(self, term):
+        if isinstance(term, unicode):
+            term = term.encode("utf-8")
+        rank = self.rank(term)
+        if rank == -1:
+            return None
+        return TERM_ID.unpack_from(self.data, self.rank_ids_start + rank * TERM_ID.size)[0]
+
+    def term(self, term_id):
+        if not isinstance(term_id, (int, long)) or term_id < 0 or term_id >= self.size:
+            return None
+        rank = TERM_ID.unpack_from(self.data, self.id_ranks_start + term_id * TERM_ID.size)[0]
+        block_no, i = divmod(rank, self.restart_interval)
+        for j, term in enumerate(self.i_block_terms(block_no)):
+            if j == i:
+                return term
+
+    def i_terms(self):
+        """
+        Yields (term, term_id) pairs in the term order.
+        """
+        rank = 0
+        for block_no in xrange(self.n_blocks):
+            for term in self.i_block_terms(block_no):
+                yield term, TERM_ID.unpack_from(self.data, self.rank_ids_start + rank * TERM_ID.size)[0]
+                rank += 1
+
+    def close(self):
+        if self.own_data:
+            self.data.close()
+
+
+class TermIdMap(object):
+    """
+    Read-only dict-like term -> id view of the term dictionary.
+    """
+
+    def __init__(self, term_dict):
+        self.term_dict = term_dict
+
+    def get(self, term, default=None):
+        term_id = self.term_dict.term_id(term)
+        return term_id if term_id is not None else default
+
+    def __getitem__(self, term):
+        term_id = self.term_dict.term_id(term)
+        if term_id is None:
+            raise KeyError(term)
+        return term_id
+
+    def __contains__(self, term):
+        return self.term_dict.term_id(term) is not None
+
+    def __len__(self):
+        return len(self.term_dict)
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def iterkeys(self):
+        for term, _ in self.term_dict.i_terms():
+            yield term
+
+    def iteritems(self):
+        return self.term_dict.i_terms()
+
+    def keys(self):
+        return list(self.iterkeys())
+
+
+class IdTermMap(object):
+    """
+    Read-only dict-like id -> term view of the term dictionary.
+    """
+
+    def __init__(self, term_dict):
+        self.term_dict = term_dict
+
+    def get(self, term_id, default=None):
+        term = self.term_dict.term(term_id)
+        return term if term is not None else default
+
+    def __getitem__(self, term_id):
+        term = self.term_dict.term(term_id)
+        if term is None:
+            raise KeyError(term_id)
+        return term
+
+    def __contains__(self, term_id):
+        return isinstance(term_id, (int, long)) and 0 <= term_id < len(self.term_dict)
+
+    def __len__(self):
+        return len(self.term_dict)
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def iterkeys(self):
+        return iter(xrange(len(self.term_dict)))
+
+    def iteritems(self):
+        for term_id in xrange(len(self.term_dict)):
+            yield term_id, self.term_dict.term(term_id)
+
+    def keys(self):
+        return range(len(self.term_dict))
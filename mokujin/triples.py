@@ -7,8 +7,16 @@
 # For license information, see LICENSE
 
 
+import time
+import array
+import logging
 import collections
+
+from timeit import default_timer as timer
+
+from mokujin import extsort
 from mokujin.logicalform import POS
+from mokujin.logicalform import PredicateSet
 
 
 class AbsDependencyRelation(object):
@@ -562,34 +570,695 @@ class DepAny_Compl(AbsDependencyRelation):
 
 
 class TripleFold(object):
+    """
+    Counts triples. Triple arguments are interned: each distinct lemma_pos() string gets an int id
+    and triples are counted as (relation, id1, ..., id5) tuples, so the strings are formatted once
+    per distinct argument rather than once per match and are joined into packed triples
+    (see Triple.pack) only at output time.
+
+    With `max_entries` or `max_rss` (bytes) given the fold keeps memory bounded: when the counter
+    grows over the limit it is written to disk as a sorted (compressed) run of packed triples and
+    cleared together with the argument string table (runs hold the strings, arguments are interned
+    again after a spill), so memory does not grow with the argument vocabulary. i_triples() then
+    merges the runs summing frequencies and sorts the result by frequency externally, so the output
+    is the same as of the in-memory fold.
+    """
+    RSS_CHECK_INTERVAL = 10000
+    MIN_SPILL_ENTRIES = 10000
+    NONE_ID = 0
 
-    def __init__(self):
+    def __init__(self, max_entries=None, max_rss=None, tmp_dir=None):
         self.counter = collections.Counter()
-
-    def add_triples(self, triples):
+        self.clear_strings()
+        self.max_entries = max_entries
+        self.max_rss = max_rss
+        self.tmp_dir = tmp_dir
+        self.runs = []
+        self.added = 0
+
+    def clear_strings(self):
+        self.key_ids = dict()
+        self.string_ids = {"<->": self.NONE_ID}
+        self.strings = ["<->"]
+
+    def string_id(self, string):
+        string_id = self.string_ids.get(string)
+        if string_id is None:
+            string_id = len(self.strings)
+            self.strings.append(string)
+            self.string_ids[string] = string_id
+        return string_id
+
+    def i_keys(self, triples):
+        key_ids = self.key_ids
         for triple in triples:
-            self.counter[triple.pack()] += 1
+            key = [triple.relation]
+            for arg in (triple.arg1, triple.arg2, triple.arg3, triple.arg4, triple.arg5):
+                if arg is None:
+                    key.append(self.NONE_ID)
+                    continue
+                arg_key = arg.fold_key()
+                arg_id = key_ids.get(arg_key)
+                if arg_id is None:
+                    # Different keys may give the same string (e.g. PredicateSet lemmas order),
+                    # ids are assigned to strings.
+                    arg_id = self.string_id(arg.lemma_pos())
+                    key_ids[arg_key] = arg_id
+                key.append(arg_id)
+            yield tuple(key)
 
-    def i_triples(self):
-        for p_triple, freq in self.counter.most_common():
+    def add_triples(self, triples):
+        counter = self.counter
+        for key in self.i_keys(triples):
+            counter[key] += 1
+        if self.max_entries is not None or self.max_rss is not None:
+            self.check_memory(len(triples))
+
+    def add_packed(self, p_triple, freq):
+        parts = Triple.unpack(p_triple)
+        self.counter[tuple([parts[0]] + [self.string_id(arg) for arg in parts[1:]])] += freq
+
+    def pack(self, key):
+        strings = self.strings
+        return "<^>".join([key[0]] + [strings[arg_id] for arg_id in key[1:]])
+
+    def check_memory(self, added):
+        if self.max_entries is not None and len(self.counter) >= self.max_entries:
+            self.spill()
+        elif self.max_rss is not None:
+            self.added += added
+            if self.added >= self.RSS_CHECK_INTERVAL:
+                self.added = 0
+                if len(self.counter) >= self.MIN_SPILL_ENTRIES and extsort.current_rss() >= self.max_rss:
+                    self.spill()
+
+    def spill(self):
+        if len(self.counter) == 0:
+            return
+        logging.info("SPILLING %d TRIPLES TO DISK (RUN #%d)" % (len(self.counter), len(self.runs) + 1))
+        pack = self.pack
+        run = sorted((pack(key), freq) for key, freq in self.counter.iteritems())
+        self.runs.append(extsort.write_run(run, self.tmp_dir))
+        self.counter = collections.Counter()
+        self.clear_strings()
+
+    def merge(self, other):
+        """
+        Adds counts of another fold (ids of its arguments are mapped to ids of this fold) or counter
+        of packed triples.
+        """
+        if isinstance(other, TripleFold):
+            self.runs.extend(other.runs)
+            other.runs = []
+            id_map = [self.string_id(string) for string in other.strings]
+            for key, freq in other.counter.iteritems():
+                self.counter[tuple([key[0]] + [id_map[arg_id] for arg_id in key[1:]])] += freq
+            added = len(other.counter)
+        else:
+            for p_triple, freq in other.iteritems():
+                self.add_packed(p_triple, freq)
+            added = len(other)
+        if self.max_entries is not None or self.max_rss is not None:
+            self.check_memory(added)
+
+    def i_counts(self, remove_runs=True):
+        # Ties are ordered by the packed triple, so that the output does not depend on the order in
+        # which triples were counted (e.g. when folds of several workers are merged).
+        if not self.runs:
+            pack = self.pack
+            counts = [(pack(key), freq) for key, freq in self.counter.iteritems()]
+            counts.sort(key=lambda item: (-item[1], item[0]))
+            for p_triple, freq in counts:
+                yield p_triple, freq
+            return
+        self.spill()
+        runs, self.runs = self.runs, []
+        try:
+            logging.info("MERGING %d TRIPLE RUNS" % len(runs))
+            totals = extsort.i_sum_sorted(extsort.i_merge_runs(runs, self.tmp_dir))
+            by_freq = ((-freq, p_triple) for p_triple, freq in totals)
+            max_items = self.max_entries or self.MIN_SPILL_ENTRIES * 10
+            for neg_freq, p_triple in extsort.i_external_sort(by_freq, max_items, self.tmp_dir):
+                yield p_triple, -neg_freq
+        finally:
+            if remove_runs:
+                extsort.remove_runs(runs)
+
+    def i_triples(self, remove_runs=True):
+        """
+        Yields [relation, arg1, ..., arg5, freq] lists sorted by frequency. Run files are removed
+        after the iteration, unless `remove_runs` is False (e.g. runs persisted by a batch job).
+        """
+        for p_triple, freq in self.i_counts(remove_runs):
             triple = Triple.unpack(p_triple)
             yield triple + [freq]
 
 
+class CountMinSketch(object):
+    """
+    Count-Min sketch: `depth` rows of `width` counters. The estimate of a key count is never less
+    than its true count.
+    """
+
+    def __init__(self, width, depth=4):
+        self.width = width
+        self.depth = depth
+        self.rows = [array.array("l", [0]) * width for _ in xrange(depth)]
+
+    def add(self, key):
+        """
+        Counts one more occurrence of the key and returns estimate of its count before that.
+        """
+        h1 = hash(key)
+        h2 = (h1 >> 16) | 1
+        width = self.width
+        estimate = None
+        for i, row in enumerate(self.rows):
+            j = (h1 + i * h2) % width
+            count = row[j]
+            if estimate is None or count < estimate:
+                estimate = count
+            row[j] = count + 1
+        return estimate
+
+
+class ApproximateTripleFold(TripleFold):
+    """
+    Fixed-memory approximate fold for finding frequent triples (Space-Saving heavy hitters table
+    with a Count-Min sketch). At most 2 * `capacity` triples are counted exactly at a time; when the
+    table is full it is pruned to `capacity` most frequent triples (ties are broken by the key), the
+    largest evicted count becomes the floor. A triple (re)entering the table may have been seen that
+    many times before, so it starts with the floor (or the sketch estimate, if it is smaller) as its
+    error. Argument strings of the evicted triples are dropped on pruning and the rest are given new
+    ids, so the sketch counts triples by their strings, which do not change.
+
+    For every counted triple the true frequency is between `count - error` and `count`. Triples
+    with frequency over the final floor are always in the table.
+    """
+
+    def __init__(self, capacity, sketch_width=None, sketch_depth=4):
+        TripleFold.__init__(self)
+        self.capacity = capacity
+        self.floor = 0
+        self.errors = dict()
+        self.sketch = CountMinSketch(sketch_width, sketch_depth) if sketch_width else None
+
+    def add_triples(self, triples):
+        counter = self.counter
+        sketch = self.sketch
+        strings = self.strings
+        for key in self.i_keys(triples):
+            seen = None
+            if sketch is not None:
+                seen = sketch.add((key[0], ) + tuple([strings[arg_id] for arg_id in key[1:]]))
+            count = counter.get(key)
+            if count is not None:
+                counter[key] = count + 1
+            else:
+                error = self.floor if seen is None or seen > self.floor else seen
+                counter[key] = error + 1
+                if error:
+                    self.errors[key] = error
+        if len(counter) >= 2 * self.capacity:
+            self.prune()
+
+    def prune(self):
+        if len(self.counter) <= self.capacity:
+            return
+        ranked = sorted(self.counter.iteritems(), key=lambda item: (-item[1], item[0]))
+        self.floor = max(self.floor, ranked[self.capacity][1])
+        errors = self.errors
+        self.counter = collections.Counter(dict(ranked[:self.capacity]))
+        self.errors = dict((key, errors[key]) for key in self.counter if key in errors)
+        self.compact_strings()
+
+    def compact_strings(self):
+        """
+        Drops argument strings which no counted triple has, the rest get new ids in the order of
+        the old ones.
+        """
+        used_ids = set([self.NONE_ID])
+        for key in self.counter:
+            used_ids.update(key[1:])
+        id_map = dict((arg_id, new_id) for new_id, arg_id in enumerate(sorted(used_ids)))
+        self.strings = [self.strings[arg_id] for arg_id in sorted(used_ids)]
+        self.string_ids = dict((string, string_id) for string_id, string in enumerate(self.strings))
+        self.key_ids = dict((arg_key, id_map[arg_id]) for arg_key, arg_id in self.key_ids.iteritems()
+                            if arg_id in id_map)
+        self.counter = collections.Counter(dict((self.remap(key, id_map), count)
+                                                for key, count in self.counter.iteritems()))
+        self.errors = dict((self.remap(key, id_map), error) for key, error in self.errors.iteritems())
+
+    @staticmethod
+    def remap(key, id_map):
+        return tuple([key[0]] + [id_map[arg_id] for arg_id in key[1:]])
+
+    def merge(self, other):
+        """
+        Merges another approximate fold (mergeable summaries: a triple missing in one of the tables
+        gets floor of that table added to its count and error). The sketch is dropped, since it does
+        not cover counts of the other fold.
+        """
+        id_map = [self.string_id(string) for string in other.strings]
+        other_counter = dict()
+        for key, count in other.counter.iteritems():
+            error = other.errors.get(key, 0)
+            other_counter[tuple([key[0]] + [id_map[arg_id] for arg_id in key[1:]])] = count, error
+        counter = self.counter
+        errors = self.errors
+        for key in counter:
+            count, error = other_counter.pop(key, (other.floor, other.floor))
+            counter[key] += count
+            error += errors.get(key, 0)
+            if error:
+                errors[key] = error
+        for key, (count, error) in other_counter.iteritems():
+            counter[key] = count + self.floor
+            if error + self.floor:
+                errors[key] = error + self.floor
+        self.floor += other.floor
+        self.sketch = None
+        self.prune()
+
+    def i_estimates(self, min_freq=1):
+        """
+        Yields (packed triple, count, error) in the same order as TripleFold.i_counts.
+        """
+        pack = self.pack
+        counts = [(pack(key), count) for key, count in self.counter.iteritems() if count >= min_freq]
+        counts.sort(key=lambda item: (-item[1], item[0]))
+        errors = dict((pack(key), error) for key, error in self.errors.iteritems())
+        for p_triple, count in counts:
+            yield p_triple, count, errors.get(p_triple, 0)
+
+    def i_counts(self, remove_runs=True):
+        for p_triple, count, _ in self.i_estimates():
+            yield p_triple, count
+
+
+class FusedRelationMatcher(object):
+    """
+    Matches several relations at once. Instead of letting every relation scan the sentence on its
+    own, it makes one pass over the predicates of each head type (verbs, adverbs, adjectives, nouns,
+    prepositions, `equal` and `compl` predicates) and matches all relations sharing that head,
+    computing common lookups (e.g. the subject set of a verb) only once per sentence. Lookups are
+    made directly in SentenceIndex dictionaries, see SentenceIndex.find for their semantics.
+
+    Relations from FUSED_RELATIONS are compiled into the fused passes, any other relation is matched
+    with its own find_matches(). The result is the same list of triples, in the same order, as
+    concatenated find_matches() results of the given relations.
+    """
+
+    def __init__(self, triple_patterns):
+        self.triple_patterns = tuple(triple_patterns)
+        self.other = []
+        slots = dict()
+        for i, pattern in enumerate(self.triple_patterns):
+            if type(pattern) in FUSED_RELATIONS and type(pattern) not in slots:
+                slots[type(pattern)] = (i, pattern)
+            else:
+                self.other.append((i, pattern))
+        self.fused = [i for i, _ in slots.itervalues()]
+
+        def compile_slots(*relation_classes):
+            compiled = tuple(slots.get(relation_class, (None, None)) for relation_class in relation_classes)
+            return compiled if any(i is not None for i, _ in compiled) else None
+
+        self.verb_slots = compile_slots(DepVerb_SubjVerbDirobj,
+                                        DepVerb_SubjVerbIndirobj,
+                                        DepVerb_SubjVerbInstr,
+                                        DepVerb_SubjVerb,
+                                        DepVerb_PrepCompl,
+                                        DepVerb_SubjVerbVerbPrepNoun,
+                                        DepVerb_SubjVerbVerb)
+        self.adj_slots = compile_slots(DepAdj_NounAdj)
+        self.adv_slots = compile_slots(DepAdv_VerbNounAdv)
+        self.equal_slots = compile_slots(DepNoun_NounEqualPrepNoun, DepNoun_NounEqualNoun)
+        self.noun_slots = compile_slots(DepNoun_NounNoun, DepNoun_NounNounNoun)
+        self.prep_slots = compile_slots(DepNoun_NounPrepNoun)
+        self.compl_slots = compile_slots(DepAny_Compl)
+
+        # Fused passes as (name, method), the name is used in ExtractorStats reports.
+        self.passes = [(name, match) for name, match, slots in (
+            ("pass:verb", self.match_verbs, self.verb_slots),
+            ("pass:adj", self.match_adjs, self.adj_slots),
+            ("pass:adv", self.match_advs, self.adv_slots),
+            ("pass:equal", self.match_equals, self.equal_slots),
+            ("pass:noun", self.match_nouns, self.noun_slots),
+            ("pass:prep", self.match_preps, self.prep_slots),
+            ("pass:compl", self.match_compls, self.compl_slots),
+        ) if slots is not None]
+
+    def find_matches(self, sentence, stats=None):
+        index = sentence.index
+        buckets = [None] * len(self.triple_patterns)
+        for i in self.fused:
+            buckets[i] = []
+
+        # find(pos=pos) and find(first/second/third=arg, pos=pos) lookups. Arguments are never None
+        # (unbound ones are False), so these are exactly the find() fast paths.
+        by_pos = index.i_dic_pos.get
+        by_slot_pos = index.i_dic_slot_pos.get
+
+        # find(second=arg, pos=POS.NN, return_set=True) is the most common lookup of all relations.
+        nn_sets = dict()
+
+        def nn_set(arg):
+            nouns = nn_sets.get(arg)
+            if nouns is None:
+                nouns = PredicateSet(by_slot_pos((1, arg, POS.NN), ()), POS.NN)
+                nn_sets[arg] = nouns
+            return nouns
+
+        if stats is None:
+            for _, match in self.passes:
+                match(index, by_pos, by_slot_pos, nn_set, buckets)
+            for i, pattern in self.other:
+                buckets[i] = pattern.find_matches(sentence)
+        else:
+            for pass_name, match in self.passes:
+                t0 = timer()
+                match(index, by_pos, by_slot_pos, nn_set, buckets)
+                stats.add_time(pass_name, timer() - t0)
+            for i, pattern in self.other:
+                t0 = timer()
+                buckets[i] = pattern.find_matches(sentence)
+                stats.add_time(type(pattern).__name__, timer() - t0)
+            for i, pattern in enumerate(self.triple_patterns):
+                stats.add_matches(type(pattern).__name__, len(buckets[i]))
+
+        matches = []
+        for bucket in buckets:
+            matches.extend(bucket)
+        return matches
+
+    def match_verbs(self, index, by_pos, by_slot_pos, nn_set, buckets):
+        ((i_dirobj, dirobj_rel),
+         (i_indirobj, indirobj_rel),
+         (i_instr, instr_rel),
+         (i_subj, subj_rel),
+         (i_compl, compl_rel),
+         (i_vvpn, vvpn_rel),
+         (i_vv, vv_rel)) = self.verb_slots
+        vvpn_pairs = []
+        vv_pairs = []
+        for verb1 in by_pos(POS.VB, ()):
+            args = verb1.args
+            subj = nn_set(args.second)
+            if i_dirobj is not None:
+                dirobj = nn_set(args.third)
+                if dirobj and subj != dirobj:
+                    buckets[i_dirobj].append(Triple(dirobj_rel.rel_name, subj, verb1, dirobj))
+            if i_indirobj is not None and args.fourth:
+                indirobj = nn_set(args.fourth)
+                if indirobj and subj != indirobj:
+                    buckets[i_indirobj].append(Triple(indirobj_rel.rel_name, subj, verb1, indirobj))
+            if i_instr is not None:
+                for instr in index.find(second=args.first, extra="instr"):
+                    instr_noun = nn_set(instr.args.third)
+                    if instr_noun and subj != instr_noun:
+                        buckets[i_instr].append(Triple(instr_rel.rel_name, subj, verb1, instr_noun))
+            if i_subj is not None and args.second and not args.third and not args.fourth and subj:
+                buckets[i_subj].append(Triple(subj_rel.rel_name, subj, verb1))
+            if i_compl is not None and args.second:
+                for prep in index.i_dic_arg_second.get(args.first, ()):
+                    prep_noun = nn_set(prep.args.third)
+                    if prep_noun and subj != prep_noun:
+                        buckets[i_compl].append(Triple(compl_rel.rel_name, subj, verb1, prep, prep_noun))
+            if (i_vvpn is None or not args.third) and (i_vv is None or not args.second or not subj):
+                continue
+            verbs2 = [verb2 for verb2 in by_slot_pos((0, args.third, POS.VB), ()) if verb2 is not verb1]
+            if i_vvpn is not None and args.third:
+                for verb2 in verbs2:
+                    together = vvpn_rel.together(verb1.lemma, verb2.lemma)
+                    if together not in vvpn_pairs:
+                        for prep in by_slot_pos((1, verb2.args.first, POS.PREP), ()):
+                            prep_noun = nn_set(prep.args.third)
+                            if prep_noun and prep_noun != subj:
+                                buckets[i_vvpn].append(Triple(vvpn_rel.rel_name, subj, verb1, verb2, prep, prep_noun))
+                                vvpn_pairs.append(together)
+            if i_vv is not None and args.second and subj and verbs2:
+                if (1, args.first, POS.PREP) not in index.i_dic_slot_pos:
+                    for verb2 in verbs2:
+                        together = vv_rel.together(verb1.lemma, verb2.lemma)
+                        if together not in vv_pairs:
+                            buckets[i_vv].append(Triple(vv_rel.rel_name, subj, verb1, verb2))
+                            vv_pairs.append(together)
+
+    def match_adjs(self, index, by_pos, by_slot_pos, nn_set, buckets):
+        (i_adj, adj_rel), = self.adj_slots
+        for adj in by_pos(POS.ADJ, ()):
+            arg = adj.args.second
+            if arg:
+                noun = nn_set(arg)
+                if noun and not by_slot_pos((1, arg, POS.PREP)) and not by_slot_pos((2, arg, POS.PREP)):
+                    buckets[i_adj].append(Triple(adj_rel.rel_name, noun, adj))
+
+    def match_advs(self, index, by_pos, by_slot_pos, nn_set, buckets):
+        (i_adv, adv_rel), = self.adv_slots
+        for adv in by_pos(POS.RB, ()):
+            arg = adv.args.first
+            if not by_slot_pos((1, arg, POS.PREP)) and not by_slot_pos((2, arg, POS.PREP)):
+                for verb in by_slot_pos((0, adv.args.second, POS.VB), ()):
+                    subj = nn_set(verb.args.second)
+                    buckets[i_adv].append(Triple(adv_rel.rel_name, subj, verb, adv))
+
+    def match_equals(self, index, by_pos, by_slot_pos, nn_set, buckets):
+        (i_epn, epn_rel), (i_en, en_rel) = self.equal_slots
+        nn_pairs1 = []
+        nn_pairs2 = []
+        nn_pairs3 = []
+        for equal in index.i_dic_extra.get("equal", ()):
+            if i_epn is not None:
+                for noun1 in by_slot_pos((1, equal.args.second, POS.NN), ()):
+                    nouns2 = [noun2 for noun2 in by_slot_pos((1, equal.args.third, POS.NN), ()) if noun2 is not noun1]
+                    for noun2 in nouns2:
+                        together1 = epn_rel.together(noun1.lemma, noun2.lemma)
+                        if together1 not in nn_pairs1:
+                            for prep in by_slot_pos((1, noun2.args.second, POS.PREP), ()):
+                                for noun3 in by_slot_pos((1, prep.args.third, POS.NN), ()):
+                                    if noun3 is noun1 or noun3 is noun2:
+                                        continue
+                                    together2 = epn_rel.together(noun1.lemma, noun3.lemma)
+                                    together3 = epn_rel.together(noun2.lemma, noun3.lemma)
+                                    if together2 not in nn_pairs2 and together3 not in nn_pairs3:
+                                        buckets[i_epn].append(Triple(epn_rel.rel_name, noun1, noun2, prep, noun3))
+                                        nn_pairs1.append(together1)
+                                        nn_pairs2.append(together2)
+                                        nn_pairs3.append(together3)
+            if i_en is not None:
+                noun1 = nn_set(equal.args.second)
+                if noun1:
+                    noun2 = nn_set(equal.args.third)
+                    if noun2 and noun1 != noun2:
+                        if not by_slot_pos((1, noun2.predicates[0].args.second, POS.PREP)):
+                            buckets[i_en].append(Triple(en_rel.rel_name, noun1, noun2))
+
+    def match_nouns(self, index, by_pos, by_slot_pos, nn_set, buckets):
+        (i_nn, nn_rel), (i_nnn, nnn_rel) = self.noun_slots
+        nn_pairs = []
+        nn_triples = []
+        for noun1 in by_pos(POS.NN, ()):
+            arg = noun1.args.second
+            if not by_slot_pos((1, arg, POS.PREP)):
+                nouns2 = [noun2 for noun2 in by_slot_pos((1, arg, POS.NN), ()) if noun2 is not noun1]
+                if i_nn is not None and len(nouns2) == 1:
+                    noun2 = nouns2[0]
+                    together = nn_rel.together(noun1.lemma, noun2.lemma)
+                    if together not in nn_pairs:
+                        if noun1.lemma != noun2.lemma:
+                            buckets[i_nn].append(Triple(nn_rel.rel_name, noun1, noun2))
+                            nn_pairs.append(together)
+                if i_nnn is not None and len(nouns2) == 2:
+                    noun2, noun3 = nouns2
+                    together = nnn_rel.together(noun1.lemma, noun2.lemma, noun3.lemma)
+                    if together not in nn_triples:
+                        if noun1.lemma != noun2.lemma and noun2.lemma != noun3.lemma and noun1.lemma != noun3.lemma:
+                            buckets[i_nnn].append(Triple(nnn_rel.rel_name, noun1, noun2, noun3))
+                            nn_triples.append(together)
+
+    def match_preps(self, index, by_pos, by_slot_pos, nn_set, buckets):
+        (i_pn, pn_rel), = self.prep_slots
+        nn_pairs = []
+        for prep in by_pos(POS.PREP, ()):
+            nouns1 = by_slot_pos((1, prep.args.second, POS.NN))
+            if nouns1:
+                nouns2 = by_slot_pos((1, prep.args.third, POS.NN), ())
+                for noun1 in nouns1:
+                    for noun2 in nouns2:
+                        if noun2 is not noun1:
+                            together = pn_rel.together(noun1.lemma, noun2.lemma)
+                            if together not in nn_pairs:
+                                buckets[i_pn].append(Triple(pn_rel.rel_name, noun1, prep, noun2))
+                                nn_pairs.append(together)
+
+    def match_compls(self, index, by_pos, by_slot_pos, nn_set, buckets):
+        (i_compl, compl_rel), = self.compl_slots
+
+        def compl_args(arg):
+            matched = list(by_slot_pos((0, arg, POS.VB), ()))
+            matched.extend(by_slot_pos((0, arg, POS.RB), ()))
+            for slot, pos in ((0, POS.NN), (0, POS.ADJ), (1, POS.NN), (1, POS.ADJ)):
+                predicate_set = PredicateSet(by_slot_pos((slot, arg, pos), ()), pos)
+                if predicate_set:
+                    matched.append(predicate_set)
+            return matched
+
+        for compl in index.i_dic_extra.get("compl", ()):
+            any_2s = compl_args(compl.args.third)
+            if any_2s:
+                for any_1 in compl_args(compl.args.second):
+                    for any_2 in any_2s:
+                        buckets[i_compl].append(Triple(compl_rel.rel_name, any_1, any_2))
+
+
+FUSED_RELATIONS = frozenset((
+    DepVerb_SubjVerbDirobj,
+    DepVerb_SubjVerbIndirobj,
+    DepVerb_SubjVerbInstr,
+    DepVerb_SubjVerb,
+    DepVerb_PrepCompl,
+    DepVerb_SubjVerbVerbPrepNoun,
+    DepVerb_SubjVerbVerb,
+    DepAdj_NounAdj,
+    DepAdv_VerbNounAdv,
+    DepNoun_NounEqualPrepNoun,
+    DepNoun_NounEqualNoun,
+    DepNoun_NounNoun,
+    DepNoun_NounNounNoun,
+    DepNoun_NounPrepNoun,
+    DepAny_Compl,
+))
+
+
+class ExtractorStats(object):
+    """
+    Extraction counters: wall time, calls and emitted triples per relation class (or per fused pass
+    of FusedRelationMatcher, which matches several relations at once), number of sentences and
+    histogram of predicates per sentence (bins are powers of 2: a sentence with n predicates is
+    counted in the smallest bin >= n). Stats of several workers can be merged.
+
+    In the report, "passes" are the fused passes (names with PASS_PREFIX) and "relations" are the
+    relation classes. Time of a fused relation class is a part of its pass, the class itself has
+    only its triples counted (calls and time are 0), time of every class is measured only when
+    relations are matched one by one (TripleExtractor with fused=False).
+    """
+
+    PASS_PREFIX = "pass:"
+
+    def __init__(self, log_interval=60.0):
+        self.log_interval = log_interval
+        self.times = collections.Counter()
+        self.calls = collections.Counter()
+        self.matches = collections.Counter()
+        self.predicates = collections.Counter()
+        self.sentences = 0
+        self.started = time.time()
+        self.elapsed = 0.0
+        self.last_log = self.started
+        self.last_log_sentences = 0
+
+    def add_time(self, name, seconds):
+        self.times[name] += seconds
+        self.calls[name] += 1
+
+    def add_matches(self, name, n_matches):
+        self.matches[name] += n_matches
+
+    def add_sentence(self, sentence):
+        self.sentences += 1
+        self.predicates[1 << (len(sentence.predicates) - 1).bit_length() if sentence.predicates else 0] += 1
+        if self.sentences & 0x3FF == 0 and self.log_interval:
+            now = time.time()
+            if now - self.last_log >= self.log_interval:
+                logging.info(self.log_line(now))
+                self.last_log = now
+                self.last_log_sentences = self.sentences
+
+    def log_line(self, now=None):
+        now = now or time.time()
+        recent = (self.sentences - self.last_log_sentences) / max(now - self.last_log, 1e-9)
+        top = sorted(self.times.iteritems(), key=lambda item: -item[1])[:3]
+        return "EXTRACTED %d SENTENCES (%.0f sent/sec), %d TRIPLES, SLOWEST: %s" % (
+            self.sentences,
+            recent,
+            sum(self.matches.itervalues()),
+            ", ".join("%s %.1fs" % item for item in top),
+        )
+
+    def stop(self):
+        self.elapsed += time.time() - self.started
+        self.started = time.time()
+
+    def merge(self, other):
+        self.times.update(other.times)
+        self.calls.update(other.calls)
+        self.matches.update(other.matches)
+        self.predicates.update(other.predicates)
+        self.sentences += other.sentences
+        self.elapsed = max(self.elapsed, other.elapsed)
+
+    def report(self):
+        return {
+            "sentences": self.sentences,
+            "elapsed_sec": self.elapsed,
+            "sentences_per_sec": self.sentences / self.elapsed if self.elapsed else None,
+            "triples": sum(self.matches.itervalues()),
+            "predicates_per_sentence": dict((str(n), count) for n, count in sorted(self.predicates.iteritems())),
+            "passes": dict((name, {
+                "calls": self.calls[name],
+                "time_sec": self.times[name],
+            }) for name in self.calls if name.startswith(ExtractorStats.PASS_PREFIX)),
+            "relations": dict((name, {
+                "calls": self.calls[name],
+                "time_sec": self.times[name],
+                "triples": self.matches[name],
+            }) for name in set(self.calls) | set(self.matches) if not name.startswith(ExtractorStats.PASS_PREFIX)),
+        }
+
+
 class TripleExtractor():
 
-    def __init__(self, triple_patterns=()):
+    def __init__(self, triple_patterns=(), fused=True, stats=None):
         if len(triple_patterns) == 0:
             raise Exception("Extractor should have least 1 triple pattern.")
         self.triple_patterns = triple_patterns
+        self.matcher = FusedRelationMatcher(triple_patterns) if fused else None
+        self.stats = stats
 
     def i_extract_triples(self, i_sentences):
+        if self.stats is not None:
+            for matches in self.i_extract_triples_stats(i_sentences):
+                yield matches
+            return
+        if self.matcher is not None:
+            for sent in i_sentences:
+                yield self.matcher.find_matches(sent)
+            return
         for sent in i_sentences:
             matches = []
             for pattern in self.triple_patterns:
                 matches.extend(pattern.find_matches(sent))
             yield matches
 
+    def i_extract_triples_stats(self, i_sentences):
+        stats = self.stats
+        for sent in i_sentences:
+            stats.add_sentence(sent)
+            if self.matcher is not None:
+                yield self.matcher.find_matches(sent, stats)
+                continue
+            matches = []
+            for pattern in self.triple_patterns:
+                name = type(pattern).__name__
+                t0 = timer()
+                pattern_matches = pattern.find_matches(sent)
+                stats.add_time(name, timer() - t0)
+                stats.add_matches(name, len(pattern_matches))
+                matches.extend(pattern_matches)
+            yield matches
+        stats.stop()
+
 
 ACTUAL_RELS = (
     DepVerb_SubjVerbDirobj(),
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Copyright (C) USC Information Sciences Institute
+# Author: Vladimir M. Zaytsev <zaytsev@usc.edu>
+# URL: <http://nlg.isi.edu/>
+# For more information, see README.md
+# For license information, see LICENSE
+
+"""
+Columnar tuple store, memory mapped and addressed by tuple id.
+
+File is a header, the relation ranges table and fixed-width columns: relation id (uint8), five
+argument columns (int32) and frequency (uint32), every column is aligned to 8 bytes. Arguments are
+term ids or ArgType.NONE (-1), argument columns of the stamps with less than five arguments are
+filled by ArgType.EMPTY (-2), which never occurs in a stamp. Columns have the native byte order,
+they can be used as NumPy arrays (see TupleStore.numpy_column).
+"""
+
+import mmap
+import array
+import struct
+
+
+MAGIC = "MKJTUPLS"
+VERSION = 1
+MAX_ARGS = 5
+EMPTY_ARG = -2
+HEADER = struct.Struct("=8sIIQ")        # magic, version, relations, tuples
+REL_RANGE = struct.Struct("=QQQ")       # relation id, start, end
+ARG = struct.Struct("=i")
+FREQ = struct.Struct("=I")
+COLUMNS = (("rel", "B", "u1"),) + tuple(("arg%d" % i, "i", "i4") for i in xrange(MAX_ARGS)) + (("freq", "I", "u4"),)
+WRITE_BATCH_SIZE = 65536
+
+
+def align(offset):
+    return (offset + 7) & ~7
+
+
+def column_offsets(n_rels, n_tuples):
+    offsets = []
+    offset = align(HEADER.size + n_rels * REL_RANGE.size)
+    for _, typecode, _ in COLUMNS:
+        offsets.append(offset)
+        offset = align(offset + n_tuples * array.array(typecode).itemsize)
+    return offsets, offset
+
+
+def write_tuple_store(path, stamps, n_tuples, rel_ranges):
+    """
+    Writes n_tuples stamps given in the tuple id order, rel_ranges is {rel_id: (start, end)}.
+    """
+    offsets, size = column_offsets(len(rel_ranges), n_tuples)
+    with open(path, "wb") as store_file:
+        store_file.write(HEADER.pack(MAGIC, VERSION, len(rel_ranges), n_tuples))
+        for rel_id, (start, end) in sorted(rel_ranges.iteritems()):
+            store_file.write(REL_RANGE.pack(rel_id, start, end))
+        store_file.truncate(size)
+        written = 0
+        stamps = iter(stamps)
+        while written < n_tuples:
+            columns = [array.array(typecode) for _, typecode, _ in COLUMNS]
+            for stamp in stamps:
+                if len(stamp) > MAX_ARGS + 2:
+                    raise ValueError("Stamp %r has more than %d arguments." % (stamp, MAX_ARGS))
+                columns[0].append(stamp[0])
+                for i in xrange(MAX_ARGS):
+                    columns[i + 1].append(stamp[i + 1] if i + 2 < len(stamp) else EMPTY_ARG)
+                columns[-1].append(stamp[-1])
+                if len(columns[0]) == WRITE_BATCH_SIZE:
+                    break
+            if not columns[0]:
+                raise ValueError("Expected %d tuples, got %d." % (n_tuples, written))
+            for column, offset in zip(columns, offsets):
+                store_file.seek(offset + written * column.itemsize)
+                store_file.write(column.tostring())
+            written += len(columns[0])
+
+
+class TupleStore(object):
+    """
+    Read-only dict-like tuple id -> stamp view of the store.
+    """
+
+    def __init__(self, path, data=None, offset=0):
+        """
+        Maps the store file or, if data is given, reads the store from the data (mapped snapshot)
+        at the offset, which should be aligned to 8 bytes.
+        """
+        self.path = path
+        self.own_data = data is None
+        if data is None:
+            with open(path, "rb") as store_file:
+                data = mmap.mmap(store_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.data = data
+        magic, version, n_rels, self.size = HEADER.unpack_from(data, offset)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a tuple store of version %d." % (path, VERSION))
+        self.rel_ranges = {}
+        for i in xrange(n_rels):
+            rel_id, start, end = REL_RANGE.unpack_from(data, offset + HEADER.size + i * REL_RANGE.size)
+            self.rel_ranges[rel_id] = (start, end)
+        self.offsets = [offset + column_offset for column_offset in column_offsets(n_rels, self.size)[0]]
+        self.rel_offset = self.offsets[0]
+        self.args_offsets = self.offsets[1:-1]
+        self.freq_offset = self.offsets[-1]
+
+    def stamp(self, tuple_id):
+        data = self.data
+        unpack_arg = ARG.unpack_from
+        arg_offset = tuple_id * ARG.size
+        stamp = [ord(data[self.rel_offset + tuple_id])]
+        for offset in self.args_offsets:
+            arg = unpack_arg(data, offset + arg_offset)[0]
+            if arg == EMPTY_ARG:
+                break
+            stamp.append(arg)
+        stamp.append(FREQ.unpack_from(data, self.freq_offset + tuple_id * FREQ.size)[0])
+        return tuple(stamp)
+
+    def numpy_column(self, name):
+        """
+        Column as a read-only NumPy array (requires NumPy).
+        """
+        import numpy
+        for (column_name, _, dtype), offset in zip(COLUMNS, self.offsets):
+            if column_name == name:
+                return numpy.frombuffer(self.data, dtype=numpy.dtype(dtype), count=self.size, offset=offset)
+        raise KeyError(name)
+
+    def __getitem__(self, tuple_id):
+        if not isinstance(tuple_id, (int, long)) or tuple_id < 0 or tuple_id >= self.size:
+            raise KeyError(tuple_id)
+        return self.stamp(tuple_id)
+
+    def get(self, tuple_id, default=None):
+        try:
+            return self[tuple_id]
+        except KeyError:
+            return default
+
+    def __contains__(self, tuple_id):
+        return isinstance(tuple_id, (int, long)) and 0 <= tuple_id < self.size
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def iterkeys(self):
+        return iter(xrange(self.size))
+
+    def itervalues(self):
+        for tuple_id in xrange(self.size):
+            yield self.stamp(tuple_id)
+
+    def iteritems(self):
+        for tuple_id in xrange(self.size):
+            yield tuple_id, self.stamp(tuple_id)
+
+    def keys(self):
+        return range(self.size)
+
+    def close(self):
+        if self.own_data:
+            self.data.close()
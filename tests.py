@@ -7,10 +7,40 @@
 # For more information, see README.md
 # For license information, see LICENSE
 
+import os
+import sys
+import bz2
+import array
+import gzip
+import json
 import random
+import shutil
+import itertools
+import collections
+import cPickle
+import lz4
+import tempfile
 import unittest
+import subprocess
 
+try:
+    import plyvel
+except ImportError:
+    plyvel = None
+
+from mokujin import streams
+from mokujin import extsort
 from mokujin import numencode
+from mokujin import termdict
+from mokujin import snapshot
+from mokujin import tuplestore
+from mokujin.journal import BatchJournal, JournalError
+from mokujin.logicalform import POS, Pos, Sentence, MetaphorAdpLF_Reader, lf_byte_ranges
+from mokujin.lfcorpus import lf_reader, BinaryLF_Reader, BinaryLF_Writer
+from mokujin.triples import ACTUAL_RELS, TripleExtractor, TripleFold, ApproximateTripleFold, ExtractorStats
+from mokujin.triples import FusedRelationMatcher, DepNoun_NounPrep
+from mokujin.index import REL_ID_MAP, ArgType, TripleReader, DepTupleIndex, TripleSearchEngine
+from mokujin.index import build_plist_partition
 
 
 class TestNumCode(unittest.TestCase):
@@ -55,4 +85,1015 @@ class TestNumCode(unittest.TestCase):
                 part_1_2_data = numencode.update_plist(part_1_data, part_2)
                 part_1_2 = numencode.decode_plist(part_1_2_data)
                 self.assertEqual(part_1_2_data, plist_data)
-                self.assertEqual(part_1_2, plist)
\ No newline at end of file
+                self.assertEqual(part_1_2, plist)
+
+    def test_plist_unsorted(self):
+        poss = array.array("B", [0, 1, 2])
+        for tids in ([5, 3, 9], [-1, 2, 3], [-5, -3, -1]):
+            self.assertRaises(ValueError, numencode.encode_plist_arrays, array.array("l", tids), poss)
+        tids = range(0, 1000, 3)
+        self.assertRaises(ValueError, numencode.encode_plist_arrays, array.array("l", tids[:200] + [0] + tids[200:]),
+                          array.array("B", [0]) * (len(tids) + 1))
+        # Postings added below the last tuple id are merged in, old postings of a tuple id go first.
+        plist_data = numencode.encode_plist([(2, 0), (5, 1), (9, 0)])
+        updated = numencode.update_plist(plist_data, [(7, 2), (1, 1), (5, 0)])
+        self.assertEqual(numencode.decode_plist(updated), [(1, 1), (2, 0), (5, 1), (5, 0), (7, 2), (9, 0)])
+        v1_data = numencode.encode_plist_v1(array.array("l", [2, 5, 9]), array.array("B", [0, 1, 0]))
+        self.assertEqual(numencode.update_plist(v1_data, [(7, 2), (1, 1), (5, 0)]), updated)
+
+    def test_plist_versions(self):
+        for sz in [0, 1, 10, 127, 128, 129, 1000, 10000]:
+            tids = sorted(random.randint(0, 2 ** random.choice([4, 12, 20, 40])) for _ in xrange(sz))
+            poss = [random.randint(0, 4) for _ in xrange(sz)]
+            plist = zip(tids, poss)
+            v1_data = numencode.encode_plist_v1(array.array("l", tids), array.array("B", poss))
+            v2_data = numencode.encode_plist(plist)
+            self.assertEqual(numencode.plist_version(v1_data), numencode.PLIST_V1)
+            self.assertEqual(numencode.plist_version(v2_data), numencode.PLIST_V2)
+            self.assertEqual(numencode.decode_plist(v1_data), plist)
+            self.assertEqual(numencode.update_plist(v1_data, []), v2_data)
+
+    def test_plist_size(self):
+        # Sparse lists (large gaps between tuple ids) must not be larger than the legacy encoding.
+        for sz in [1, 2, 10, 127, 128, 129, 1000]:
+            for gap_bits in [1, 8, 20, 40]:
+                tids = sorted(random.randint(0, 2 ** gap_bits * sz) for _ in xrange(sz))
+                poss = [random.randint(0, 4) for _ in xrange(sz)]
+                v1_data = numencode.encode_plist_v1(array.array("l", tids), array.array("B", poss))
+                v2_data = numencode.encode_plist_arrays(array.array("l", tids), array.array("B", poss))
+                self.assertLessEqual(len(v2_data), len(v1_data))
+                self.assertEqual(numencode.decode_plist(v2_data), zip(tids, poss))
+        # Consecutive tuple ids take one bit per delta.
+        v2_data = numencode.encode_plist_arrays(array.array("l", xrange(1000, 2000)), array.array("B", [0]) * 1000)
+        self.assertLess(len(v2_data), 1000 * 1.25)
+
+    def test_plist_range(self):
+        for sz in [0, 1, 200, 5000]:
+            # Repeated tuple ids (term in several arguments of a tuple) may cross block boundaries.
+            tids = sorted(random.randint(0, sz) for _ in xrange(sz))
+            poss = [random.randint(0, 4) for _ in xrange(sz)]
+            plist_data = numencode.encode_plist(zip(tids, poss))
+            for v_data in (plist_data, numencode.encode_plist_v1(array.array("l", tids), array.array("B", poss))):
+                for _ in xrange(20):
+                    start_tid = random.randint(0, sz + 1)
+                    end_tid = random.choice([None, start_tid + random.randint(0, sz / 4 + 1)])
+                    expected = [(tid, pos) for tid, pos in zip(tids, poss)
+                                if tid >= start_tid and (end_tid is None or tid < end_tid)]
+                    tid_arr, pos_arr = numencode.decode_plist_range(v_data, start_tid, end_tid)
+                    self.assertEqual(zip(tid_arr, pos_arr), expected)
+
+    def test_plist_dir(self):
+        for plist_dir in ([], [(0, 1)], [(0, 127), (1, 128), (4, 2 ** 40)], [(255, 300000)]):
+            self.assertEqual(numencode.decode_plist_dir(numencode.encode_plist_dir(plist_dir)), plist_dir)
+
+class TestTermDict(unittest.TestCase):
+
+    def test_term_dict(self):
+        rnd = random.Random(1)
+        terms = set(["", "a", "ab", "abc", "b", u"\u043c\u0438\u0440".encode("utf-8")])
+        while len(terms) < 1000:
+            terms.add("".join(rnd.choice("abcd") for _ in xrange(rnd.randint(1, 8))))
+        term2id = dict((term, term_id) for term_id, term in enumerate(rnd.sample(sorted(terms), len(terms))))
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            dict_path = os.path.join(tmp_dir, "term.dict")
+            termdict.write_term_dict(term2id, dict_path)
+            term_dict = termdict.TermDict(dict_path)
+            self.assertEqual(len(term_dict.term_id_map), len(term2id))
+            self.assertEqual(dict(term_dict.term_id_map.iteritems()), term2id)
+            for term, term_id in term2id.iteritems():
+                self.assertEqual(term_dict.term_id_map[term], term_id)
+                self.assertEqual(term_dict.id_term_map[term_id], term)
+            self.assertEqual(term_dict.term_id_map.get(u"\u043c\u0438\u0440"), term2id[u"\u043c\u0438\u0440".encode("utf-8")])
+            self.assertEqual(term_dict.term_id_map.get("abcde", -1), -1)
+            self.assertNotIn("0", term_dict.term_id_map)
+            self.assertNotIn(len(term2id), term_dict.id_term_map)
+            self.assertRaises(KeyError, lambda: term_dict.id_term_map[-1])
+            term_dict.close()
+            termdict.write_term_dict({u"\u0434\u043e\u043c": 0, "abc": 1}, dict_path)
+            term_dict = termdict.TermDict(dict_path)
+            self.assertEqual(term_dict.term_id_map[u"\u0434\u043e\u043c"], 0)
+            self.assertEqual(term_dict.id_term_map[0], u"\u0434\u043e\u043c".encode("utf-8"))
+            self.assertEqual(term_dict.term_id_map["abc"], 1)
+            term_dict.close()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+class TestTupleStore(unittest.TestCase):
+
+    def test_tuple_store(self):
+        rnd = random.Random(1)
+        stamps = []
+        rel_ranges = {}
+        for rel_id in (0, 3, 7):
+            start = len(stamps)
+            for _ in xrange(rnd.randint(1, 300)):
+                args = [rnd.choice((-1, rnd.randint(0, 2 ** 31 - 1))) for _ in xrange(rnd.randint(1, 5))]
+                stamps.append(tuple([rel_id] + args + [rnd.randint(0, 2 ** 32 - 1)]))
+            rel_ranges[rel_id] = (start, len(stamps))
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            store_path = os.path.join(tmp_dir, "tuple.cols")
+            tuplestore.write_tuple_store(store_path, iter(stamps), len(stamps), rel_ranges)
+            store = tuplestore.TupleStore(store_path)
+            self.assertEqual(len(store), len(stamps))
+            self.assertEqual(store.rel_ranges, rel_ranges)
+            self.assertEqual(list(store.itervalues()), stamps)
+            self.assertEqual(store[len(stamps) - 1], stamps[-1])
+            self.assertIn(0, store)
+            self.assertNotIn(len(stamps), store)
+            self.assertRaises(KeyError, lambda: store[len(stamps)])
+            self.assertIsNone(store.get(-1))
+            store.close()
+            self.assertRaises(ValueError, tuplestore.write_tuple_store, store_path, iter(stamps), len(stamps) + 1,
+                              rel_ranges)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+class TestLogicalForm(unittest.TestCase):
+
+    def setUp(self):
+        with open("testdata/sample.lf", "rb") as lf_file:
+            self.lines = [line.decode("utf-8") for line in lf_file if line[0] == "["]
+        self.lines.extend([
+            u"[1]:a-b-nn(x1,u2) & past(e1,x1)",
+            u"[1]:a-nn(x1) & [2]:b-vb(e1,x1,x2,u1) \n",
+            u"[1]:a:b-nn(x1) & foo(bar(x1))\n",
+            u"a(x1) &  b(x2) && c(x3)\n",
+            u"[1]:a-nn(x-1) & [2]:-nn(x2) & (x3)\n",
+        ])
+
+    @staticmethod
+    def dump(sentence):
+        return sentence.line, [(p.pid, p.lemma, str(p.pos), list(p.args), p.extra) for p in sentence]
+
+    def test_scan_parser(self):
+        for i, line in enumerate(self.lines):
+            self.assertEqual(self.dump(Sentence.from_lf_line(i, line)), self.dump(Sentence.split_lf_line(i, line)))
+
+    def test_compact_predicates(self):
+        sentences = [Sentence.from_lf_line(i, line) for i, line in enumerate(self.lines)]
+        self.assertIs(Pos("nn"), Pos.fromenum(POS.NN))
+        self.assertIs(Pos("foo"), Pos(None))
+        for protocol in (0, 2):
+            for sentence in sentences:
+                copy = cPickle.loads(cPickle.dumps(sentence, protocol))
+                self.assertEqual(self.dump(copy), self.dump(sentence))
+                for pred, pred_copy in zip(sentence, copy):
+                    self.assertIs(pred.pos, pred_copy.pos)
+
+    def test_sentence_index(self):
+        slots = ("first", "second", "third", "fourth")
+        for i, line in enumerate(self.lines):
+            sentence = Sentence.from_lf_line(i, line)
+            args = set(arg for pred in sentence for arg in pred.args if arg)
+            for slot_i, slot in enumerate(slots):
+                for arg in args:
+                    slot_preds = [p for p in sentence if len(p.args.arg_list) > slot_i and p.args.arg_list[slot_i] == arg]
+                    self.assertEqual(sentence.index.find(**{slot: arg}), slot_preds)
+                    for pos in (POS.VB, POS.NN, POS.ADJ, POS.RB, POS.PREP, POS.PR):
+                        # Predicates are matched by their lemmas, see Predicate.__eq__.
+                        expected = [p for p in sentence if p.pos.pos == pos and p in slot_preds]
+                        self.assertEqual(sentence.index.find(pos=pos, **{slot: arg}), expected)
+            # Results are copies, changing them does not change the later results.
+            for pos in (POS.VB, POS.NN):
+                for kwargs in ({"pos": pos}, {"pos": pos, "first": arg}, {"first": arg}, {"arg": arg}):
+                    expected = list(sentence.index.find(**kwargs))
+                    sentence.index.find(**kwargs).append(None)
+                    self.assertEqual(sentence.index.find(**kwargs), expected)
+
+    def test_binary_corpus(self):
+        with open("testdata/sample.lf", "rb") as lf_file:
+            sentences = list(MetaphorAdpLF_Reader(lf_file).i_sentences())
+        with tempfile.NamedTemporaryFile() as bin_file:
+            BinaryLF_Writer.convert(sentences, open(bin_file.name, "wb"))
+            reader = lf_reader(bin_file)
+            self.assertIsInstance(reader, BinaryLF_Reader)
+            for sentence, bin_sentence in zip(sentences, reader.i_sentences()):
+                self.assertEqual(bin_sentence.sid, sentence.sid)
+                self.assertEqual(bin_sentence.raw_text, sentence.raw_text)
+                self.assertEqual(self.dump(bin_sentence)[1], self.dump(sentence)[1])
+            self.assertEqual(len(reader), len(sentences))
+
+    def test_lazy_reader(self):
+        for line in self.lines:
+            lf_line = line.encode("utf-8")
+            self.assertEqual(self.dump(Sentence.from_lf_bytes(0, lf_line)), self.dump(Sentence.from_lf_line(0, line)))
+        with open("testdata/sample.lf", "rb") as lf_file:
+            sentences = list(MetaphorAdpLF_Reader(lf_file).i_sentences())
+            lf_file.seek(0)
+            lazy_sentences = list(MetaphorAdpLF_Reader(lf_file, lazy=True).i_sentences())
+        self.assertEqual(len(lazy_sentences), len(sentences))
+        for sentence, lazy_sentence in zip(sentences, lazy_sentences):
+            self.assertIsInstance(lazy_sentence._raw_text, str)
+            self.assertEqual(lazy_sentence.raw_text, sentence.raw_text)
+            self.assertIsInstance(lazy_sentence.raw_text, unicode)
+            self.assertEqual(self.dump(lazy_sentence), self.dump(sentence))
+
+    def test_byte_ranges(self):
+        with open("testdata/sample.lf", "rb") as lf_file:
+            sentences = list(MetaphorAdpLF_Reader(lf_file).i_sentences())
+            for n_ranges in (1, 2, 3, 5, 100):
+                ranges = lf_byte_ranges(lf_file, n_ranges)
+                self.assertLessEqual(len(ranges), n_ranges)
+                shards = [list(MetaphorAdpLF_Reader(lf_file, start, end).i_sentences()) for start, end in ranges]
+                shard_sentences = [sentence for shard in shards for sentence in shard]
+                self.assertEqual([(s.raw_text, s.line) for s in shard_sentences],
+                                 [(s.raw_text, s.line) for s in sentences])
+
+
+class TestTriples(unittest.TestCase):
+
+    @staticmethod
+    def random_sentences(n_sentences, seed=42):
+        # Random LF sentences with lemmas from the sample corpus and a small pool of variables, so that
+        # predicates share arguments often and every relation gets matched.
+        with open("testdata/sample.lf", "rb") as lf_file:
+            lemmas = sorted(set(p.lemma for s in MetaphorAdpLF_Reader(lf_file).i_sentences() for p in s if p.lemma))
+        rnd = random.Random(seed)
+        tags = ("vb", "vb", "nn", "nn", "nn", "adj", "rb", "in", "in")
+        variables = ("e1", "e2", "e3", "x1", "x2", "x3", "u1")
+        sentences = []
+        for i in xrange(n_sentences):
+            predicates = []
+            for j in xrange(rnd.randint(3, 12)):
+                args = ",".join(rnd.choice(variables) for _ in xrange(rnd.randint(2, 4)))
+                if rnd.random() < 0.25:
+                    predicates.append(u"%s(%s)" % (rnd.choice(("equal", "instr", "compl")), args))
+                else:
+                    predicates.append(u"[%d]:%s-%s(%s)" % (j, rnd.choice(lemmas[:12]), rnd.choice(tags), args))
+            sentences.append(Sentence.from_lf_line(i, u" & ".join(predicates)))
+        return sentences
+
+    def test_fused_matcher(self):
+        with open("testdata/sample.lf", "rb") as lf_file:
+            sentences = list(MetaphorAdpLF_Reader(lf_file).i_sentences())
+        sentences.extend(self.random_sentences(3000))
+        fused = TripleExtractor(triple_patterns=ACTUAL_RELS)
+        per_relation = TripleExtractor(triple_patterns=ACTUAL_RELS, fused=False)
+        relations = set()
+        for matches, fused_matches in zip(per_relation.i_extract_triples(sentences),
+                                          fused.i_extract_triples(sentences)):
+            self.assertEqual([(t.relation, t.pack()) for t in fused_matches], [(t.relation, t.pack()) for t in matches])
+            relations.update(t.relation for t in matches)
+        self.assertEqual(relations, set(rel.rel_name for rel in ACTUAL_RELS))
+        # Relations which are not fused are matched by their own find_matches().
+        patterns = (DepNoun_NounPrep(), ) + ACTUAL_RELS[:3]
+        for sentence in sentences[:500]:
+            expected = [t.pack() for rel in patterns for t in rel.find_matches(sentence)]
+            self.assertEqual([t.pack() for t in FusedRelationMatcher(patterns).find_matches(sentence)], expected)
+
+    def test_extractor_stats(self):
+        sentences = self.random_sentences(500)
+        expected = collections.Counter()
+        for matches in TripleExtractor(triple_patterns=ACTUAL_RELS).i_extract_triples(sentences):
+            expected.update(type(rel).__name__ for t in matches for rel in ACTUAL_RELS if rel.rel_name == t.relation)
+        for fused in (True, False):
+            stats = ExtractorStats(log_interval=0)
+            extractor = TripleExtractor(triple_patterns=ACTUAL_RELS, fused=fused, stats=stats)
+            triples = sum(map(len, extractor.i_extract_triples(sentences)))
+            report = stats.report()
+            self.assertEqual(report["sentences"], len(sentences))
+            self.assertEqual(report["triples"], triples)
+            self.assertEqual(sum(report["predicates_per_sentence"].values()), len(sentences))
+            self.assertEqual(dict((name, rel["triples"]) for name, rel in report["relations"].items()
+                                  if rel["triples"]), dict(expected))
+            # Fused relation classes are timed only when relations are matched one by one.
+            self.assertEqual(report["relations"]["DepVerb_SubjVerbDirobj"]["time_sec"] > 0, not fused)
+            self.assertEqual(report["relations"]["DepVerb_SubjVerbDirobj"]["calls"], 0 if fused else len(sentences))
+            self.assertEqual(bool(report["passes"]), fused)
+            if fused:
+                self.assertGreater(report["passes"]["pass:verb"]["time_sec"], 0)
+        merged = ExtractorStats()
+        merged.merge(stats)
+        merged.merge(stats)
+        self.assertEqual(merged.report()["triples"], 2 * triples)
+
+    def test_fold_merge(self):
+        with open("testdata/sample.lf", "rb") as lf_file:
+            sentences = list(MetaphorAdpLF_Reader(lf_file).i_sentences())
+        extractor = TripleExtractor(triple_patterns=ACTUAL_RELS)
+        serial = TripleFold()
+        for triples in extractor.i_extract_triples(sentences):
+            serial.add_triples(triples)
+        merged = TripleFold()
+        for shard in (sentences[5:], sentences[:2], sentences[2:5]):
+            fold = TripleFold()
+            for triples in extractor.i_extract_triples(shard):
+                fold.add_triples(triples)
+            merged.merge(fold)
+        self.assertEqual(list(merged.i_triples()), list(serial.i_triples()))
+        packed = collections.Counter()
+        for triples in extractor.i_extract_triples(sentences):
+            for triple in triples:
+                packed[triple.pack()] += 1
+        from_packed = TripleFold()
+        from_packed.merge(packed)
+        self.assertEqual(list(from_packed.i_triples()), list(serial.i_triples()))
+
+    def test_spilling_fold(self):
+        sentences = self.random_sentences(1000)
+        extractor = TripleExtractor(triple_patterns=ACTUAL_RELS)
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            memory = TripleFold()
+            spilling = TripleFold(max_entries=50, tmp_dir=tmp_dir)
+            merged = TripleFold(max_entries=70, tmp_dir=tmp_dir)
+            for i, triples in enumerate(extractor.i_extract_triples(sentences)):
+                memory.add_triples(triples)
+                spilling.add_triples(triples)
+                shard = TripleFold(max_entries=30, tmp_dir=tmp_dir)
+                shard.add_triples(triples)
+                merged.merge(shard)
+            self.assertGreater(len(spilling.runs), 1)
+            # String table is cleared by every spill, it holds only the strings of the last run.
+            self.assertLess(len(spilling.strings), len(memory.strings))
+            expected = list(memory.i_triples())
+            self.assertEqual(list(spilling.i_triples()), expected)
+            self.assertEqual(list(merged.i_triples()), expected)
+            self.assertEqual(os.listdir(tmp_dir), [])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_approximate_fold(self):
+        sentences = self.random_sentences(2000)
+        extractor = TripleExtractor(triple_patterns=ACTUAL_RELS)
+        exact = TripleFold()
+        approx = ApproximateTripleFold(capacity=200, sketch_width=400)
+        merged = ApproximateTripleFold(capacity=200)
+        shards = [ApproximateTripleFold(capacity=200, sketch_width=400) for _ in xrange(3)]
+        for i, triples in enumerate(extractor.i_extract_triples(sentences)):
+            exact.add_triples(triples)
+            approx.add_triples(triples)
+            shards[i % 3].add_triples(triples)
+        for shard in shards:
+            merged.merge(shard)
+        counts = dict(exact.i_counts())
+        for tfold in (approx, merged):
+            self.assertGreater(tfold.floor, 0)
+            self.assertLessEqual(len(tfold.counter), 2 * tfold.capacity)
+            estimates = list(tfold.i_estimates())
+            for p_triple, freq, error in estimates:
+                self.assertLessEqual(freq - error, counts[p_triple])
+                self.assertLessEqual(counts[p_triple], freq)
+            emitted = set(p_triple for p_triple, _, _ in estimates)
+            for p_triple, freq in counts.iteritems():
+                if freq > tfold.floor:
+                    self.assertIn(p_triple, emitted)
+            # Only the strings of the counted triples are kept.
+            self.assertLessEqual(len(tfold.strings), 5 * len(tfold.counter) + 1)
+        # Triples tied at the cutoff are evicted by the key, exactly `capacity` triples are kept.
+        tfold = ApproximateTripleFold(capacity=3)
+        for i, count in enumerate([5, 4, 4, 4, 4, 1]):
+            arg_id = tfold.string_id("arg%d-NN" % i)
+            tfold.key_ids[("arg%d" % i, POS.NN)] = arg_id
+            tfold.counter[("nn", arg_id, arg_id, 0, 0, 0)] = count
+        tfold.errors[("nn", 3, 3, 0, 0, 0)] = 2
+        tfold.prune()
+        self.assertEqual(tfold.floor, 4)
+        self.assertEqual(list(tfold.i_estimates()), [("nn<^>arg0-NN<^>arg0-NN<^><-><^><-><^><->", 5, 0),
+                                                    ("nn<^>arg1-NN<^>arg1-NN<^><-><^><-><^><->", 4, 0),
+                                                    ("nn<^>arg2-NN<^>arg2-NN<^><-><^><-><^><->", 4, 2)])
+        self.assertEqual(tfold.strings, ["<->", "arg0-NN", "arg1-NN", "arg2-NN"])
+        self.assertEqual(sorted(tfold.key_ids.values()), [1, 2, 3])
+
+    def test_external_sort(self):
+        rnd = random.Random(1)
+        items = [(rnd.randint(0, 100), unicode(rnd.random())) for _ in xrange(5000)]
+        self.assertEqual(list(extsort.i_external_sort(iter(items), 300)), sorted(items))
+        pairs = sorted((rnd.randint(0, 50), 1) for _ in xrange(1000))
+        totals = collections.Counter(key for key, _ in pairs)
+        self.assertEqual(list(extsort.i_sum_sorted(pairs)), sorted(totals.items()))
+        run_paths = extsort.write_sorted_runs(iter(items), 700)
+        self.assertEqual(len(run_paths), 8)
+        self.assertEqual(list(extsort.i_merge_runs(run_paths)), sorted(items))
+        extsort.remove_runs(run_paths)
+        self.assertEqual(list(extsort.i_external_sort(iter(items), len(items) + 1)), sorted(items))
+        # Blocks which end before the first key are skipped, the rest is read from the block with it.
+        block_size = extsort.BLOCK_SIZE
+        extsort.BLOCK_SIZE = 100
+        try:
+            run_path = extsort.write_run(sorted(items))
+        finally:
+            extsort.BLOCK_SIZE = block_size
+        for first_key in (-1, 0, 50, 100, 101):
+            tail = list(extsort.i_read_run(run_path, first_key))
+            self.assertEqual([item for item in tail if item[0] >= first_key],
+                             [item for item in sorted(items) if item[0] >= first_key])
+            self.assertLess(len(tail) - sum(1 for item in tail if item[0] >= first_key), 100)
+        self.assertEqual(len(list(extsort.i_read_run(run_path, 101))), 0)
+        self.assertEqual(list(extsort.i_read_run(run_path)), sorted(items))
+        extsort.remove_runs([run_path])
+        # More runs than the fan-in are merged in groups, at most max_fan_in runs are read at once.
+        tmp_dir = tempfile.mkdtemp()
+        reading = [0, 0]
+        i_read_run = extsort.i_read_run
+
+        def i_counted_run(run_path, first_key=None):
+            reading[0] += 1
+            reading[1] = max(reading)
+            try:
+                for item in i_read_run(run_path, first_key):
+                    yield item
+            finally:
+                reading[0] -= 1
+
+        extsort.i_read_run = i_counted_run
+        try:
+            self.assertEqual(list(extsort.i_external_sort(iter(items), 100, tmp_dir)), sorted(items))
+            self.assertEqual(os.listdir(tmp_dir), [])
+            run_paths = extsort.write_sorted_runs(iter(items), 100, tmp_dir)
+            self.assertEqual(len(run_paths), 50)
+            for max_fan_in in (2, 3, 7, 50):
+                reading[1] = 0
+                self.assertEqual(list(extsort.i_merge_runs(run_paths, tmp_dir, max_fan_in)), sorted(items))
+                self.assertLessEqual(reading[1], max_fan_in)
+                self.assertEqual(sorted(os.listdir(tmp_dir)), sorted(os.path.basename(path) for path in run_paths))
+        finally:
+            extsort.i_read_run = i_read_run
+            shutil.rmtree(tmp_dir)
+
+
+    def test_batch_journal(self):
+        work_dir = tempfile.mkdtemp()
+        try:
+            params = {"input": "testdata", "checkpoint_mb": 1}
+            journal = BatchJournal(work_dir, params)
+            fold = TripleFold(tmp_dir=work_dir)
+            fold.add_packed(u"noun_adj<^>a-NN<^>b-ADJ<^><-><^><-><^><->", 3)
+            fold.spill()
+            journal.add("testdata/sample.lf", 0, 100, fold.runs, sentences=1)
+            journal.close()
+            # A run which was written, but not journaled, and an incomplete journal line.
+            extsort.write_run([], work_dir)
+            with open(os.path.join(work_dir, "journal"), "ab") as j_file:
+                j_file.write('{"path": "testdata/sa')
+            self.assertRaises(JournalError, lambda: BatchJournal(work_dir, dict(params, checkpoint_mb=2)))
+            journal = BatchJournal(work_dir, params)
+            self.assertTrue(journal.is_done("testdata/sample.lf", 0, 100))
+            self.assertFalse(journal.is_done("testdata/sample.lf", 100, 200))
+            self.assertEqual(journal.run_paths(), fold.runs)
+            self.assertEqual([name for name in os.listdir(work_dir) if name.endswith(".run")],
+                             [os.path.basename(run_path) for run_path in fold.runs])
+            journal.add("testdata/sample.lf", 100, 200, [])
+            journal.close()
+            self.assertEqual(len(BatchJournal(work_dir, params).segments), 2)
+        finally:
+            shutil.rmtree(work_dir)
+
+
+class TestStreams(unittest.TestCase):
+
+    def setUp(self):
+        with open("testdata/sample.lf", "rb") as lf_file:
+            self.data = lf_file.read()
+
+    def test_open_input(self):
+        with tempfile.NamedTemporaryFile() as plain_file, \
+                tempfile.NamedTemporaryFile() as gz_file, \
+                tempfile.NamedTemporaryFile() as bz2_file:
+            plain_file.write(self.data)
+            plain_file.flush()
+            with gzip.GzipFile(fileobj=gz_file, mode="wb") as gz_stream:
+                gz_stream.write(self.data)
+            gz_file.flush()
+            bz2_file.write(bz2.compress(self.data) * 2)
+            bz2_file.flush()
+            self.assertIsNone(streams.input_codec(plain_file.name))
+            self.assertEqual(streams.input_codec(gz_file.name), "gzip")
+            self.assertEqual("".join(streams.open_input(plain_file.name)), self.data)
+            self.assertEqual("".join(streams.open_input(gz_file.name)), self.data)
+            self.assertEqual(streams.open_input(bz2_file.name).read(), self.data * 2)
+            # Decompression in a thread, when command line tools are not available.
+            codecs = streams.CODECS
+            streams.CODECS = [(name, magic, ("mokujin-no-such-command", )) for name, magic, _ in codecs]
+            try:
+                self.assertEqual("".join(streams.open_input(gz_file.name)), self.data)
+                self.assertEqual(streams.open_input(bz2_file.name).read(), self.data * 2)
+                with tempfile.NamedTemporaryFile() as broken_file:
+                    broken_file.write(bz2.compress(self.data)[:-100])
+                    broken_file.flush()
+                    self.assertRaises(IOError, lambda: streams.open_input(broken_file.name).read())
+            finally:
+                streams.CODECS = codecs
+
+
+class TestPlistBuild(unittest.TestCase):
+
+    N_TERMS = 300
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rnd = random.Random(7)
+        rel_counts = collections.Counter()
+        self.plist_runs, self.plist_dict, self.expected = [], {}, collections.defaultdict(list)
+        postings = []
+        for _ in xrange(3000):
+            rel_id = rnd.choice([2, 5, 9])
+            tid = (rel_id << DepTupleIndex.REL_ID_SHIFT) | rel_counts[rel_id]
+            rel_counts[rel_id] += 1
+            postings.append((rel_id, tid, rnd.sample(xrange(self.N_TERMS), rnd.randint(1, 3))))
+        self.rel_starts = {2: 0, 5: rel_counts[2], 9: rel_counts[2] + rel_counts[5]}
+        for rel_id, tid, term_ids in postings:
+            for ag_pos, term_id in enumerate(term_ids):
+                tid_arr, pos_arr = self.plist_dict.setdefault(term_id, (array.array("l"), array.array("B")))
+                tid_arr.append(tid)
+                pos_arr.append(ag_pos)
+                final_tid = self.rel_starts[rel_id] + tid - (rel_id << DepTupleIndex.REL_ID_SHIFT)
+                self.expected[term_id].append((final_tid, ag_pos))
+            if len(self.plist_dict) > 100:
+                self.plist_runs.append(DepTupleIndex.write_plist_run(self.plist_dict, len(self.plist_runs),
+                                                                     self.tmp_dir))
+                self.plist_dict = {}
+        self.expected = dict((term_id, sorted(plist)) for term_id, plist in self.expected.iteritems())
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def decode(self, plist_blobs):
+        keys = [key for key, _ in plist_blobs]
+        self.assertEqual(keys, sorted(set(keys)))
+        plist_blobs = dict(plist_blobs)
+        found = {}
+        for term_id in self.expected:
+            plist = []
+            for ag_pos, _ in numencode.decode_plist_dir(plist_blobs[DepTupleIndex.plist_key(term_id)]):
+                sub_blob = plist_blobs[DepTupleIndex.plist_key(term_id, ag_pos)]
+                plist.extend(zip(*numencode.decode_plist_arrays(sub_blob)))
+            found[term_id] = sorted(plist)
+        self.assertEqual(len(plist_blobs), len(found) + sum(len(set(pos for _, pos in plist))
+                                                            for plist in self.expected.itervalues()))
+        return found
+
+    def serial(self):
+        i_plists = DepTupleIndex.i_merge_plists(self.plist_runs, self.plist_dict, self.tmp_dir)
+        return list(DepTupleIndex.i_encode_plists(DepTupleIndex.i_final_plists(i_plists, self.rel_starts)))
+
+    def test_merge(self):
+        self.assertGreater(len(self.plist_runs), 5)
+        self.assertEqual(self.decode(self.serial()), self.expected)
+        # More runs than the fan-in are merged in groups, intermediate runs are removed.
+        max_fan_in = extsort.MAX_FAN_IN
+        extsort.MAX_FAN_IN = 3
+        try:
+            self.assertEqual(self.decode(self.serial()), self.expected)
+        finally:
+            extsort.MAX_FAN_IN = max_fan_in
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)),
+                         sorted(os.path.basename(run_path) for run_path in self.plist_runs))
+
+    def test_key_ranges(self):
+        for n_terms in (1, 2, self.N_TERMS):
+            keys = sorted(DepTupleIndex.plist_key(term_id) for term_id in xrange(n_terms))
+            for n_parts in (1, 2, 4):
+                key_ranges = DepTupleIndex.plist_key_ranges(n_terms, n_parts)
+                self.assertLessEqual(len(key_ranges), n_parts)
+                self.assertEqual(key_ranges[0][0], None)
+                self.assertEqual(key_ranges[-1][1], None)
+                for (_, end_key), (first_key, _) in zip(key_ranges, key_ranges[1:]):
+                    self.assertEqual(end_key, first_key)
+                parts = [[key for key in keys if (first_key is None or key >= first_key) and
+                          (end_key is None or key < end_key)] for first_key, end_key in key_ranges]
+                self.assertTrue(all(parts))
+                self.assertEqual(sum(parts, []), keys)
+
+    def test_partitions(self):
+        self.plist_runs.append(DepTupleIndex.write_plist_run(self.plist_dict, len(self.plist_runs), self.tmp_dir))
+        self.plist_dict = {}
+        serial = self.serial()
+        tasks = [(self.plist_runs, key_range, self.rel_starts, self.tmp_dir)
+                 for key_range in DepTupleIndex.plist_key_ranges(self.N_TERMS, 4)]
+        blob_runs = [build_plist_partition(task) for task in tasks]
+        self.assertEqual(len(blob_runs), 4)
+        self.assertEqual(list(itertools.chain.from_iterable(extsort.i_read_run(blob_run) for blob_run in blob_runs)),
+                         serial)
+        extsort.remove_runs(blob_runs)
+
+
+@unittest.skipIf(plyvel is None, "plyvel is not installed")
+class TestIndex(unittest.TestCase):
+
+    FREQ_THRESHOLD = 12000
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        with open("testdata/eng.tuples", "rb") as tuples_file:
+            self.tuples = list(TripleReader().iter_triples(tuples_file))
+        self.indexed = [(rel_name, [arg for arg in arguments if arg != ArgType.EMPTY], freq)
+                        for rel_name, arguments, freq in self.tuples if freq > self.FREQ_THRESHOLD]
+        term_counts = collections.Counter(arg for _, arguments, _ in self.indexed
+                                          for arg in arguments if arg != ArgType.NONE)
+        terms = [term for term, _ in term_counts.most_common()]
+        self.terms = terms[:6] + terms[-2:]
+        self.rel_types = sorted(set(REL_ID_MAP[rel_name] for rel_name, _, _ in self.indexed))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def build(self, name, **kwargs):
+        index_root = os.path.join(self.tmp_dir, name)
+        os.mkdir(index_root)
+        DepTupleIndex.create(index_root, iter(self.tuples), self.FREQ_THRESHOLD, tmp_dir=self.tmp_dir, **kwargs)
+        return DepTupleIndex(index_root)
+
+    def write_old_index(self, name):
+        """
+        Writes index of the layout created before the posting lists were split by argument position:
+        terms and tuples are stored in LevelDB, every term has one version 1 posting list and the
+        posting lists database has no layout key.
+        """
+        index_root = os.path.join(self.tmp_dir, name)
+        os.mkdir(index_root)
+        term2id, id2tuple, plist_dict = {}, {}, collections.defaultdict(list)
+        for d_tuple in self.tuples:
+            for term in d_tuple[1]:
+                if term != ArgType.NONE and term != ArgType.EMPTY and term not in term2id:
+                    term2id[term] = len(term2id)
+            if d_tuple[-1] > self.FREQ_THRESHOLD:
+                tuple_id = len(id2tuple)
+                id2tuple[tuple_id] = DepTupleIndex.tuple2stamp(d_tuple, term2id)
+                for arg_idx, arg in enumerate(id2tuple[tuple_id][1:-1]):
+                    if arg >= 0:
+                        plist_dict[arg].append((tuple_id, arg_idx))
+        term_ldb = DepTupleIndex.get_term_ldb(index_root, create=True)
+        DepTupleIndex.write_terms(term2id, term_ldb)
+        term_ldb.close()
+        tuple_ldb = DepTupleIndex.get_tuple_ldb(index_root, create=True)
+        DepTupleIndex.write_tuples(id2tuple, tuple_ldb)
+        tuple_ldb.close()
+        plist_ldb = DepTupleIndex.get_plist_ldb(index_root, create=True)
+        for term_id, plist in plist_dict.iteritems():
+            plist_data = numencode.encode_plist_v1(array.array("l", [tid for tid, _ in plist]),
+                                                   array.array("B", [pos for _, pos in plist]))
+            plist_ldb.put(DepTupleIndex.plist_key(term_id), lz4.compressHC(plist_data))
+        plist_ldb.close()
+        return DepTupleIndex(index_root)
+
+    def i_queries(self):
+        for rel_type in self.rel_types:
+            yield rel_type, ()
+        for term in self.terms:
+            yield None, (term, )
+            for pos in xrange(3):
+                yield None, ((term, pos), )
+        for term_a, term_b in zip(self.terms, self.terms[1:]):
+            yield None, (term_a, term_b)
+            yield None, ((term_a, 0), term_b)
+        for rel_type in self.rel_types:
+            for term in self.terms:
+                yield rel_type, (term, )
+                yield rel_type, ((term, 1), )
+
+    def expected(self, rel_type=None, arg_query=()):
+        results = []
+        for rel_name, arguments, freq in self.indexed:
+            if rel_type is not None and REL_ID_MAP[rel_name] != rel_type:
+                continue
+            for arg in arg_query:
+                term, pos = arg if isinstance(arg, tuple) else (arg, -1)
+                if pos == -1 and term not in arguments:
+                    break
+                if pos != -1 and (pos >= len(arguments) or arguments[pos] != term):
+                    break
+            else:
+                results.append([rel_name] + arguments + [freq])
+        return sorted(results)
+
+    @staticmethod
+    def found(index, rel_type=None, arg_query=()):
+        results = TripleSearchEngine(index).search(rel_type, arg_query)
+        return sorted(DepTupleIndex.stamp2tuple(stamp, index.id2term) for stamp in results)
+
+    def assertSearch(self, index):
+        for rel_type, arg_query in self.i_queries():
+            self.assertEqual(self.found(index, rel_type, arg_query), self.expected(rel_type, arg_query),
+                             (rel_type, arg_query))
+        self.assertEqual(self.found(index, None, ("no-such-term", )), [])
+
+    def test_search(self):
+        self.assertGreater(len(self.expected(None, self.terms[:1])), 10)
+        self.assertSearch(self.build("default"))
+        # Postings of every tuple are written to a run, then all runs are merged.
+        self.assertSearch(self.build("runs", memory_mb=0))
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), ["default", "runs"])
+
+    def test_parallel(self):
+        serial = self.build("serial")
+        for name, memory_mb in (("parallel", 512), ("parallel-runs", 0)):
+            parallel = self.build(name, memory_mb=memory_mb, n_jobs=4)
+            self.assertEqual(list(parallel.plist_ldb), list(serial.plist_ldb))
+            for term_id in xrange(len(serial.id2term)):
+                self.assertEqual(parallel.get_postings(term_id), serial.get_postings(term_id))
+            self.assertSearch(parallel)
+
+    def test_positional(self):
+        index = self.build("positional")
+        old_index = self.write_old_index("old")
+        self.assertTrue(index.positional)
+        for term in self.terms:
+            term_id, old_term_id = index.term2id[term], old_index.term2id[term]
+            plist_dir = numencode.decode_plist_dir(index.plist_ldb.get(DepTupleIndex.plist_key(term_id)))
+            tid_arr, pos_arr = index.get_postings(term_id)
+            self.assertEqual(plist_dir, sorted(collections.Counter(pos_arr).items()))
+            for pos in xrange(4):
+                # Sub-list of the position is the part of the term postings, in both layouts.
+                postings = zip(*index.get_postings(term_id, pos))
+                self.assertEqual(postings, [posting for posting in zip(tid_arr, pos_arr) if posting[1] == pos])
+                old_postings = zip(*old_index.get_postings(old_term_id, pos))
+                self.assertEqual(sorted(DepTupleIndex.stamp2tuple(index.id2tuple[tid], index.id2term)
+                                        for tid, _ in postings),
+                                 sorted(DepTupleIndex.stamp2tuple(old_index.id2tuple[tid], old_index.id2term)
+                                        for tid, _ in old_postings))
+
+    def test_rel_ranges(self):
+        index = self.build("ranges")
+        self.assertEqual(sorted(index.rel_ranges), self.rel_types)
+        self.assertEqual(sum(end - start for start, end in index.rel_ranges.itervalues()), len(self.indexed))
+        for rel_type, (start, end) in index.rel_ranges.iteritems():
+            self.assertEqual(set(index.id2tuple[tuple_id][0] for tuple_id in xrange(start, end)), set([rel_type]))
+        # Indexes which store terms and tuples in LevelDB have no relation ranges.
+        term_ldb = DepTupleIndex.get_term_ldb(index.index_root, create=True)
+        DepTupleIndex.write_terms(dict(index.term2id.iteritems()), term_ldb)
+        term_ldb.close()
+        tuple_ldb = DepTupleIndex.get_tuple_ldb(index.index_root, create=True)
+        DepTupleIndex.write_tuples(dict(index.id2tuple.iteritems()), tuple_ldb)
+        tuple_ldb.close()
+        index.plist_ldb.close()
+        index.term_dict.close()
+        index.tuple_store.close()
+        os.remove(os.path.join(index.index_root, DepTupleIndex.TERM_DICT_FILE))
+        os.remove(os.path.join(index.index_root, DepTupleIndex.TUPLE_STORE_FILE))
+        ldb_index = DepTupleIndex(index.index_root)
+        self.assertIsNone(ldb_index.tuple_store)
+        self.assertIsNone(ldb_index.rel_ranges)
+        self.assertSearch(ldb_index)
+
+    def test_snapshot_search(self):
+        index = self.build("directory")
+        snapshot_path = os.path.join(self.tmp_dir, "index.snapshot")
+        index.export_snapshot(snapshot_path, tmp_dir=self.tmp_dir)
+        snapshot_index = DepTupleIndex.open_snapshot(snapshot_path, verify=True)
+        self.assertTrue(snapshot_index.positional)
+        self.assertEqual(snapshot_index.rel_ranges, index.rel_ranges)
+        for rel_type, arg_query in self.i_queries():
+            self.assertEqual(TripleSearchEngine(snapshot_index).search(rel_type, arg_query),
+                             TripleSearchEngine(index).search(rel_type, arg_query))
+        self.assertSearch(snapshot_index)
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), ["directory", "index.snapshot"])
+        # Old indexes have no relation ranges and can not be exported.
+        old_index = self.write_old_index("old")
+        self.assertRaises(ValueError, old_index.export_snapshot, os.path.join(self.tmp_dir, "old.snapshot"))
+
+    def test_old_layout(self):
+        index = self.write_old_index("old")
+        self.assertFalse(index.positional)
+        self.assertIsNone(index.rel_ranges)
+        self.assertSearch(index)
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def test_snapshot(self):
+        items = sorted((numencode.encode_uint(i) + ".%d" % (i % 3), "v" * (i % 7)) for i in xrange(500))
+        stamps = [(0, 1, -1, 5), (0, 2, 3, 4, 5, 6, 1), (2, 7, 1)]
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            term_dict_path = os.path.join(tmp_dir, "terms")
+            termdict.write_term_dict({"a": 1, "b": 0}, term_dict_path)
+            tuple_store_path = os.path.join(tmp_dir, "tuples")
+            tuplestore.write_tuple_store(tuple_store_path, stamps, len(stamps), {0: (0, 2), 2: (2, 3)})
+            plist_table_path = os.path.join(tmp_dir, "plists")
+            snapshot.write_posting_table(plist_table_path, items, tmp_dir)
+            snapshot_path = os.path.join(tmp_dir, "index.snapshot")
+            snapshot.write_snapshot(snapshot_path, [("terms", term_dict_path),
+                                                    ("tuples", tuple_store_path),
+                                                    ("plists", plist_table_path)])
+            index_snapshot = snapshot.Snapshot(snapshot_path)
+            index_snapshot.verify()
+            plist_table = snapshot.PostingTable(index_snapshot.data, index_snapshot.section_offset("plists"))
+            self.assertEqual(list(plist_table), items)
+            for key, value in items:
+                self.assertEqual(plist_table.get(key), value)
+            self.assertIsNone(plist_table.get(""))
+            self.assertIsNone(plist_table.get("\xff"))
+            term_dict = termdict.TermDict(snapshot_path, index_snapshot.data, index_snapshot.section_offset("terms"))
+            self.assertEqual(term_dict.term_id_map["a"], 1)
+            store = tuplestore.TupleStore(snapshot_path, index_snapshot.data, index_snapshot.section_offset("tuples"))
+            self.assertEqual(list(store.itervalues()), stamps)
+            self.assertEqual(store.rel_ranges, {0: (0, 2), 2: (2, 3)})
+            self.assertRaises(ValueError, index_snapshot.section_offset, "other")
+            self.assertRaises(ValueError, snapshot.write_posting_table, plist_table_path, items[::-1])
+            # Offsets are written in chunks, the table does not depend on the chunk size.
+            with open(plist_table_path, "rb") as plist_table_file:
+                plist_table_data = plist_table_file.read()
+            offset_chunk = snapshot.OFFSET_CHUNK
+            snapshot.OFFSET_CHUNK = 7
+            try:
+                snapshot.write_posting_table(plist_table_path, items, tmp_dir)
+            finally:
+                snapshot.OFFSET_CHUNK = offset_chunk
+            with open(plist_table_path, "rb") as plist_table_file:
+                self.assertEqual(plist_table_file.read(), plist_table_data)
+            # Corrupted section is found by verify, corrupted section table on open.
+            plists_offset, plists_size, _ = index_snapshot.sections["plists"]
+            with open(snapshot_path, "r+b") as snapshot_file:
+                snapshot_file.seek(plists_offset + plists_size - 1)
+                snapshot_file.write("x")
+            index_snapshot.close()
+            self.assertRaises(ValueError, snapshot.Snapshot(snapshot_path).verify)
+            with open(snapshot_path, "r+b") as snapshot_file:
+                snapshot_file.seek(snapshot.HEADER.size)
+                snapshot_file.write("x")
+            self.assertRaises(ValueError, snapshot.Snapshot, snapshot_path)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+class TestTools(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def run_script(self, *args, **kwargs):
+        script = subprocess.Popen((sys.executable, ) + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = script.communicate()
+        if kwargs.get("fails"):
+            self.assertNotEqual(script.returncode, 0)
+        else:
+            self.assertEqual(script.returncode, 0, err)
+        return err
+
+    def read(self, path):
+        with open(path, "rb") as i_file:
+            return i_file.read()
+
+    def test_batch_resume(self):
+        import findtriples
+        with open("testdata/sample.lf", "rb") as lf_file:
+            lf_data = lf_file.read()
+        input_dir = os.path.join(self.tmp_dir, "input")
+        work_dir = os.path.join(self.tmp_dir, "batch")
+        os.mkdir(input_dir)
+        for name, repeat in (("a.lf", 3), ("b.lf", 1), ("c.lf", 2)):
+            with open(os.path.join(input_dir, name), "wb") as lf_file:
+                lf_file.write(lf_data * repeat)
+        with open(os.path.join(self.tmp_dir, "all.lf"), "wb") as lf_file:
+            lf_file.write(lf_data * 6)
+        self.run_script("findtriples.py", os.path.join(self.tmp_dir, "all.lf"), os.path.join(self.tmp_dir, "all.csv"))
+        # State of a job killed while the second segment was being journaled: the first segment is
+        # done, runs of the second one are written, its journal line is incomplete.
+        journal = BatchJournal(work_dir, {"input": os.path.abspath(input_dir), "pattern": "*", "checkpoint_mb": 1})
+        fold_options = {"max_entries": None, "max_rss": None, "tmp_dir": work_dir, "log_interval": 0, "fused": True}
+        segments = findtriples.batch_segments(findtriples.i_input_files(input_dir, "*"), 1024 * 1024, fold_options)
+        self.assertEqual(len(segments), 3)
+        segment, runs, stats = findtriples.fold_segment(segments[0])
+        journal.add(segment[0], segment[1], segment[2], runs, sentences=stats.sentences)
+        findtriples.fold_segment(segments[1])
+        journal.j_file.write('{"path": ')
+        journal.close()
+        err = self.run_script("findtriples.py", "--batch", work_dir, "--checkpoint_mb", "1", input_dir,
+                              os.path.join(self.tmp_dir, "batch.csv"))
+        self.assertGreater(len(self.read(os.path.join(self.tmp_dir, "all.csv"))), 0)
+        self.assertIn("(1 ALREADY DONE)", err)
+        self.assertIn("REMOVING UNFINISHED RUN", err)
+        self.assertEqual(self.read(os.path.join(self.tmp_dir, "batch.csv")),
+                         self.read(os.path.join(self.tmp_dir, "all.csv")))
+        self.assertEqual(os.listdir(work_dir), [])
+
+    def test_batch_merge(self):
+        # Final merge of a batch job which journaled more runs than the merge fan-in.
+        import findtriples
+        lf_path = os.path.join(self.tmp_dir, "input.lf")
+        work_dir = os.path.join(self.tmp_dir, "batch")
+        with open("testdata/sample.lf", "rb") as lf_file:
+            lf_data = lf_file.read()
+        with open(lf_path, "wb") as lf_file:
+            lf_file.write(lf_data * 30)
+        fold_options = {"max_entries": None, "max_rss": None, "tmp_dir": work_dir, "log_interval": 0, "fused": True}
+        journal = BatchJournal(work_dir, {"input": lf_path})
+        for segment in findtriples.batch_segments([lf_path], 2048, fold_options):
+            segment, runs, stats = findtriples.fold_segment(segment)
+            journal.add(segment[0], segment[1], segment[2], runs, sentences=stats.sentences)
+        run_paths = journal.run_paths()
+        self.assertGreater(len(run_paths), 20)
+        with open(lf_path, "rb") as lf_file:
+            expected, _ = findtriples.fold_sentences(lf_reader(lf_file).i_sentences(), fold_options)
+        max_fan_in = extsort.MAX_FAN_IN
+        extsort.MAX_FAN_IN = 4
+        try:
+            tfold = findtriples.make_fold(fold_options)
+            tfold.runs.extend(run_paths)
+            self.assertEqual(list(tfold.i_triples(remove_runs=False)), list(expected.i_triples()))
+        finally:
+            extsort.MAX_FAN_IN = max_fan_in
+        self.assertEqual(sorted(os.listdir(work_dir)), sorted(["journal"] + map(os.path.basename, run_paths)))
+        journal.remove()
+
+    def test_stats_file(self):
+        out_path = os.path.join(self.tmp_dir, "triples.csv")
+        self.run_script("findtriples.py", "testdata/sample.lf", out_path)
+        self.assertEqual(os.listdir(self.tmp_dir), ["triples.csv"])
+        stats_path = os.path.join(self.tmp_dir, "report.json")
+        self.run_script("findtriples.py", "--stats", stats_path, "testdata/sample.lf", out_path)
+        self.assertGreater(json.loads(self.read(stats_path))["sentences"], 0)
+
+    def test_reduce(self):
+        rnd = random.Random(1)
+        input_dir = os.path.join(self.tmp_dir, "input")
+        os.mkdir(input_dir)
+        keys = ["noun_adj, n%d-NN, a%d-ADJ, <->, <->, <->" % (rnd.randint(0, 20), i % 7) for i in xrange(200)]
+        expected = collections.Counter()
+        for file_no in xrange(4):
+            with open(os.path.join(input_dir, "part-%d.csv" % file_no), "wb") as csv_file:
+                for key in rnd.sample(keys, 80):
+                    freq = rnd.randint(1, 50)
+                    expected[key] += freq
+                    csv_file.write("%s, %d\n" % (key, freq))
+
+        def rows(path):
+            return [(row.rsplit(", ", 1)[0], int(row.rsplit(", ", 1)[1])) for row in self.read(path).splitlines()]
+
+        self.run_script("tools/reduce.py", "-d", input_dir, "-o", os.path.join(self.tmp_dir, "memory.csv"))
+        memory_rows = rows(os.path.join(self.tmp_dir, "memory.csv"))
+        self.assertEqual(dict(memory_rows), dict(expected))
+        runs_dir = os.path.join(self.tmp_dir, "runs")
+        os.mkdir(runs_dir)
+        for options in (("-m", "5"), ("-m", "5", "-j", "3"), ("-j", "2")):
+            out_path = os.path.join(self.tmp_dir, "merged%s.csv" % "".join(options))
+            self.run_script("tools/reduce.py", "-d", input_dir, "-o", out_path, "--tmp_dir", runs_dir, *options)
+            # External merge orders ties by key, the in-memory table in any order.
+            self.assertEqual(rows(out_path), sorted(memory_rows, key=lambda row: (-row[1], row[0])))
+            self.assertEqual(os.listdir(runs_dir), [])
+
+    def test_split(self):
+        import imp
+        split = imp.load_source("split", "tools/split.py")
+        rnd = random.Random(1)
+        words = [u"\u043c\u0438\u0440", u"word", u"x", u"\u0434\u043e\u043c"]
+        plain_lines = ["\n" * rnd.randint(0, 3)]
+        for _ in xrange(300):
+            plain_lines.append(" ".join(rnd.choice(words) for _ in xrange(rnd.randint(1, 8))).encode("utf-8") + "\n")
+            plain_lines.append("\n" * rnd.choice((0, 0, 1, 2, 3, 5)))
+        ruwac_lines = []
+        for text_no in xrange(20):
+            ruwac_lines.append('<text id="%d">\n' % text_no)
+            for _ in xrange(rnd.randint(1, 6)):
+                n_tokens = rnd.randint(1, 7)
+                for token_no in xrange(1, n_tokens + 1):
+                    pos = "SENT" if token_no == n_tokens and rnd.random() < 0.8 else "NN"
+                    ruwac_lines.append((u"%s\t%s\t%s\tf\t%d\t0\trel\n" % (
+                        rnd.choice(words), pos, rnd.choice(words), token_no)).encode("utf-8"))
+            ruwac_lines.append("</text>\n")
+        for iformat, lines in (("plain", plain_lines), ("ruwac", ruwac_lines)):
+            in_path = os.path.join(self.tmp_dir, "%s.txt" % iformat)
+            with open(in_path, "wb") as in_file:
+                in_file.write("".join(lines))
+            # Output of the serial split (one chunk), line by line.
+            splitter = split.FORMAT_SPLITTER_MAP[iformat]()
+            expected = []
+            prev_is_end = True
+            for line in self.read(in_path).splitlines(True):
+                for mapping in splitter.map_line(line):
+                    if mapping is split.SENT_END:
+                        if not prev_is_end:
+                            expected.append("\n")
+                            prev_is_end = True
+                    else:
+                        prev_is_end = False
+                        expected.append(mapping)
+            expected = "".join(expected)
+            for chunk_numb in (1, 4, 7):
+                out_dir = os.path.join(self.tmp_dir, "%s-%d" % (iformat, chunk_numb))
+                os.mkdir(out_dir)
+                self.run_script("tools/split.py", "-i", in_path, "-o", os.path.join(out_dir, "chunk-%d"),
+                                "-n", str(chunk_numb), "-f", iformat, "-j", "2")
+                chunks = sorted(os.listdir(out_dir), key=lambda name: int(name.split("-")[1]))
+                self.assertEqual(len(chunks), chunk_numb)
+                self.assertEqual("".join(self.read(os.path.join(out_dir, name)) for name in chunks), expected)
+
+    def test_combine(self):
+        input_dir = os.path.join(self.tmp_dir, "input")
+        segments_dir = os.path.join(self.tmp_dir, "segments")
+        os.mkdir(input_dir)
+        os.mkdir(segments_dir)
+        texts = [u"\u0444\u0430\u0439\u043b %d\n" % i * (i + 1) for i in xrange(7)]
+        for i, text in enumerate(texts):
+            with open(os.path.join(input_dir, "%d.txt" % i), "wb") as text_file:
+                text_file.write(text.encode("utf-16"))
+        out_path = os.path.join(self.tmp_dir, "combined.txt")
+        self.run_script("tools/combine.py", "-d", input_dir, "-o", out_path, "-ie", "utf-16", "-oe", "utf-8",
+                        "-j", "2", "--tmp_dir", segments_dir)
+        self.assertEqual(self.read(out_path), "".join(texts).encode("utf-8"))
+        self.assertEqual(os.listdir(segments_dir), [])
+        # Segments of the converted files are removed when a file can not be converted.
+        with open(os.path.join(input_dir, "3.txt"), "ab") as text_file:
+            text_file.write("\0")
+        self.run_script("tools/combine.py", "-d", input_dir, "-o", out_path, "-ie", "utf-16", "-oe", "utf-8",
+                        "-j", "2", "--tmp_dir", segments_dir, fails=True)
+        self.assertEqual(os.listdir(segments_dir), [])
+
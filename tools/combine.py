@@ -18,37 +18,93 @@
 
 import os
 import sys
+import codecs
+import shutil
 import argparse
+import tempfile
+import itertools
+import collections
+import multiprocessing
 
 from fnmatch import fnmatch
 
 
-def visit(pattern, dir_name, files, rd_file, wr_file):
-    for filename in files:
-        if fnmatch(filename, pattern):
-            fl_path = os.path.join(dir_name, filename)
-            fl = open(fl_path, "r")
-            wr_file(rd_file(fl))
-
-
-def read(i_file):
-    for line in i_file:
-        yield line
-
-
-def read_enc(i_file, enc):
-    for line in i_file:
-        yield line.decode(enc)
-
-
-def write(o_file, lines):
-    for line in lines:
-        o_file.write(line)
-
-
-def write_enc(o_file, enc, lines):
-    for line in lines:
-        o_file.write(line.encode(enc))
+BUFFER_SIZE = 1 << 24
+
+
+def i_files(dir_name, pattern, recursive):
+    # os.walk lists one directory at a time, so files are combined while the tree is traversed.
+    for dir_path, dir_names, file_names in os.walk(dir_name):
+        if recursive:
+            dir_names.sort()
+        else:
+            del dir_names[:]
+        for filename in sorted(file_names):
+            if fnmatch(filename, pattern):
+                yield os.path.join(dir_path, filename)
+
+
+def copy(fl_path, o_file):
+    with open(fl_path, "rb") as fl:
+        shutil.copyfileobj(fl, o_file, BUFFER_SIZE)
+
+
+def convert(task):
+    """
+    Converts the file into a temporary segment, which is then appended to the combined file.
+    """
+    fl_path, ienc, oenc, tmp_dir = task
+    decoder = codecs.getincrementaldecoder(ienc)()
+    encoder = codecs.getincrementalencoder(oenc)()
+    fd, segment_path = tempfile.mkstemp(prefix="combine-", suffix=".segment", dir=tmp_dir)
+    with open(fl_path, "rb") as fl, os.fdopen(fd, "wb") as segment:
+        while True:
+            data = fl.read(BUFFER_SIZE)
+            if not data:
+                break
+            segment.write(encoder.encode(decoder.decode(data)))
+        segment.write(encoder.encode(decoder.decode("", final=True), final=True))
+    return segment_path
+
+
+def i_bounded_map(pool, func, tasks, max_pending):
+    """
+    Like pool.imap, but at most `max_pending` tasks are submitted ahead of the results which were
+    taken, so that at most that many converted segments wait on disk.
+    """
+    pending = collections.deque()
+    for task in tasks:
+        pending.append(pool.apply_async(func, (task, )))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def combine(fl_paths, o_file, ienc=None, oenc=None, n_jobs=1, tmp_dir=None):
+    if ienc is None or oenc is None:
+        for fl_path in fl_paths:
+            copy(fl_path, o_file)
+        return
+    # Segments are written to a directory of their own, which is removed with the segments of the
+    # unfinished tasks when combining fails.
+    work_dir = tempfile.mkdtemp(prefix="combine-", dir=tmp_dir)
+    tasks = ((fl_path, ienc, oenc, work_dir) for fl_path in fl_paths)
+    pool = multiprocessing.Pool(n_jobs) if n_jobs > 1 else None
+    try:
+        if pool is not None:
+            i_segments = i_bounded_map(pool, convert, tasks, n_jobs)
+        else:
+            i_segments = itertools.imap(convert, tasks)
+        # Segments are appended in the order of input files.
+        for segment_path in i_segments:
+            copy(segment_path, o_file)
+            os.remove(segment_path)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        shutil.rmtree(work_dir, ignore_errors=True)
 
 
 if __name__ == "__main__":
@@ -62,7 +118,7 @@ if __name__ == "__main__":
     parser.add_argument("-p", "--pattern", default="*", type=str,
                         help="File name pattern which should be applied to "
                              "filter the files which should be combined.")
-    parser.add_argument("-r", "--recursive", default=0, choices=(0, 1),
+    parser.add_argument("-r", "--recursive", default=0, type=int, choices=(0, 1),
                         help="Recursively traverse subdirs of the input "
                              "directory.")
     parser.add_argument("-ie", "--iencoding", default=None, type=str,
@@ -70,20 +126,20 @@ if __name__ == "__main__":
                              "when the conversation should be performed.")
     parser.add_argument("-oe", "--oencoding", default=None, type=str,
                         help="Encoding of the output files.")
+    parser.add_argument("-j", "--jobs", default=1, type=int,
+                        help="Number of processes converting files, when "
+                             "encodings are given.")
+    parser.add_argument("--tmp_dir", default=None, type=str,
+                        help="Directory for the converted segments.")
     args = parser.parse_args()
 
-    out_file = file(args.ofile, "w") if args.ofile is not None else sys.stdout
-
-    if args.iencoding is not None and args.oencoding is not None:
-        rd_file = lambda i_file: read_enc(i_file, args.iencoding)
-        wr_file = lambda lines: write_enc(out_file, args.oencoding, lines)
-    else:
-        rd_file = read
-        wr_file = lambda lines: write(out_file, lines)
+    out_file = file(args.ofile, "wb") if args.ofile is not None else sys.stdout
 
-    vst = lambda pattern, dir_name, files: \
-        visit(pattern, dir_name, files, rd_file, wr_file)
+    fl_paths = i_files(args.dir, args.pattern, args.recursive)
+    if args.ofile is not None:
+        # The combined file may be created inside of the input directory.
+        fl_paths = (fl_path for fl_path in fl_paths if os.path.abspath(fl_path) != os.path.abspath(args.ofile))
 
-    os.path.walk(args.dir, vst, args.pattern)
+    combine(fl_paths, out_file, args.iencoding, args.oencoding, args.jobs, args.tmp_dir)
 
-    out_file.close()
\ No newline at end of file
+    out_file.close()
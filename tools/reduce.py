@@ -10,22 +10,45 @@
 
 import os
 import sys
+import zlib
+import logging
 import argparse
+import itertools
 import collections
+import multiprocessing
 
 from fnmatch import fnmatch
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
 
-def accumulate_table(pattern, dir_name, files, result_table):
-    for filename in files:
-        if fnmatch(filename, pattern):
-            fl_path = os.path.join(dir_name, filename)
-            with open(fl_path, "r") as fl:
-                for row in fl:
-                    fields = row.split(", ")
-                    freq = int(fields[-1])
-                    r_key = ", ".join(fields[0:(len(fields) - 1)])
-                    result_table[r_key] += freq
+from mokujin import extsort
+from mokujin.streams import open_input
+
+
+def i_input_files(dir_name, pattern, recursive):
+    for dir_path, dir_names, file_names in os.walk(dir_name):
+        if recursive:
+            dir_names.sort()
+        else:
+            del dir_names[:]
+        for filename in sorted(file_names):
+            if fnmatch(filename, pattern):
+                yield os.path.join(dir_path, filename)
+
+
+def i_rows(fl_path):
+    with open_input(fl_path) as fl:
+        for row in fl:
+            fields = row.split(", ")
+            freq = int(fields[-1])
+            r_key = ", ".join(fields[0:(len(fields) - 1)])
+            yield r_key, freq
+
+
+def accumulate_table(fl_paths, result_table):
+    for fl_path in fl_paths:
+        for r_key, freq in i_rows(fl_path):
+            result_table[r_key] += freq
 
 
 def write_table(result_table, ofile):
@@ -36,22 +59,104 @@ def write_table(result_table, ofile):
         ofile.write("\n")
 
 
+def sort_partial(task):
+    """
+    Sums frequencies of the partial file rows in a counter of at most `max_items` keys, which is
+    written to disk as sorted runs (one per key partition) whenever it is full.
+    """
+    fl_path, n_parts, max_items, tmp_dir = task
+    part_runs = [[] for _ in xrange(n_parts)]
+    partial_table = collections.Counter()
+
+    def spill():
+        parts = [[] for _ in xrange(n_parts)]
+        for r_key, freq in partial_table.iteritems():
+            parts[zlib.crc32(r_key) % n_parts].append((r_key, freq))
+        for part, runs in zip(parts, part_runs):
+            if part:
+                part.sort()
+                runs.append(extsort.write_run(part, tmp_dir))
+        partial_table.clear()
+
+    for r_key, freq in i_rows(fl_path):
+        partial_table[r_key] += freq
+        if len(partial_table) >= max_items:
+            spill()
+    spill()
+    logging.info("SORTED %s" % fl_path)
+    return part_runs
+
+
+def merge_partition(task):
+    """
+    K-way merge of the sorted runs of one key partition. Summed rows are written as runs sorted
+    by (-freq, key).
+    """
+    run_paths, max_items, tmp_dir = task
+    try:
+        totals = extsort.i_sum_sorted(extsort.i_merge_runs(run_paths, tmp_dir))
+        return extsort.write_sorted_runs(((-freq, r_key) for r_key, freq in totals), max_items, tmp_dir)
+    finally:
+        extsort.remove_runs(run_paths)
+
+
+def write_merged(fl_paths, ofile, n_jobs, max_items, tmp_dir):
+    # Keys are partitioned by hash, so partitions can be merged independently, in parallel, and
+    # their results are merged once more by frequency while writing the output.
+    n_parts = n_jobs
+    pool = multiprocessing.Pool(n_jobs) if n_jobs > 1 else None
+    i_map = pool.imap if pool is not None else itertools.imap
+    part_runs = [[] for _ in xrange(n_parts)]
+    freq_runs = []
+    try:
+        for file_part_runs in i_map(sort_partial, [(fl_path, n_parts, max_items, tmp_dir) for fl_path in fl_paths]):
+            for runs, file_runs in zip(part_runs, file_part_runs):
+                runs.extend(file_runs)
+        logging.info("MERGING %d SORTED RUNS" % sum(map(len, part_runs)))
+        for runs in i_map(merge_partition, [(runs, max_items, tmp_dir) for runs in part_runs]):
+            freq_runs.extend(runs)
+        part_runs = []
+        for neg_freq, r_key in extsort.i_merge_runs(freq_runs, tmp_dir):
+            ofile.write(r_key)
+            ofile.write(", ")
+            ofile.write(str(-neg_freq))
+            ofile.write("\n")
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        extsort.remove_runs([run_path for runs in part_runs for run_path in runs])
+        extsort.remove_runs(freq_runs)
+
+
 if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO)
+
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", "--dir", default=None, type=str, help="A path to the directory containing the csv "
                                                                     "files which should be reduced.")
     parser.add_argument("-o", "--ofile", default=None, type=str, help="A path to the result file")
     parser.add_argument("-p", "--pattern", default="*", type=str, help="File name pattern which should be applied to "
                                                                        "filter the files which should be reduced.")
-    parser.add_argument("-r", "--recursive", default=0, choices=(0, 1), help="Recursively traverse sub-dirs of the "
-                                                                             "input directory.")
+    parser.add_argument("-r", "--recursive", default=1, type=int, choices=(0, 1), help="Recursively traverse sub-dirs "
+                                                                                       "of the input directory.")
+    parser.add_argument("-m", "--max_items", default=None, type=int, help="Merge the files externally, keeping at "
+                                                                          "most this many rows in memory (per "
+                                                                          "process).")
+    parser.add_argument("-j", "--jobs", default=1, type=int, help="Number of processes for the external merge "
+                                                                  "(implies it).")
+    parser.add_argument("--tmp_dir", default=None, type=str, help="Directory for the sorted runs of the external "
+                                                                  "merge.")
     args = parser.parse_args()
     out_file = file(args.ofile, "w") if args.ofile is not None else sys.stdout
-    result_table = collections.Counter()
-    os.path.walk(args.dir,
-                 lambda pattern, dir_name, files: accumulate_table(pattern, dir_name, files, result_table),
-                 args.pattern)
+    fl_paths = list(i_input_files(args.dir, args.pattern, args.recursive))
 
-    write_table(result_table, out_file)
+    if args.max_items is not None or args.jobs > 1:
+        write_merged(fl_paths, out_file, args.jobs, args.max_items or 1000000, args.tmp_dir)
+    else:
+        result_table = collections.Counter()
+        accumulate_table(fl_paths, result_table)
+        write_table(result_table, out_file)
 
-    out_file.close()
\ No newline at end of file
+    out_file.close()
@@ -8,8 +8,11 @@
 # For license information, see LICENSE
 
 import os
+import re
 import sys
+import mmap
 import argparse
+import multiprocessing
 
 
 SENT_END = 0xDC
@@ -58,39 +61,165 @@ FORMAT_SPLITTER_MAP = {
 }
 
 
-def split_file(ifile, ofilef, iformat, chunk_numb):
-    splitter = FORMAT_SPLITTER_MAP[iformat]()
-    source_size = os.path.getsize(ifile)
-    ifile = file(ifile, "r")
-    if chunk_numb is None:
-        chunk_size = source_size
-    else:
-        chunk_size = source_size / chunk_numb
-    read_bytes = 0
-    curren_chunk = 1
-    chunk = open(ofilef % curren_chunk, "w")
+# Runs of 2 or more newlines (1 or more blank lines) mapped the way PlainSplitter maps them: a single
+# blank line is dropped, every next one is a sentence end and is written as two newlines.
+PLAIN_RUN_RE = re.compile(r"\n\n+")
+PLAIN_MAPPED_RE = re.compile(r"(?<!\n)\n\n(?!\n)|\n\n\n\n")
+PLAIN_SENT_END = "\n\n\n"
+BLOCK_SIZE = 1 << 26
+
+
+def map_plain_run(match):
+    return "\n" * (2 * len(match.group()) - 3)
+
+
+def plain_cut_points(data, chunk_numb):
+    """
+    Finds at most `chunk_numb` - 1 cut points near size * k / chunk_numb. Every cut is made right after
+    a sentence end (two or more blank lines), so that chunks can be mapped independently.
+    """
+    size = len(data)
+    cuts = [0]
+    for k in xrange(1, chunk_numb):
+        position = data.find(PLAIN_SENT_END, max(size * k / chunk_numb, cuts[-1]))
+        if position == -1:
+            break
+        position += len(PLAIN_SENT_END)
+        while position < size and data[position] == "\n":
+            position += 1
+        if position >= size:
+            break
+        if position > cuts[-1]:
+            cuts.append(position)
+    cuts.append(size)
+    return cuts
+
+
+def ruwac_cut_points(data, chunk_numb):
+    """
+    Same as plain_cut_points for RuWaC files: chunks are cut before "<text", "</text" lines and
+    first tokens of sentences or after "SENT" tokens.
+    """
+    size = len(data)
+    cuts = [0]
+    for k in xrange(1, chunk_numb):
+        data.seek(max(size * k / chunk_numb, cuts[-1]))
+        if data.tell() > 0:
+            data.readline()
+        position = None
+        while True:
+            line_start = data.tell()
+            line = data.readline()
+            if not line:
+                break
+            if line.startswith("<text") or line.startswith("</text"):
+                position = line_start
+                break
+            tokens = line.split("\t")
+            if len(tokens) > 1 and tokens[1] == "SENT":
+                position = data.tell()
+                break
+            if len(tokens) > 4 and tokens[4] == "1":
+                position = line_start
+                break
+        if position is None or position >= size:
+            break
+        if position > cuts[-1]:
+            cuts.append(position)
+    cuts.append(size)
+    return cuts
+
+
+FORMAT_CUT_POINTS_MAP = {
+    "plain": plain_cut_points,
+    "ruwac": ruwac_cut_points,
+}
+
+
+def write_plain(data, start, end, chunk):
+    """
+    Writes data[start:end] mapped as by PlainSplitter. Blocks which are not changed by the mapping
+    are written directly from the mmap.
+    """
+    if start == 0:
+        position = 0
+        while position < end and data[position] == "\n":
+            position += 1
+        chunk.write("\n" * max(0, 2 * position - 3))
+        start = position
+    while start < end:
+        # Blocks end before a non-newline byte, so that runs of newlines are not split.
+        block_end = min(start + BLOCK_SIZE, end)
+        while block_end < end and data[block_end] == "\n":
+            block_end += 1
+        if PLAIN_MAPPED_RE.search(data, start, block_end) is None:
+            chunk.write(buffer(data, start, block_end - start))
+        else:
+            chunk.write(PLAIN_RUN_RE.sub(map_plain_run, data[start:block_end]))
+        start = block_end
+
+
+def i_range_lines(data, start, end):
+    data.seek(start)
+    while data.tell() < end:
+        yield data.readline()
+
+
+def write_mapped(lines, splitter, chunk, last):
     prev_is_end = True
-    for line in ifile:
-        read_bytes += len(line)
+    for line in lines:
         mappings = splitter.map_line(line)
         for mapping in mappings:
             if mapping is SENT_END:
                 if not prev_is_end:
                     chunk.write("\n")
                     prev_is_end = True
-                if read_bytes > chunk_size:
-                    read_bytes = 0
-                    chunk.close()
-                    curren_chunk += 1
-                    chunk = open(ofilef % curren_chunk, "w")
             else:
                 prev_is_end = False
                 chunk.write(mapping)
                 # chunk.write("\n")
-    
-    if not chunk.closed:
-        chunk.close()
-    ifile.close()
+    # Next chunk starts with a sentence end, which would be written here by the serial split.
+    if not prev_is_end and not last:
+        chunk.write("\n")
+
+
+def write_chunk(task):
+    ifile, start, end, chunk_path, iformat, last = task
+    with open(ifile, "rb") as i_fl, open(chunk_path, "wb") as chunk:
+        data = mmap.mmap(i_fl.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if iformat == "plain":
+                write_plain(data, start, end, chunk)
+            else:
+                write_mapped(i_range_lines(data, start, end), FORMAT_SPLITTER_MAP[iformat](), chunk, last)
+        finally:
+            data.close()
+    return chunk_path
+
+
+def split_file(ifile, ofilef, iformat, chunk_numb, n_jobs=None):
+    """
+    Splits the input file into at most `chunk_numb` chunks of about equal size, cut at sentence
+    boundaries. Chunks are mapped and written in parallel by `n_jobs` processes.
+    """
+    if os.path.getsize(ifile) == 0:
+        open(ofilef % 1, "w").close()
+        return
+    with open(ifile, "rb") as i_fl:
+        data = mmap.mmap(i_fl.fileno(), 0, access=mmap.ACCESS_READ)
+        cuts = FORMAT_CUT_POINTS_MAP[iformat](data, chunk_numb or 1)
+        data.close()
+    tasks = []
+    for i in xrange(len(cuts) - 1):
+        tasks.append((ifile, cuts[i], cuts[i + 1], ofilef % (i + 1), iformat, i == len(cuts) - 2))
+    n_jobs = min(n_jobs or multiprocessing.cpu_count(), len(tasks))
+    if n_jobs > 1:
+        pool = multiprocessing.Pool(n_jobs)
+        pool.map(write_chunk, tasks, chunksize=1)
+        pool.close()
+        pool.join()
+    else:
+        map(write_chunk, tasks)
 
 
 if __name__ == "__main__":
@@ -103,6 +232,7 @@ if __name__ == "__main__":
     parser.add_argument("-o", "--ofilef", default=None, type=str)
     parser.add_argument("-n", "--chunknumb", default=1, type=int)
     parser.add_argument("-f", "--iformat", default="plain", type=str, choices=iformats)
+    parser.add_argument("-j", "--jobs", default=None, type=int)
 
     args = parser.parse_args()
 
@@ -116,4 +246,4 @@ if __name__ == "__main__":
                          "and the output files format (-i/--ifile and -o/--ofilef)\n")
         exit(1)
         
-    split_file(ifile, ofilef, iformat, chunk_numb)
+    split_file(ifile, ofilef, iformat, chunk_numb, args.jobs)